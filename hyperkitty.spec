@@ -31,7 +31,6 @@ BuildRequires:  pytz
 BuildRequires:  python-django-paintstore
 BuildRequires:  python-django >= 1.8
 BuildRequires:  python-dateutil
-BuildRequires:  python-networkx
 BuildRequires:  python-enum34
 BuildRequires:  python-django-haystack >= 2.5.0
 BuildRequires:  python-django-extensions
@@ -60,7 +59,6 @@ Requires:       pytz
 Requires:       python-django-paintstore
 Requires:       python-django >= 1.8
 Requires:       python-dateutil
-Requires:       python-networkx
 Requires:       python-enum34
 Requires:       python-django-haystack >= 2.5.0
 Requires:       python-django-extensions
@@ -30,9 +30,11 @@ This can happen if HK receives the reply before the original message (when a
 mail server in the chain has an issue, or in case of greylisting for example).
 """
 
+from django.db.models import OuterRef, Subquery
+
 from django_extensions.management.jobs import BaseJob
 
-from hyperkitty.models import Email
+from hyperkitty.models import Email, PendingReply
 
 
 class Job(BaseJob):
@@ -40,16 +42,17 @@ class Job(BaseJob):
     when = "daily"
 
     def execute(self):
-        orphan_starters = Email.objects.filter(
-            parent_id__isnull=True, in_reply_to__isnull=False)
-        for orphan_starter in orphan_starters:
-            parent = Email.objects.filter(
-                mailinglist=orphan_starter.mailinglist,
-                message_id=orphan_starter.in_reply_to).first()
-            if parent is None:
-                continue
-            if orphan_starter.id == parent.id:
-                # an email with the in-reply-to header pointing to itself,
-                # that's just bogus, ignore it.
-                continue
-            orphan_starter.set_parent(parent)
+        parents = Email.objects.filter(
+            mailinglist_id=OuterRef("mailinglist_id"),
+            message_id=OuterRef("in_reply_to"),
+        ).exclude(
+            # an email with the in-reply-to header pointing to itself, that's
+            # just bogus, ignore it.
+            id=OuterRef("email_id")
+        ).values("id")[:1]
+        resolved = PendingReply.objects.annotate(
+            parent_id=Subquery(parents)
+        ).filter(parent_id__isnull=False).select_related("email")
+        for pending_reply in resolved:
+            parent = Email.objects.get(id=pending_reply.parent_id)
+            pending_reply.email.set_parent(parent)
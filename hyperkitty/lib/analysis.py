@@ -23,33 +23,113 @@ Analysis of messages or threads of messages
 Author: Aurelien Bompard <abompard@fedoraproject.org>
 """
 
+from collections import defaultdict
+
 from django.db import transaction
+from django.db.models import F, Max, Min, Q
+
 
-import networkx as nx
+def get_thread_positions(starting_email_id, emails):
+    """
+    Compute the position of the emails in a thread.
+
+    :arg starting_email_id: the id of the thread's starting email.
+    :arg emails: the (id, parent_id) tuples of the thread's emails, sorted by
+        date.
+    :returns: a dict of email id -> (thread_order, thread_depth). The emails
+        that can't be reached from the starting email are not included.
+    """
+    children = defaultdict(list)
+    for email_id, parent_id in emails:
+        if parent_id is not None:
+            children[parent_id].append(email_id)
+    # Walk the tree depth-first. Emails that have already been visited are
+    # skipped, I don't want reply loops in my graph, thank you very much.
+    positions = {}
+    order = 0
+    stack = [(starting_email_id, 0)]
+    while stack:
+        email_id, depth = stack.pop()
+        if email_id in positions:
+            continue
+        positions[email_id] = (order, depth)
+        order += 1
+        stack.extend(
+            (child_id, depth + 1)
+            for child_id in reversed(children[email_id]))
+    return positions
 
 
 def compute_thread_order_and_depth(thread):
     # Emails must be saved, there will be DB queries in this function.
-    graph = nx.DiGraph()
-    thread_pos = {"d": 0, "o": 0}  # depth, order
-
-    def walk_successors(msgid):
-        obj = graph.nodes[msgid]["obj"]
-        obj.thread_depth = thread_pos["d"]
-        obj.thread_order = thread_pos["o"]
-        obj.save(update_fields=["thread_depth", "thread_order"])
-        thread_pos["d"] += 1
-        thread_pos["o"] += 1
-        for succ in sorted(graph.successors(msgid),
-                           key=lambda m: graph.nodes[m]["num"]):
-            walk_successors(succ)
-        thread_pos["d"] -= 1
-    for index, email in enumerate(thread.emails.order_by("date")):
-        graph.add_node(email.id, num=index, obj=email)
-        if email.parent_id is not None:
-            graph.add_edge(email.parent_id, email.id)
-            if not nx.is_directed_acyclic_graph(graph):
-                # I don't want reply loops in my graph, thank you very much
-                graph.remove_edge(email.parent_id, email.id)
+    if thread.starting_email_id is None:
+        return
+    Email = thread.emails.model
+    emails = []
+    old_positions = {}
+    for email_id, parent_id, order, depth in thread.emails.order_by(
+            "date", "id").values_list(
+            "id", "parent_id", "thread_order", "thread_depth"):
+        old_positions[email_id] = (order, depth)
+        emails.append((email_id, parent_id))
+    if thread.starting_email_id not in old_positions:
+        return
+    changed = [
+        Email(id=email_id, thread_order=order, thread_depth=depth)
+        for email_id, (order, depth) in get_thread_positions(
+            thread.starting_email_id, emails).items()
+        if old_positions[email_id] != (order, depth)]
+    if changed:
+        with transaction.atomic():
+            Email.objects.bulk_update(
+                changed, ["thread_order", "thread_depth"])
+
+
+def add_to_thread_order(thread):
+    """
+    Compute the position of the emails recently added to a thread, without
+    recomputing the positions of the whole thread.
+
+    This only handles the common case where the new emails are replies to an
+    email that already has a position, have no replies yet, and are more
+    recent than their siblings. A new email is then placed right after its
+    parent's sub-thread, and only the emails that follow are moved down.
+
+    :returns: ``True`` if the positions are up-to-date, ``False`` if the whole
+        thread must be recomputed with ``compute_thread_order_and_depth()``.
+    """
     with transaction.atomic():
-        walk_successors(thread.starting_email.id)
+        # Only one update of the thread positions at a time.
+        type(thread).objects.select_for_update().filter(id=thread.id).first()
+        new_emails = thread.emails.filter(
+            thread_order__isnull=True).order_by("date", "id").values_list(
+            "id", "parent_id", "date")
+        for email_id, parent_id, date in new_emails:
+            if parent_id is None or parent_id == email_id:
+                return False
+            parent = thread.emails.filter(id=parent_id).values_list(
+                "thread_order", "thread_depth").first()
+            if parent is None or parent[0] is None:
+                return False
+            parent_order, parent_depth = parent
+            if thread.emails.filter(parent_id=email_id).exists():
+                return False
+            if thread.emails.filter(parent_id=parent_id).filter(
+                    Q(date__gt=date) | Q(date=date, id__gt=email_id)
+                    ).exists():
+                return False
+            # The parent's sub-thread ends at the next email that is not
+            # deeper than the parent.
+            position = thread.emails.filter(
+                thread_order__gt=parent_order,
+                thread_depth__lte=parent_depth,
+            ).aggregate(position=Min("thread_order"))["position"]
+            if position is None:
+                position = thread.emails.aggregate(
+                    position=Max("thread_order"))["position"] + 1
+            else:
+                thread.emails.filter(thread_order__gte=position).update(
+                    thread_order=F("thread_order") + 1)
+            thread.emails.filter(id=email_id).update(
+                thread_order=position, thread_depth=parent_depth + 1)
+    return True
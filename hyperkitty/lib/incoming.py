@@ -22,19 +22,23 @@
 
 import logging
 import re
+from collections import namedtuple
 from email.message import EmailMessage
 
 from django.conf import settings
-from django.db import DataError
+from django.core.cache import cache
+from django.db import DataError, transaction
 from django.utils import timezone
 
 from django_mailman3.lib.scrub import Scrubber
 
+from hyperkitty.lib import metrics
 from hyperkitty.lib.utils import (
-    get_message_id, get_ref, header_to_unicode, parseaddr, parsedate)
+    LRUCache, get_message_id, get_ref, header_to_unicode, parseaddr, parsedate)
 from hyperkitty.models import (
-    ArchivePolicy, Attachment, Email, MailingList, Sender)
-from hyperkitty.tasks import sender_mailman_id, update_from_mailman
+    ArchivePolicy, Attachment, Email, MailingList, PendingReply, Sender)
+from hyperkitty.tasks import (
+    get_mailman_lookup_key, sender_mailman_id, update_from_mailman)
 
 
 logger = logging.getLogger(__name__)
@@ -43,88 +47,266 @@ logger = logging.getLogger(__name__)
 UNIXFROM_DATE_RE = re.compile(r'^\s*[^\s]+@[^\s]+ (.*)$')
 
 
+# Per-process caches of the MailingList and Sender rows used when archiving,
+# to avoid a few queries per archived email.
+_mailinglist_cache = LRUCache(
+    maxsize=getattr(settings, "HYPERKITTY_INCOMING_CACHE_SIZE", 1000),
+    timeout=getattr(settings, "HYPERKITTY_INCOMING_CACHE_TIMEOUT", 300))
+_sender_cache = LRUCache(
+    maxsize=getattr(settings, "HYPERKITTY_INCOMING_CACHE_SIZE", 1000),
+    timeout=getattr(settings, "HYPERKITTY_INCOMING_CACHE_TIMEOUT", 300))
+
+
+def _cache_row(lru_cache, key, instance, created):
+    if created:
+        # Don't cache a row that may be rolled back.
+        transaction.on_commit(lambda: lru_cache.set(key, instance))
+    else:
+        lru_cache.set(key, instance)
+
+
+def get_mailinglist(list_name):
+    mlist = _mailinglist_cache.get(list_name)
+    if mlist is None:
+        mlist, created = MailingList.objects.get_or_create(name=list_name)
+        _cache_row(_mailinglist_cache, list_name, mlist, created)
+    return mlist
+
+
+def get_sender(address):
+    sender = _sender_cache.get(address)
+    if sender is None:
+        sender, created = Sender.objects.get_or_create(address=address)
+        _cache_row(_sender_cache, address, sender, created)
+    return sender
+
+
+def forget_mailinglist(list_name=None):
+    """Forget a cached MailingList, or all of them if no name is given."""
+    if list_name is None:
+        _mailinglist_cache.clear()
+    else:
+        _mailinglist_cache.delete(list_name)
+
+
+def clear_lookup_caches():
+    _mailinglist_cache.clear()
+    _sender_cache.clear()
+
+
+# Names of the counters of the calls to Mailman that were not made.
+SUPPRESSED_COUNTERS = (
+    "update_from_mailman_suppressed",
+    "sender_mailman_id_suppressed",
+)
+
+
+def refresh_from_mailman(mlist):
+    """
+    Schedule the update of the list properties from Mailman, unless it has
+    already been done recently.
+    """
+    interval = getattr(
+        settings, "HYPERKITTY_MAILMAN_LIST_REFRESH_INTERVAL", 900)
+    if interval and not cache.add(
+            "MailingList:%s:mailman_refresh" % mlist.pk, True, interval):
+        metrics.incr("update_from_mailman_suppressed")
+        return
+    update_from_mailman(mlist.name)
+
+
+def lookup_mailman_id(sender):
+    """
+    Schedule the lookup of the sender's Mailman user id, unless it is already
+    known or it has been looked up recently.
+    """
+    if sender.mailman_id is not None:
+        metrics.incr("sender_mailman_id_suppressed")
+        return
+    interval = getattr(
+        settings, "HYPERKITTY_MAILMAN_SENDER_LOOKUP_INTERVAL", 86400)
+    # The marker is removed by the task if Mailman can't be reached, so that
+    # only the senders that were not found are skipped.
+    key = get_mailman_lookup_key(sender.address)
+    if interval and not cache.add(key, True, interval):
+        # Not found in Mailman the last time, or being looked up.
+        metrics.incr("sender_mailman_id_suppressed")
+        return
+    sender_mailman_id(sender.pk)
+
+
 class DuplicateMessage(Exception):
     """
     The database already contains an email with the same Message-ID header.
     """
 
 
-def add_to_list(list_name, message, from_import=False):
+# The stages of the archiving process, as measured by the metrics Timer.
+STAGES = (
+    "mailinglist", "message_id", "sender", "headers", "scrub", "parent",
+    "save", "attachments",
+)
+
+
+def add_to_list(list_name, message, from_import=False, timer=None):
     assert isinstance(message, EmailMessage)
-    # timeit("1 start")
-    mlist = MailingList.objects.get_or_create(name=list_name)[0]
-    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        update_from_mailman(mlist.name)
-    mlist.save()
+    if timer is None:
+        timer = metrics.Timer()
+    with timer.stage("mailinglist"):
+        mlist = get_mailinglist(list_name)
+        if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+            refresh_from_mailman(mlist)
     if mlist.archive_policy == ArchivePolicy.never.value and not from_import:
         logger.info("Archiving disabled by list policy for %s", list_name)
         return
+    return _add_to_mlist(mlist, message, timer)
+
+
+def add_many_to_list(list_name, messages, timer=None):
+    """
+    Archive several messages to the same mailing-list in one transaction.
+
+    The mailing-list and the senders are only looked up once for the whole
+    batch. Each message is stored in its own savepoint, so that a message that
+    can't be archived does not prevent the others from being stored.
+
+    :returns: a list with one item per message, in the same order: the
+        message's Message-ID hash if it was archived, ``None`` if archiving is
+        disabled for this list, or the exception that prevented archiving it
+        (a ``DuplicateMessage`` if it was already archived).
+    """
+    if timer is None:
+        timer = metrics.Timer()
+    with timer.stage("mailinglist"):
+        mlist = get_mailinglist(list_name)
+        if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+            refresh_from_mailman(mlist)
+    if mlist.archive_policy == ArchivePolicy.never.value:
+        logger.info("Archiving disabled by list policy for %s", list_name)
+        return [None for message in messages]
+    senders = {}
+    results = []
+    with transaction.atomic():
+        for message in messages:
+            assert isinstance(message, EmailMessage)
+            try:
+                with transaction.atomic():
+                    result = _add_to_mlist(mlist, message, timer, senders)
+            except (DuplicateMessage, ValueError) as e:
+                result = e
+            except Exception as e:
+                logger.exception(
+                    "Could not archive the email with message-id '%s'",
+                    message.get("Message-Id", None))
+                result = e
+            results.append(result)
+    return results
+
+
+def _add_to_mlist(mlist, message, timer, senders=None):
+    with timer.stage("message_id"):
+        if "Message-Id" not in message:
+            raise ValueError("No 'Message-Id' header in email", message)
+        msg_id = get_message_id(message)
+        if Email.objects.filter(
+                mailinglist=mlist, message_id=msg_id).exists():
+            raise DuplicateMessage(msg_id)
+    parsed = parse_message(message, timer)
+    return store_email(mlist, parsed, timer, senders).message_id_hash
+
+
+# The data extracted from an email, without any database access. It can be
+# pickled to be sent between processes.
+ParsedEmail = namedtuple("ParsedEmail", [
+    "message_id", "in_reply_to", "archived_date", "sender_name",
+    "sender_address", "subject", "date", "timezone", "content",
+    "attachments",
+])
+
+
+def parse_message(message, timer=None):
+    """
+    Extract the data that will be stored in the database from an email.
+
+    This is the CPU-intensive part of archiving, it does not access the
+    database.
+
+    :returns: a ``ParsedEmail`` instance.
+    :raises ValueError: if the email can't be archived.
+    """
+    if timer is None:
+        timer = metrics.Timer()
     if "Message-Id" not in message:
         raise ValueError("No 'Message-Id' header in email", message)
-    # timeit("2 after ml, before checking email & sender")
-    msg_id = get_message_id(message)
-    if Email.objects.filter(mailinglist=mlist, message_id=msg_id).exists():
-        raise DuplicateMessage(msg_id)
-    email = Email(mailinglist=mlist, message_id=msg_id)
-    email.in_reply_to = get_ref(message)  # Find thread id
-    if message.get_unixfrom() is not None:
-        mo = UNIXFROM_DATE_RE.match(message.get_unixfrom())
-        if mo:
-            archived_date = parsedate(mo.group(1))
-            if archived_date is not None:
-                email.archived_date = archived_date
-
-    # Sender
-    try:
-        from_str = header_to_unicode(message['From'])
-        from_name, from_email = parseaddr(from_str)
-        from_name = from_name.strip()
-        sender_address = from_email.encode('ascii').decode("ascii").strip()
-    except (UnicodeDecodeError, UnicodeEncodeError):
-        raise ValueError("Non-ascii sender address", message)
-    if not sender_address:
-        if from_name:
-            sender_address = re.sub("[^a-z0-9]", "", from_name.lower())
-            if not sender_address:
-                sender_address = "unknown"
-            sender_address = "{}@example.com".format(sender_address)
+    with timer.stage("headers"):
+        archived_date = None
+        if message.get_unixfrom() is not None:
+            mo = UNIXFROM_DATE_RE.match(message.get_unixfrom())
+            if mo:
+                archived_date = parsedate(mo.group(1))
+        sender_name, sender_address = _parse_sender(message)
+        subject = header_to_unicode(message.get('Subject'))
+        if subject is not None:
+            # limit subject size to 512, it's a varchar field
+            subject = subject[:512]
+        msg_date = parsedate(message.get("Date"))
+        if msg_date is None:
+            # Absent or unparseable date
+            msg_date = timezone.now()
+        utcoffset = msg_date.utcoffset()
+        if msg_date.tzinfo is not None:
+            msg_date = msg_date.astimezone(timezone.utc)  # store in UTC
+        if utcoffset is None:
+            msg_timezone = 0
         else:
-            sender_address = "unknown@example.com"
-    email.sender_name = from_name
-    sender = Sender.objects.get_or_create(address=sender_address)[0]
-    email.sender = sender
-    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
-        sender_mailman_id(sender.pk)
-    # timeit("3 after sender, before email content")
-
-    # Headers
-    email.subject = header_to_unicode(message.get('Subject'))
-    if email.subject is not None:
-        # limit subject size to 512, it's a varchar field
-        email.subject = email.subject[:512]
-    msg_date = parsedate(message.get("Date"))
-    if msg_date is None:
-        # Absent or unparseable date
-        msg_date = timezone.now()
-    utcoffset = msg_date.utcoffset()
-    if msg_date.tzinfo is not None:
-        msg_date = msg_date.astimezone(timezone.utc)  # store in UTC
-    email.date = msg_date
-    if utcoffset is None:
-        email.timezone = 0
-    else:
-        # in minutes
-        email.timezone = int(
-            ((utcoffset.days * 24 * 60 * 60) + utcoffset.seconds) / 60)
+            # in minutes
+            msg_timezone = int(
+                ((utcoffset.days * 24 * 60 * 60) + utcoffset.seconds) / 60)
+        message_id = get_message_id(message)
+        in_reply_to = get_ref(message)  # Find thread id
 
     # Content
-    scrubber = Scrubber(message)
-    # warning: scrubbing modifies the msg in-place
-    email.content, attachments = scrubber.scrub()
-    # timeit("4 after email content, before signals")
+    with timer.stage("scrub"):
+        scrubber = Scrubber(message)
+        # warning: scrubbing modifies the msg in-place
+        content, attachments = scrubber.scrub()
 
     # TODO: detect category?
 
+    return ParsedEmail(
+        message_id=message_id, in_reply_to=in_reply_to,
+        archived_date=archived_date, sender_name=sender_name,
+        sender_address=sender_address, subject=subject, date=msg_date,
+        timezone=msg_timezone, content=content,
+        attachments=[tuple(attachment) for attachment in attachments],
+    )
+
+
+def store_email(mlist, parsed, timer=None, senders=None):
+    """
+    Store an email in the database.
+
+    The caller must make sure that the email is not already archived.
+
+    :param parsed: a ``ParsedEmail`` instance, as returned by
+        ``parse_message()``.
+    :param senders: an optional dict of the senders already looked up, by
+        address.
+    :returns: the ``Email`` instance.
+    """
+    if timer is None:
+        timer = metrics.Timer()
+    email = Email(
+        mailinglist=mlist, message_id=parsed.message_id,
+        in_reply_to=parsed.in_reply_to, sender_name=parsed.sender_name,
+        subject=parsed.subject, date=parsed.date, timezone=parsed.timezone,
+        content=parsed.content)
+    if parsed.archived_date is not None:
+        email.archived_date = parsed.archived_date
+
+    with timer.stage("sender"):
+        email.sender = _get_sender(parsed.sender_address, senders)
+
     # Find the parent email.
     # This can't be moved to Email.on_pre_save() because Email.set_parent()
     # needs to be free to change the parent independently from the in_reply_to
@@ -135,26 +317,74 @@ def add_to_list(list_name, message, from_import=False):
     # parent). The work in Email.on_post_created() also depends on it, so be
     # careful with task dependencies if you ever do this.
     # Plus, it has "premature optimization" written all over it.
-    if email.in_reply_to is not None:
+    with timer.stage("parent"):
+        if email.in_reply_to is not None:
+            try:
+                ref_msg = Email.objects.get(
+                    mailinglist=email.mailinglist,
+                    message_id=email.in_reply_to)
+            except Email.DoesNotExist:
+                # the parent may not be archived (on partial imports), create
+                # a new thread for now.
+                pass
+            else:
+                # re-use parent's thread-id
+                email.parent = ref_msg
+                email.thread_id = ref_msg.thread_id
+
+    with timer.stage("save"):
         try:
-            ref_msg = Email.objects.get(
-                mailinglist=email.mailinglist,
-                message_id=email.in_reply_to)
-        except Email.DoesNotExist:
-            # the parent may not be archived (on partial imports), create a new
-            # thread for now.
-            pass
-        else:
-            # re-use parent's thread-id
-            email.parent = ref_msg
-            email.thread_id = ref_msg.thread_id
+            email.save()
+        except DataError as e:
+            raise ValueError(str(e))
+
+        if (email.in_reply_to is not None and email.parent_id is None
+                and email.in_reply_to != email.message_id):
+            # Wait for the parent to be archived.
+            PendingReply.objects.create(
+                mailinglist=mlist, in_reply_to=email.in_reply_to,
+                email=email)
+
+    with timer.stage("attachments"):
+        _add_attachments(email, parsed.attachments)
 
+    return email
+
+
+def _parse_sender(message):
+    """Return the name and the address of the email's sender."""
     try:
-        email.save()
-    except DataError as e:
-        raise ValueError(str(e))
+        from_str = header_to_unicode(message['From'])
+        from_name, from_email = parseaddr(from_str)
+        from_name = from_name.strip()
+        sender_address = from_email.encode('ascii').decode("ascii").strip()
+    except (UnicodeDecodeError, UnicodeEncodeError):
+        raise ValueError("Non-ascii sender address", message)
+    if not sender_address:
+        if from_name:
+            sender_address = re.sub("[^a-z0-9]", "", from_name.lower())
+            if not sender_address:
+                sender_address = "unknown"
+            sender_address = "{}@example.com".format(sender_address)
+        else:
+            sender_address = "unknown@example.com"
+    return from_name, sender_address
+
+
+def _get_sender(sender_address, senders=None):
+    if senders is not None and sender_address in senders:
+        # Already looked up in this batch.
+        return senders[sender_address]
+    sender = get_sender(sender_address)
+    if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
+        lookup_mailman_id(sender)
+    if senders is not None:
+        senders[sender_address] = sender
+    return sender
+
 
-    # Attachments (email must have been saved before)
+def _add_attachments(email, attachments):
+    # The email must have been saved before
     for attachment in attachments:
         counter, name, content_type, encoding, content = attachment
         if Attachment.objects.filter(email=email, counter=counter).exists():
@@ -164,5 +394,3 @@ def add_to_list(list_name, message, from_import=False):
             encoding=encoding)
         att.set_content(content)
         att.save()
-
-    return email.message_id_hash
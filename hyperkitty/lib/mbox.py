@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Read the messages of a mbox file, a compressed mbox file or a Maildir folder
+without loading it in memory.
+"""
+
+import bz2
+import gzip
+import lzma
+import mailbox
+import mmap
+import os
+from email import policy
+from email.parser import Parser
+
+
+class MboxReader:
+    """
+    Iterate over the messages of a mbox file.
+
+    The file is mapped in memory, and the messages are found by searching for
+    the ``From`` lines as they are read, instead of building a table of
+    contents first like ``mailbox.mbox`` does. Iterating gives the start and
+    end offsets of each message, which can then be read with ``view()``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        if self.size:
+            self._map = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # Empty files can't be mapped.
+            self._map = b""
+
+    def __iter__(self):
+        return self.messages()
+
+    def messages(self, offset=0):
+        """
+        Iterate over the start and end offsets of the messages.
+
+        :arg offset: the offset where the search for the messages starts, for
+            example the end offset of a message that was read before.
+        """
+        data = self._map
+        if data[offset:offset + 5] == b"From ":
+            start = offset
+        else:
+            # Ignore what comes before the first From line.
+            start = data.find(b"\nFrom ", offset)
+            if start == -1:
+                return
+            start += 1
+        while True:
+            next_start = data.find(b"\nFrom ", start)
+            end = self.size if next_start == -1 else next_start + 1
+            # Like mailbox.mbox, don't include the empty line before the next
+            # From line or the end of the file.
+            if end - start > 1 and data[end - 2:end] == b"\n\n":
+                yield start, end - 1
+            else:
+                yield start, end
+            if next_start == -1:
+                return
+            start = end
+
+    def view(self, start, end):
+        """
+        Return the bytes of a message, including its From line, without
+        copying them. The caller must release the ``memoryview`` before the
+        reader is closed.
+        """
+        return memoryview(self._map)[start:end]
+
+    def close(self):
+        if self.size:
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class MboxStreamReader:
+    """
+    Iterate over the messages of a mbox file object, such as an uploaded file.
+
+    The file is read line by line, and the messages are split like
+    ``MboxReader`` does. The offsets are positions in the file.
+    """
+
+    def __init__(self, fileobj):
+        self.size = None
+        self._file = fileobj
+
+    def read(self, offset=0):
+        """
+        Iterate over the messages, as (end offset, bytes) tuples.
+
+        :arg offset: the offset where the search for the messages starts, for
+            example the end offset of a message that was read before.
+        """
+        self._file.seek(offset)
+        position = offset
+        lines = []
+        for line in iter(self._file.readline, b""):
+            if line.startswith(b"From "):
+                if lines:
+                    yield self._get_message(lines, position)
+                lines = [line]
+            elif lines:
+                lines.append(line)
+            # Ignore what comes before the first From line.
+            position += len(line)
+        if lines:
+            yield self._get_message(lines, position)
+
+    def _get_message(self, lines, end):
+        # Like mailbox.mbox, don't include the empty line before the next
+        # From line or the end of the file.
+        if len(lines) > 1 and lines[-1] == b"\n":
+            lines.pop()
+            end -= 1
+        return end, b"".join(lines)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class CompressedMboxReader(MboxStreamReader):
+    """
+    Iterate over the messages of a compressed mbox file.
+
+    The file is decompressed as it is read, and the messages are split like
+    ``MboxReader`` does. The offsets are positions in the decompressed data.
+    """
+
+    def __init__(self, path, module):
+        # The decompressed size is unknown.
+        super().__init__(module.open(path, "rb"))
+        self.path = path
+
+
+class MaildirReader:
+    """
+    Iterate over the messages of a Maildir folder.
+
+    The messages are read in the order of their file names, which start with
+    their delivery time. The offsets are positions in this order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._maildir = mailbox.Maildir(path, factory=None, create=False)
+        self._keys = sorted(self._maildir.keys())
+        self.size = len(self._keys)
+
+    def read(self, offset=0):
+        """
+        Iterate over the messages, as (end offset, bytes) tuples.
+
+        :arg offset: the number of messages to skip.
+        """
+        for index in range(offset, self.size):
+            yield index + 1, self._maildir.get_bytes(self._keys[index])
+
+    def close(self):
+        self._maildir.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+COMPRESSION_MODULES = {".gz": gzip, ".bz2": bz2, ".xz": lzma}
+
+
+def is_maildir(path):
+    return os.path.isdir(os.path.join(path, "cur"))
+
+
+def open_mailbox(path):
+    """
+    Open a mbox file, a compressed mbox file or a Maildir folder.
+
+    :returns: a ``MboxReader`` for uncompressed mbox files, which can be
+        mapped in memory, or a reader with a ``read()`` method for the other
+        sources.
+    """
+    if is_maildir(path):
+        return MaildirReader(path)
+    module = COMPRESSION_MODULES.get(os.path.splitext(path)[1].lower())
+    if module is not None:
+        return CompressedMboxReader(path, module)
+    return MboxReader(path)
+
+
+def get_mtime(path):
+    """
+    Return the last modification time of a mailbox. The folders of a Maildir
+    are modified when messages are delivered, not the Maildir itself.
+    """
+    if is_maildir(path):
+        return max(os.path.getmtime(os.path.join(path, folder))
+                   for folder in ("cur", "new"))
+    return os.path.getmtime(path)
+
+
+def parse_mbox_message(data):
+    """
+    Parse a message from a mbox file or a Maildir folder.
+
+    :arg data: the message as a bytes-like object. Its From line, if any, is
+        set as the message's unixfrom.
+    :returns: an ``email.message.EmailMessage`` instance.
+    """
+    # This is what BytesParser.parsebytes() does, but it only accepts bytes.
+    text = str(data, "ascii", "surrogateescape")
+    return Parser(policy=policy.default).parsestr(text)
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Counters and timings describing what the archiver is doing.
+
+The counters are stored in Django's cache so that they are shared by all the
+processes. They are only an indication: they are lost when the cache is
+cleared, and they are not updated when the cache backend does not support
+atomic increments (such as the dummy cache).
+
+The timings of the archiving stages are measured by a ``Timer`` and sent to
+the collectors listed in the ``HYPERKITTY_METRICS_COLLECTORS`` setting.
+"""
+
+import logging
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils.module_loading import import_string
+
+
+logger = logging.getLogger(__name__)
+
+
+COUNTER_KEY = "HyperKitty:counter:%s"
+
+
+def incr(name, delta=1):
+    """Increment the counter called ``name``."""
+    key = COUNTER_KEY % name
+    try:
+        cache.incr(key, delta)
+    except ValueError:
+        # The counter does not exist yet (or the backend can't store it).
+        cache.add(key, 0, None)
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            pass
+
+
+def get_counters(names):
+    """Return a dict of the current values of the counters in ``names``."""
+    values = cache.get_many([COUNTER_KEY % name for name in names])
+    return {name: values.get(COUNTER_KEY % name, 0) for name in names}
+
+
+#
+# Timings
+#
+
+TIMINGS_KEY = "HyperKitty:timings:%s"
+
+
+def percentile(values, percent):
+    """Return the ``percent`` percentile of ``values``, or ``None``."""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, math.ceil(percent / 100.0 * len(values)) - 1)
+    return values[index]
+
+
+def summarize(samples):
+    """
+    Compute the statistics of a list of ``(duration, queries)`` samples.
+    """
+    durations = [duration for duration, queries in samples]
+    queries = [queries for duration, queries in samples]
+    return {
+        "count": len(samples),
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+        "queries_p50": percentile(queries, 50),
+        "queries_p95": percentile(queries, 95),
+    }
+
+
+class MemoryCollector:
+    """
+    Keep the statistics of each stage in memory, for the duration of a
+    command.
+
+    The number of samples and their totals are exact, but the percentiles are
+    computed on a random selection of ``HYPERKITTY_METRICS_SAMPLES`` samples
+    of each stage (reservoir sampling), so that the memory used does not grow
+    with the number of samples.
+    """
+
+    def __init__(self):
+        self.size = getattr(settings, "HYPERKITTY_METRICS_SAMPLES", 1000)
+        self.samples = defaultdict(list)
+        self.counts = defaultdict(int)
+        self.total_durations = defaultdict(float)
+        self.total_queries = defaultdict(int)
+
+    def record(self, stage, duration, queries):
+        self.counts[stage] += 1
+        self.total_durations[stage] += duration
+        self.total_queries[stage] += queries
+        samples = self.samples[stage]
+        if len(samples) < self.size:
+            samples.append((duration, queries))
+        else:
+            index = random.randrange(self.counts[stage])
+            if index < self.size:
+                samples[index] = (duration, queries)
+
+    def get_stats(self):
+        stats = {}
+        for stage, samples in self.samples.items():
+            stats[stage] = summarize(samples)
+            stats[stage].update({
+                "count": self.counts[stage],
+                "total": self.total_durations[stage],
+                "queries_total": self.total_queries[stage],
+            })
+        return stats
+
+
+class LoggingCollector:
+    """Log the timings of each stage."""
+
+    def record(self, stage, duration, queries):
+        logger.debug("Stage %s: %.1f ms, %d queries",
+                     stage, duration * 1000, queries)
+
+
+class CacheCollector:
+    """
+    Keep the latest samples of each stage in Django's cache, to share them
+    between processes.
+
+    The number of samples kept for each stage is set by the
+    ``HYPERKITTY_METRICS_SAMPLES`` setting. To stay out of the way of the
+    archiving, each process keeps its samples in memory and writes them to
+    the cache at most every ``HYPERKITTY_METRICS_FLUSH_INTERVAL`` seconds,
+    with a single request for all the stages. Updates are not atomic, some
+    samples may be lost when several processes flush them at the same time.
+    """
+
+    # Shared by the instances of the process.
+    _pending = defaultdict(list)
+    _last_flush = 0
+    _lock = threading.Lock()
+
+    def __init__(self):
+        self.size = getattr(settings, "HYPERKITTY_METRICS_SAMPLES", 1000)
+        self.interval = getattr(
+            settings, "HYPERKITTY_METRICS_FLUSH_INTERVAL", 10)
+
+    def record(self, stage, duration, queries):
+        cls = self.__class__
+        with cls._lock:
+            samples = cls._pending[stage]
+            samples.append((duration, queries))
+            del samples[:-self.size]
+            must_flush = time.monotonic() - cls._last_flush >= self.interval
+        if must_flush:
+            self.flush()
+
+    @classmethod
+    def flush(cls):
+        """Write the samples of this process to the cache."""
+        with cls._lock:
+            pending = dict(cls._pending)
+            cls._pending.clear()
+            cls._last_flush = time.monotonic()
+        if not pending:
+            return
+        size = getattr(settings, "HYPERKITTY_METRICS_SAMPLES", 1000)
+        keys = {TIMINGS_KEY % stage: stage for stage in pending}
+        stored = cache.get_many(list(keys))
+        cache.set_many({
+            key: (stored.get(key, []) + pending[stage])[-size:]
+            for key, stage in keys.items()
+        }, None)
+
+
+def get_cached_stats(stages):
+    """Return the statistics stored by the ``CacheCollector``, by stage."""
+    # Include the samples of this process.
+    CacheCollector.flush()
+    values = cache.get_many([TIMINGS_KEY % stage for stage in stages])
+    return {stage: summarize(values[TIMINGS_KEY % stage])
+            for stage in stages if TIMINGS_KEY % stage in values}
+
+
+def get_collectors():
+    return [
+        import_string(path)() for path in
+        getattr(settings, "HYPERKITTY_METRICS_COLLECTORS", [])
+    ]
+
+
+class Timer:
+    """
+    Measure the wall time and the number of database queries of the stages
+    of a process, and send them to the collectors.
+
+    :param collectors: the collectors to use, defaults to the ones listed in
+        the ``HYPERKITTY_METRICS_COLLECTORS`` setting.
+    """
+
+    def __init__(self, collectors=None):
+        if collectors is None:
+            collectors = get_collectors()
+        self.collectors = collectors
+
+    @contextmanager
+    def stage(self, name):
+        if not self.collectors:
+            yield
+            return
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        start = time.perf_counter()
+        with connection.execute_wrapper(count_queries):
+            yield
+        duration = time.perf_counter() - start
+        for collector in self.collectors:
+            collector.record(name, duration, queries)
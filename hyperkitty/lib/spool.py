@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Durable on-disk spool for the archiving API.
+
+When the ``HYPERKITTY_ARCHIVE_SPOOL_DIR`` setting is set, the archiving API
+only writes the incoming messages to this directory, and the
+``hyperkitty_drain_spool`` command stores them in the database later on. The
+spool contains one sub-directory per mailing-list, and the message files are
+named after their arrival time so that they are archived in order.
+"""
+
+import datetime
+import logging
+import os
+import time
+import uuid
+from email import message_from_bytes
+from email.message import EmailMessage
+from email.policy import default
+
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections
+
+from flufl.lock import Lock, TimeOutError
+
+from hyperkitty.lib.incoming import DuplicateMessage, add_many_to_list
+
+
+logger = logging.getLogger(__name__)
+
+
+SPOOL_SUFFIX = ".msg"
+FAILED_DIR = "failed"
+# The lock is refreshed after each batch, it must outlive the archiving of a
+# batch of messages.
+LOCK_LIFETIME = datetime.timedelta(minutes=5)
+# Don't wait for another process, but leave enough time to break a lock that
+# has expired.
+LOCK_TIMEOUT = datetime.timedelta(seconds=1)
+
+
+def get_spool_dir():
+    return getattr(settings, "HYPERKITTY_ARCHIVE_SPOOL_DIR", None)
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def spool_message(list_name, data):
+    """
+    Store a raw message in the spool directory.
+
+    The data is flushed to the disk before this function returns, so the
+    message will not be lost if the server crashes afterwards.
+
+    :returns: the path to the spooled file.
+    """
+    if ("@" not in list_name or "/" in list_name or "\\" in list_name
+            or "\0" in list_name):
+        raise ValueError("Invalid list name: %r" % list_name)
+    list_dir = os.path.join(get_spool_dir(), list_name)
+    if not os.path.exists(list_dir):
+        os.makedirs(list_dir, exist_ok=True)
+    filename = "%020d-%s%s" % (time.time_ns(), uuid.uuid4().hex, SPOOL_SUFFIX)
+    # Write to a temporary file first, so that the worker never sees a partial
+    # message.
+    tmp_path = os.path.join(list_dir, ".%s.tmp" % filename)
+    path = os.path.join(list_dir, filename)
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    _fsync_dir(list_dir)
+    return path
+
+
+def _move_to_failed(spool_dir, list_name, path):
+    failed_dir = os.path.join(spool_dir, FAILED_DIR, list_name)
+    if not os.path.exists(failed_dir):
+        os.makedirs(failed_dir, exist_ok=True)
+    os.rename(path, os.path.join(failed_dir, os.path.basename(path)))
+
+
+def drain_spool(batch_size=100):
+    """
+    Archive the messages waiting in the spool directory.
+
+    The messages are stored in batches of ``batch_size`` messages per
+    transaction. Messages that can't be archived are moved to the ``failed``
+    sub-directory. If the database is unavailable, the messages stay in the
+    spool and will be processed on the next run.
+
+    :returns: the number of messages that were removed from the spool.
+    """
+    spool_dir = get_spool_dir()
+    if not spool_dir or not os.path.isdir(spool_dir):
+        return 0
+    lock = Lock(os.path.join(spool_dir, ".lock"), lifetime=LOCK_LIFETIME)
+    try:
+        lock.lock(timeout=LOCK_TIMEOUT)
+    except TimeOutError:
+        logger.debug("The archive spool is being drained by another process")
+        return 0
+    count = 0
+    try:
+        for list_name in sorted(os.listdir(spool_dir)):
+            list_dir = os.path.join(spool_dir, list_name)
+            if list_name == FAILED_DIR or not os.path.isdir(list_dir):
+                continue
+            filenames = sorted(
+                f for f in os.listdir(list_dir) if f.endswith(SPOOL_SUFFIX))
+            while filenames:
+                batch = [os.path.join(list_dir, f)
+                         for f in filenames[:batch_size]]
+                filenames = filenames[batch_size:]
+                try:
+                    count += _drain_batch(spool_dir, list_name, batch)
+                except DatabaseError as e:
+                    # Keep the messages in the spool and try again later.
+                    logger.error(
+                        "Could not archive the spooled emails: %s", e)
+                    # Don't keep a broken connection for the next run.
+                    close_old_connections()
+                    return count
+                lock.refresh()
+    finally:
+        lock.unlock(unconditionally=True)
+    return count
+
+
+def _drain_batch(spool_dir, list_name, paths):
+    messages = []
+    message_paths = []
+    for path in paths:
+        try:
+            with open(path, "rb") as f:
+                messages.append(message_from_bytes(
+                    f.read(), _class=EmailMessage, policy=default))
+        except Exception:
+            logger.exception("Could not read the spooled email %s", path)
+            _move_to_failed(spool_dir, list_name, path)
+            continue
+        message_paths.append(path)
+    if not messages:
+        return len(paths)
+    results = add_many_to_list(list_name, messages)
+    for path, message, result in zip(message_paths, messages, results):
+        if (isinstance(result, Exception)
+                and not isinstance(result, DuplicateMessage)):
+            logger.warning(
+                "Could not archive the spooled email with message-id "
+                "'%s': %s", message.get("Message-Id", None), result)
+            _move_to_failed(spool_dir, list_name, path)
+        else:
+            os.remove(path)
+    return len(paths)
@@ -22,15 +22,19 @@
 
 import email.utils
 import logging
+import math
 import os
 import os.path
 import re
+import threading
+import time
 from base64 import b32encode
+from collections import OrderedDict
 from contextlib import contextmanager
 from datetime import timedelta
 from email.parser import BytesHeaderParser, HeaderParser
 from email.policy import default
-from hashlib import sha1
+from hashlib import blake2b, sha1
 from tempfile import gettempdir
 
 from django.conf import settings
@@ -194,3 +198,87 @@ def pgsql_disable_indexscan():
             yield
         finally:
             cursor.execute("SET enable_indexscan = ON")
+
+
+class LRUCache(object):
+    """
+    A bounded in-process mapping that evicts the least recently used entries.
+
+    Entries can also expire after ``timeout`` seconds. This is only meant to
+    avoid repeating cheap but frequent database lookups in the same process,
+    it is not shared between processes.
+    """
+
+    def __init__(self, maxsize=128, timeout=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                return default
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = None
+        if self.timeout is not None:
+            expires = time.monotonic() + self.timeout
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class BloomFilter(object):
+    """
+    A compact set of strings that can have false positives.
+
+    When a string is not in the filter, it has never been added. When it is
+    in the filter, it has probably been added: the probability of a false
+    positive is ``error_rate`` when the filter holds ``capacity`` strings.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1)
+        self.size = max(8, int(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _get_positions(self, value):
+        digest = blake2b(
+            value.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+        # Double hashing, with an odd step to visit different positions.
+        first = int.from_bytes(digest[:8], "little")
+        step = int.from_bytes(digest[8:], "little") | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, value):
+        for position in self._get_positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7))
+                   for position in self._get_positions(value))
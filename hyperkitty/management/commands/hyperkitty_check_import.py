@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+
+"""
+Check the mbox files to import for the messages that can't be imported.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hyperkitty.lib.incoming import DuplicateMessage
+from hyperkitty.lib.mbox import open_mailbox
+from hyperkitty.management.commands.hyperkitty_import import (
+    DbImporter, ProgressMarker, expand_mboxes)
+from hyperkitty.management.utils import setup_logging
+
+
+class Command(BaseCommand):
+    help = ("Check mbox files for the messages that hyperkitty_import would "
+            "skip, without importing anything. The messages are parsed "
+            "like hyperkitty_import does.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'mbox', nargs='+',
+            help="mbox files, which can be compressed with gzip, bzip2 or xz "
+                 "(.gz, .bz2 or .xz), or Maildir folders. A quoted pattern "
+                 "like 'archives/*.txt.gz' checks the matching files.")
+        parser.add_argument(
+            '-j', '--jobs',
+            type=int, default=1,
+            help="number of processes parsing the emails "
+                 "(default: %(default)s)")
+        parser.add_argument(
+            '--report',
+            help="write the messages that can't be imported to this file, "
+                 "in JSON")
+
+    def handle(self, *args, **options):
+        setup_logging(self, options["verbosity"])
+        if options["jobs"] < 1:
+            raise CommandError("The number of jobs must be a positive number.")
+        mboxes = expand_mboxes(options["mbox"])
+        checker = DbImporter(
+            None, {"verbosity": options["verbosity"], "jobs": options["jobs"]},
+            self.stdout, self.stderr)
+        checker.failures = []
+        checker.progress_marker = ProgressMarker(False, self.stdout)
+        # Like hyperkitty_import, skip the duplicates in all the mboxes.
+        message_ids = set()
+        results = []
+        for mbfile in mboxes:
+            if len(mboxes) > 1:
+                report_name = ' from mbox {}'.format(mbfile)
+            else:
+                report_name = ''
+            if options["verbosity"] >= 1:
+                self.stdout.write("Checking mbox file %s" % mbfile)
+            results.append(
+                self._check(checker, mbfile, report_name, message_ids))
+        report = {
+            "messages": sum(result["messages"] for result in results),
+            "failures": sum(len(result["failures"]) for result in results),
+            "mboxes": results,
+        }
+        if options["report"]:
+            with open(options["report"], "w") as report_file:
+                json.dump(report, report_file, indent=2)
+        if options["verbosity"] >= 1:
+            self.stdout.write(
+                "Checked %d messages, %d can't be imported."
+                % (report["messages"], report["failures"]))
+
+    def _check(self, checker, mbfile, report_name, message_ids):
+        """
+        Parse the messages of a mbox file.
+
+        :returns: a dict with the number of messages and the failures. The
+            offset of a failure is the end of the previous message in the
+            file, where ``hyperkitty_import`` would look for it.
+        """
+        count = 0
+        failures = []
+        previous_end = 0
+        with open_mailbox(mbfile) as mbox:
+            for end, message_id, parsed in checker.parse_all(
+                    mbox, report_name):
+                count += 1
+                if parsed is not None:
+                    if parsed.message_id in message_ids:
+                        checker._report_failure(
+                            message_id, report_name,
+                            DuplicateMessage(parsed.message_id))
+                    message_ids.add(parsed.message_id)
+                failures.extend(
+                    {"offset": previous_end, "end": end,
+                     "message_id": failed_id, "error": error}
+                    for failed_id, error in checker.failures)
+                del checker.failures[:]
+                previous_end = end
+        return {"path": mbfile, "messages": count, "failures": failures}
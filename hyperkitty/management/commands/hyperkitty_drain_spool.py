@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301,
+# USA.
+
+
+"""
+Archive the messages waiting in the archiving API spool directory.
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from hyperkitty.lib.spool import drain_spool, get_spool_dir
+from hyperkitty.management.utils import setup_logging
+
+
+class Command(BaseCommand):
+    help = ("Archive the messages stored in the HYPERKITTY_ARCHIVE_SPOOL_DIR "
+            "directory by the archiving API.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help="number of messages archived in each transaction "
+                 "(default: 100)")
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help="drain the spool and exit, instead of watching it")
+        parser.add_argument(
+            '--interval', type=float, default=2,
+            help="number of seconds to wait between two checks of the spool "
+                 "directory (default: 2)")
+
+    def handle(self, *args, **options):
+        setup_logging(self, options["verbosity"])
+        if not get_spool_dir():
+            raise CommandError(
+                "The HYPERKITTY_ARCHIVE_SPOOL_DIR setting is not set.")
+        while True:
+            # Like a request would, don't reuse a connection that was broken
+            # or that has reached its maximum age.
+            close_old_connections()
+            count = drain_spool(batch_size=options["batch_size"])
+            if count and options["verbosity"] >= 2:
+                self.stdout.write("Archived %d spooled messages" % count)
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
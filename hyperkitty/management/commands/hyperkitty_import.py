@@ -23,37 +23,67 @@
 Import the content of a mbox file into the database.
 """
 
-import mailbox
+import cProfile
+import glob
+import json
+import multiprocessing
 import os
 import re
-from contextlib import suppress
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, suppress
 from datetime import datetime
-from email import message_from_bytes, policy
+from email.message import Message
 from email.utils import make_msgid, unquote
+from io import StringIO
 from math import floor
 from traceback import print_exc
 
+from django.apps import apps
 from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, caches
+from django.core.cache.backends.locmem import LocMemCache
 from django.core.management import call_command
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import (
+    BaseCommand, CommandError, OutputWrapper)
+from django.db import DEFAULT_DB_ALIAS
 from django.db import Error as DatabaseError
-from django.db import transaction
+from django.db import connection, connections, transaction
+from django.db.models import prefetch_related_objects
+from django.db.utils import ConnectionHandler
 from django.utils.formats import date_format
 from django.utils.timezone import utc
 
 from dateutil import tz
 from dateutil.parser import parse as parse_date
+from haystack import DEFAULT_ALIAS
+from haystack import connections as haystack_connections
 
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from hyperkitty.lib.incoming import DuplicateMessage, add_to_list
+from hyperkitty.lib.analysis import (
+    compute_thread_order_and_depth, get_thread_positions)
+from hyperkitty.lib.incoming import (
+    STAGES, DuplicateMessage, clear_lookup_caches, get_mailinglist,
+    parse_message, store_email)
 from hyperkitty.lib.mailman import sync_with_mailman
-from hyperkitty.lib.utils import get_message_id
+from hyperkitty.lib.mbox import (
+    MboxReader, get_mtime, is_maildir, open_mailbox, parse_mbox_message)
+from hyperkitty.lib.metrics import MemoryCollector, Timer, get_collectors
+from hyperkitty.lib.utils import BloomFilter
 from hyperkitty.management.utils import setup_logging
-from hyperkitty.models import Email, MailingList, Thread
+from hyperkitty.models import (
+    Attachment, Email, MailingList, PendingReply, Sender, Thread)
+from hyperkitty.models.thread import update_counters
 
 
 # Allow all wierd line endings.
 TEXTWRAP_RE = re.compile(r"(\n|\r|\r\n|\n\r)\s*")
+MONTHS = ("January", "February", "March", "April", "May", "June", "July",
+          "August", "September", "October", "November", "December")
+PIPERMAIL_NAME_RE = re.compile(r"(\d{4})-(%s)\." % "|".join(MONTHS))
+# The stages of the import, including the archiving stages.
+IMPORT_STAGES = ("read", "parse", "prepare") + STAGES + (
+    "index", "thread_structure")
 
 
 class ProgressMarker(object):
@@ -63,18 +93,19 @@ class ProgressMarker(object):
         self.total = None
         self.count = 0
         self.count_imported = 0
+        self.count_duplicates = 0
         self.spinner_seq = ('|', '/', '-', '\\')
         self.stdout = stdout
 
-    def tick(self, msgid=None):
-        if self.total:
-            msg = "%d%%" % floor(100.0 * self.count / self.total)
+    def tick(self, msgid=None, position=None):
+        # The total and the position are in bytes.
+        if self.total and position is not None:
+            msg = "%d%%" % floor(100.0 * position / self.total)
         else:
             msg = self.spinner_seq[self.count % len(self.spinner_seq)]
         if self.verbose:
-            if self.total:
-                self.stdout.write(
-                    "%s (%d/%d, %s)" % (msgid, self.count, self.total, msg))
+            if self.total and position is not None:
+                self.stdout.write("%s (%d, %s)" % (msgid, self.count, msg))
             else:
                 self.stdout.write("%s (%d)" % (msgid, self.count))
         else:
@@ -87,23 +118,182 @@ class ProgressMarker(object):
             self.stdout.write('  %s emails read' % self.count)
             self.stdout.write('  %s email added to the database'
                               % self.count_imported)
+            self.stdout.write('  %s email already archived'
+                              % self.count_duplicates)
         else:
             self.stdout.write("\r", ending='')
             self.stdout.flush()
 
 
+def _get_archive_date(path):
+    """
+    Return the date of a monthly archive, from its name if it is a Pipermail
+    archive like ``2015-February.txt.gz``, otherwise from its mtime.
+    """
+    match = PIPERMAIL_NAME_RE.match(os.path.basename(path))
+    if match is not None:
+        date = datetime(int(match.group(1)),
+                        MONTHS.index(match.group(2)) + 1, 1)
+    else:
+        date = datetime.fromtimestamp(os.path.getmtime(path))
+    return date, path
+
+
+@contextmanager
+def dry_run():
+    """
+    Replace the default database and cache with empty in-memory ones and
+    stop updating the search index, so that an import changes nothing.
+    """
+    databases = ConnectionHandler({DEFAULT_DB_ALIAS: {
+        "ENGINE": "django.db.backends.sqlite3", "NAME": ":memory:"}})
+    original_connection = connections[DEFAULT_DB_ALIAS]
+    original_cache = caches[DEFAULT_CACHE_ALIAS]
+    signal_processor = apps.get_app_config("haystack").signal_processor
+    connections[DEFAULT_DB_ALIAS] = databases[DEFAULT_DB_ALIAS]
+    caches[DEFAULT_CACHE_ALIAS] = LocMemCache("hyperkitty-dry-run", {})
+    # The cached rows are in the other database.
+    clear_lookup_caches()
+    signal_processor.teardown()
+    try:
+        call_command("migrate", verbosity=0, interactive=False)
+        yield
+    finally:
+        signal_processor.setup()
+        clear_lookup_caches()
+        connections[DEFAULT_DB_ALIAS].close()
+        connections[DEFAULT_DB_ALIAS] = original_connection
+        caches[DEFAULT_CACHE_ALIAS] = original_cache
+
+
+def expand_mboxes(paths):
+    """
+    Return the mboxes to import, with the patterns replaced by the matching
+    files in date order.
+    """
+    mboxes = []
+    for mbfile in paths:
+        if os.path.exists(mbfile):
+            mboxes.append(mbfile)
+            continue
+        # Monthly archives can be given with a pattern.
+        matches = glob.glob(mbfile)
+        if not matches:
+            raise CommandError("No such file: %s" % mbfile)
+        mboxes.extend(sorted(matches, key=_get_archive_date))
+    for mbfile in mboxes:
+        if os.path.isdir(mbfile) and not is_maildir(mbfile):
+            raise CommandError("Not a Maildir folder: %s" % mbfile)
+    return mboxes
+
+
+def _get_raw_message_id(message):
+    # Don't parse the header, it may be invalid.
+    return next((value for name, value in message.raw_items()
+                 if name.lower() == "message-id"), None)
+
+
+class Checkpoint(object):
+    """
+    The progress of an import, saved in a JSON file to be able to resume it.
+
+    For each mbox file, the checkpoint records the offset in the file after
+    the last email that was stored in the database, and its Message-ID. The
+    offset is in the decompressed data of compressed files, and is a number
+    of messages for Maildir folders.
+    It also records the threads whose structure must still be computed.
+    """
+
+    def __init__(self, path, list_address):
+        self.path = path
+        self.list_address = list_address
+        # Path of the mbox file -> {"offset", "message_id", "done"}
+        self.mboxes = {}
+        self.thread_ids = set()
+
+    def load(self):
+        try:
+            with open(self.path) as checkpoint_file:
+                data = json.load(checkpoint_file)
+        except (OSError, ValueError) as e:
+            raise CommandError(
+                "Can't read the checkpoint file {}: {}".format(self.path, e))
+        if data.get("list_address") != self.list_address:
+            raise CommandError(
+                "The checkpoint file {} is for the list {}.".format(
+                    self.path, data.get("list_address")))
+        self.mboxes = data["mboxes"]
+        self.thread_ids = set(data["thread_ids"])
+
+    def save(self):
+        data = {
+            "list_address": self.list_address,
+            "mboxes": self.mboxes,
+            "thread_ids": sorted(self.thread_ids),
+        }
+        # Don't leave a truncated file if the import is interrupted now.
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, "w") as checkpoint_file:
+            json.dump(data, checkpoint_file)
+        os.replace(tmp_path, self.path)
+
+    def delete(self):
+        with suppress(FileNotFoundError):
+            os.remove(self.path)
+
+    def get_mbox(self, mbfile):
+        return self.mboxes.get(os.path.abspath(mbfile))
+
+    def set_mbox(self, mbfile, offset, message_id, done=False):
+        self.mboxes[os.path.abspath(mbfile)] = {
+            "offset": offset, "message_id": message_id, "done": done,
+        }
+
+
 class DbImporter(object):
     """
     Import email messages into the HyperKitty database using its API.
     """
 
-    def __init__(self, list_address, options, stdout, stderr):
+    def __init__(self, list_address, options, stdout, stderr,
+                 checkpoint=None):
         self.list_address = list_address
+        self.verbosity = options["verbosity"]
         self.verbose = options["verbosity"] >= 2
         self.since = options.get("since")
         self.impacted_thread_ids = set()
+        # Thread id -> (date, id, parent_id) of the emails imported in the
+        # thread, and the threads that also contain other emails.
+        self.thread_graph = defaultdict(list)
+        self.graph_email_ids = set()
+        self.partial_thread_ids = set()
         self.stdout = stdout
         self.stderr = stderr
+        self.jobs = options.get("jobs") or 1
+        self.batch_size = options.get("batch_size") or 1000
+        # The number and the size of the messages read from the mboxes.
+        self.count_read = 0
+        self.bytes_read = 0
+        # When it is a list, the (Message-ID, error) of the emails that could
+        # not be imported are added to it.
+        self.failures = None
+        self.mlist = None
+        # The Message-IDs of the archived emails, and the senders by address,
+        # see _preload().
+        self.message_ids = None
+        self.exact_message_ids = True
+        self.senders = None
+        self.checkpoint = checkpoint
+        self.resume = options.get("resume", False)
+        # The emails to add to the search index, and the Message-IDs of the
+        # emails that may not have been added by the interrupted import.
+        self.index = options.get("index", False)
+        self.to_index = []
+        self.to_index_message_ids = []
+        if checkpoint is not None:
+            self.impacted_thread_ids.update(checkpoint.thread_ids)
+        self.timings = MemoryCollector()
+        self.timer = Timer(get_collectors() + [self.timings])
 
     def _is_too_old(self, message, report_name):
         if not self.since:
@@ -165,124 +355,765 @@ class DbImporter(object):
         mid = mid.encode('ascii', 'ignore').decode('ascii')
         return mid
 
+    def _prepare_message(self, message, report_name):
+        """
+        Fix up a message read from a mbox file before it is archived.
+
+        :returns: the ``email.message.EmailMessage`` instance, or ``None`` if
+            the message must not be imported.
+        """
+        # We need to fix up Message-IDs here because recent Python email
+        # throws an IndexError exception on getting a Message-ID of <>. Use
+        # the raw value of the header, which is not parsed.
+        mid = _get_raw_message_id(message)
+        if mid is None:
+            message['Message-ID'] = make_msgid('generated')
+        elif mid.strip() in ('', '<>'):
+            message.replace_header('Message-ID', make_msgid('generated'))
+        elif mid != self._fix_mid(mid):
+            message.replace_header('Message-ID', self._fix_mid(mid))
+        # The parser sets the From line as the unixfrom, remove the "From "
+        # part like mailbox.mboxMessage.get_from() does.
+        unixfrom = message.get_unixfrom()
+        if unixfrom:
+            unixfrom = unixfrom[5:]
+        # Fix missing and wierd Date: headers.
+        date = (self._get_date(message, "date", report_name) or
+                self._get_date(message, "resent-date", report_name))
+        if unixfrom and not date:
+            date = " ".join(unixfrom.split()[1:])
+
+        if date:
+            # Make sure this date can be parsed before setting it as as the
+            # header. If not, a TypeError is raised and we just keep the
+            # old Header.
+            with suppress(TypeError):
+                del message['Date']
+                message['Date'] = date
+
+        if self._is_too_old(message, report_name):
+            return None
+        # Un-wrap the subject line if necessary
+        if message["subject"]:
+            # If we can't replace the header because it contains some
+            # unicode Next Line or similar. Just keep the original.
+            with suppress(ValueError):
+                message.replace_header(
+                    "subject", TEXTWRAP_RE.sub(" ", message["subject"]))
+        message.set_unixfrom(unixfrom or None)
+        return message
+
+    def parse(self, data, report_name):
+        """
+        Parse a message read from a mbox file.
+
+        :arg data: the message in the mbox file, including its ``From``
+            line, as a bytes-like object.
+        :returns: a tuple with the value of the message's Message-ID header
+            and the ``ParsedEmail`` instance. The Message-ID is ``None`` if
+            the message must not be imported, and the ``ParsedEmail`` is
+            ``None`` if it could not be parsed.
+        """
+        with self.timer.stage("parse"):
+            message = parse_mbox_message(data)
+        try:
+            with self.timer.stage("prepare"):
+                message = self._prepare_message(message, report_name)
+        except (UnicodeError, IndexError) as e:
+            self._record_failure(_get_raw_message_id(message), e)
+            self.stderr.write('Failed to convert {}{} to '
+                              'email.message.Message\n    {}'.format(
+                               unquote(_get_raw_message_id(message) or 'n/a'),
+                               report_name, e))
+            return None, None
+        if message is None:
+            return None, None
+        message_id = message.get("Message-ID")
+        try:
+            parsed = parse_message(message, self.timer)
+        except Exception as e:
+            # Don't reraise the exception
+            self._report_failure(message_id, report_name, e)
+            return message_id, None
+        return message_id, parsed
+
+    def parse_all(self, mbox, report_name, offset=0):
+        """
+        Parse the messages of a mbox file, in worker processes if there are
+        several jobs.
+
+        :arg mbox: a reader returned by ``open_mailbox()``.
+        :arg offset: the offset in the file where the messages start.
+        :returns: an iterator over (end offset, Message-ID, ParsedEmail)
+            tuples, in the order of the mbox file.
+        """
+        mapped = isinstance(mbox, MboxReader)
+        if self.jobs <= 1:
+            if not mapped:
+                for end, data in self._timed(mbox.read(offset), "read"):
+                    self._count_read(len(data))
+                    yield (end,) + self.parse(data, report_name)
+                return
+            for start, end in self._timed(mbox.messages(offset), "read"):
+                self._count_read(end - start)
+                with mbox.view(start, end) as data:
+                    result = self.parse(data, report_name)
+                yield (end,) + result
+            return
+        # The messages are parsed in forked processes, which must not share
+        # the database connections.
+        connections.close_all()
+        # Don't read the mbox file faster than the emails are stored.
+        pending = threading.BoundedSemaphore(self.jobs * POOL_CHUNK_SIZE * 4)
+        # Set when the results are no longer consumed. read() runs in a thread
+        # of the pool, which must not stay blocked on the semaphore, or the
+        # pool could not be terminated.
+        aborted = threading.Event()
+
+        def wait_for_slot():
+            while not pending.acquire(timeout=0.1):
+                if aborted.is_set():
+                    return False
+            return True
+
+        def read():
+            if not mapped:
+                # The workers can't seek in the source, send the messages.
+                for end, data in mbox.read(offset):
+                    if not wait_for_slot():
+                        return
+                    self._count_read(len(data))
+                    yield data, None, None, end, report_name
+                return
+            # Only send the position of the messages, the workers read them
+            # from the file.
+            for start, end in mbox.messages(offset):
+                if not wait_for_slot():
+                    return
+                self._count_read(end - start)
+                yield None, mbox.path, start, end, report_name
+
+        worker_options = {"verbosity": self.verbosity, "since": self.since}
+        context = multiprocessing.get_context("fork")
+        with context.Pool(self.jobs, _init_worker,
+                          (self.list_address, worker_options)) as pool:
+            try:
+                for (end, message_id, parsed, output, errors, samples,
+                     failures) in pool.imap(
+                        _parse_in_worker, read(), POOL_CHUNK_SIZE):
+                    pending.release()
+                    if self.failures is not None:
+                        self.failures.extend(failures)
+                    if output:
+                        self.stdout.write(output, ending="")
+                    if errors:
+                        self.stderr.write(errors, ending="")
+                    for stage, stage_samples in samples.items():
+                        for duration, queries in stage_samples:
+                            for collector in self.timer.collectors:
+                                collector.record(stage, duration, queries)
+                    yield end, message_id, parsed
+            finally:
+                # Stopped early, or done.
+                aborted.set()
+
+    def _timed(self, iterator, stage):
+        """Measure the time spent getting each item of an iterator."""
+        iterator = iter(iterator)
+        while True:
+            with self.timer.stage(stage):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def _count_read(self, size):
+        self.count_read += 1
+        self.bytes_read += size
+
     def from_mbox(self, mbfile, report_name):
         """
         Insert all the emails contained in an mbox file into the database.
 
-        :arg mbfile: a mailbox file
+        :arg mbfile: a mbox file, a mbox file compressed with gzip, bzip2 or
+            xz, or a Maildir folder
         """
-        mbox = mailbox.mbox(mbfile)
-        progress_marker = ProgressMarker(self.verbose, self.stdout)
-        if not self.since:
-            progress_marker.total = len(mbox)
-        for msg in mbox:
-            # FIXME: this converts mailbox.mboxMessage to
-            # email.message.EmailMessage
-            # We need to fix up Message-IDs here because recent Python email
-            # throws an IndexError exception on getting a Message-ID of <>.
-            if msg['message-id'] is None:
-                msg['Message-ID'] = make_msgid('generated')
-            mid = str(msg['message-id'])
-            if mid.strip() in ('', '<>'):
-                msg.replace_header('Message-ID', make_msgid('generated'))
-            elif mid != self._fix_mid(mid):
-                msg.replace_header('Message-ID', self._fix_mid(mid))
-            try:
-                msg_raw = msg.as_bytes(unixfrom=False)
-            except UnicodeError as e:
-                self.stderr.write('Failed to convert {}{} to bytes\n'
-                                  '    {}'.format(
-                                   unquote(msg.get("Message-Id", 'n/a')),
-                                   report_name, e))
-                continue
-            unixfrom = msg.get_from()
-            try:
-                message = message_from_bytes(msg_raw, policy=policy.default)
-            except (UnicodeError, IndexError) as e:
-                self.stderr.write('Failed to convert {}{} to '
-                                  'email.message.Message\n    {}'.format(
-                                   unquote(msg.get("Message-Id", 'n/a')),
-                                   report_name, e))
-                continue
-            # Fix missing and wierd Date: headers.
-            date = (self._get_date(message, "date", report_name) or
-                    self._get_date(message, "resent-date", report_name))
-            if unixfrom and not date:
-                date = " ".join(unixfrom.split()[1:])
-
-            if date:
-                # Make sure this date can be parsed before setting it as as the
-                # header. If not, a TypeError is raised and we just keep the
-                # old Header.
-                with suppress(TypeError):
-                    del message['Date']
-                    message['Date'] = date
-
-            if self._is_too_old(message, report_name):
-                continue
-            progress_marker.tick(unquote(message.get("message-id", 'n/a')))
-            # Un-wrap the subject line if necessary
-            if message["subject"]:
-                # If we can't replace the header because it contains some
-                # unicode Next Line or similar. Just keep the original.
-                with suppress(ValueError):
-                    message.replace_header(
-                        "subject", TEXTWRAP_RE.sub(" ", message["subject"]))
-            if unixfrom:
-                message.set_unixfrom(unixfrom)
-            # Now insert the message
-            try:
-                with transaction.atomic():
-                    add_to_list(self.list_address, message, from_import=True)
-            except DuplicateMessage as e:
-                if self.verbose:
-                    self.stderr.write(
-                        "Duplicate email with message-id '%s'%s"
-                        % (e.args[0], report_name))
+        if self.mlist is None:
+            self.mlist = get_mailinglist(self.list_address)
+            self._preload()
+        with open_mailbox(mbfile) as mbox:
+            offset = 0
+            if self.checkpoint is not None:
+                offset = self._get_resume_offset(mbox)
+                if offset is None:
+                    return
+            self.progress_marker = ProgressMarker(self.verbose, self.stdout)
+            # The position after the last message that was read, and the
+            # Message-ID of the last email that was stored.
+            self.position = offset
+            self.last_message_id = None
+            unsaved = 0
+            self.progress_marker.total = mbox.size
+            for end, message_id, parsed in self.parse_all(
+                    mbox, report_name, offset):
+                if message_id is not None:
+                    self.progress_marker.tick(unquote(message_id), end)
+                if parsed is not None:
+                    # Now insert the message
+                    self.add_parsed(parsed, message_id, report_name)
+                self.position = end
+                unsaved += 1
+                if unsaved >= self.batch_size:
+                    self.flush()
+                    self.update_index()
+                    self._save_checkpoint(mbfile)
+                    unsaved = 0
+        self.flush()
+        self.update_index()
+        self._save_checkpoint(mbfile, done=True)
+        self.progress_marker.finish()
+
+    def _preload(self):
+        """
+        Load the Message-IDs of the emails already archived in the list and
+        the addresses of their senders, to find the duplicates and the known
+        senders without querying the database for each email.
+        """
+        emails = Email.objects.filter(mailinglist=self.mlist)
+        count = emails.count()
+        threshold = getattr(
+            settings, "HYPERKITTY_IMPORT_BLOOM_FILTER_THRESHOLD", 1000000)
+        if count > threshold:
+            # Use less memory, the duplicates must be confirmed in the
+            # database. Leave room for the emails that will be imported.
+            self.message_ids = BloomFilter(count * 2)
+            self.exact_message_ids = False
+        else:
+            self.message_ids = set()
+            self.exact_message_ids = True
+        for message_id in emails.values_list(
+                "message_id", flat=True).iterator(chunk_size=10000):
+            self.message_ids.add(message_id)
+        # The emails only need the primary key of their sender.
+        self.senders = dict(
+            (address, Sender(address=address))
+            for address in emails.values_list(
+                "sender_id", flat=True).distinct().iterator(chunk_size=10000))
+
+    def _is_archived(self, message_id):
+        """Tell if an email has already been archived in the list."""
+        if message_id not in self.message_ids:
+            return False
+        if self.exact_message_ids and not self.resume:
+            return True
+        # Confirm it in the database, and get its thread.
+        thread_id = Email.objects.filter(
+            mailinglist=self.mlist, message_id=message_id
+            ).values_list("thread_id", flat=True).first()
+        if thread_id is None:
+            return False
+        self._add_duplicate(message_id, thread_id)
+        return True
+
+    def _get_resume_offset(self, mbox):
+        """
+        Return the offset where the import of a mbox file must start, or
+        ``None`` if it has already been imported.
+        """
+        mbfile = mbox.path
+        state = self.checkpoint.get_mbox(mbfile)
+        if state is None:
+            return 0
+        if state["done"]:
+            if self.verbosity >= 1:
+                self.stdout.write(
+                    "  %s has already been imported" % mbfile)
+            return None
+        if mbox.size is not None and state["offset"] > mbox.size:
+            raise CommandError(
+                "The mbox file {} is smaller than when the checkpoint was "
+                "saved.".format(mbfile))
+        if state["message_id"] is not None and not Email.objects.filter(
+                mailinglist=self.mlist,
+                message_id=state["message_id"]).exists():
+            raise CommandError(
+                "The email {} of the checkpoint is not in the "
+                "database.".format(state["message_id"]))
+        if self.verbosity >= 1:
+            self.stdout.write(
+                "  resuming after the email {} at offset {}".format(
+                    state["message_id"], state["offset"]))
+        return state["offset"]
+
+    def _save_checkpoint(self, mbfile, done=False):
+        # The emails must have been stored, see flush().
+        if self.checkpoint is None:
+            return
+        self.checkpoint.set_mbox(
+            mbfile, self.position, self.last_message_id, done)
+        self.checkpoint.thread_ids = self.impacted_thread_ids
+        self.checkpoint.save()
+
+    def compute_thread_structure(self):
+        """
+        Compute the thread_order and thread_depth values of the emails in the
+        threads that received emails.
+
+        The threads that only contain emails of this import are computed from
+        the thread graph kept in memory, the others are loaded from the
+        database.
+        """
+        with self.timer.stage("thread_structure"):
+            self._compute_thread_structure()
+
+    def _compute_thread_structure(self):
+        changed = []
+        computed = []
+        for thread_id in sorted(self.impacted_thread_ids):
+            emails = self.thread_graph.get(thread_id)
+            if emails is None or thread_id in self.partial_thread_ids:
                 continue
-            except (LookupError, UnicodeError, ValueError) as e:
-                self.stderr.write("Failed adding message %s%s: %s"
-                                  % (message.get("Message-ID"),
-                                     report_name, e))
-                if len(e.args) == 2:
-                    try:
-                        self.stderr.write(
-                            "%s from %s about %s"
-                            % (e.args[0], e.args[1].get("From"),
-                               e.args[1].get("Subject")))
-                    except UnicodeDecodeError:
-                        pass
-                # Don't reraise the exception
+            emails.sort()
+            starters = [email_id for _date, email_id, parent_id in emails
+                        if parent_id is None]
+            if len(starters) != 1:
                 continue
-            except DatabaseError:
+            positions = get_thread_positions(
+                starters[0],
+                [(email_id, parent_id)
+                 for _date, email_id, parent_id in emails])
+            changed.extend(
+                Email(id=email_id, thread_order=order, thread_depth=depth)
+                for email_id, (order, depth) in positions.items())
+            computed.append(thread_id)
+            if len(changed) >= self.batch_size:
+                self._save_thread_positions(changed, computed)
+                changed, computed = [], []
+        self._save_thread_positions(changed, computed)
+        # Work on batches of thread ids to avoid creating a huge SQL request
+        # (it's an IN statement)
+        thread_ids = sorted(self.impacted_thread_ids)
+        while thread_ids:
+            thread_ids_batch = thread_ids[:100]
+            thread_ids = thread_ids[100:]
+            for thread in Thread.objects.filter(id__in=thread_ids_batch):
+                compute_thread_order_and_depth(thread)
+            self._set_threads_computed(thread_ids_batch)
+
+    def _save_thread_positions(self, emails, thread_ids):
+        with transaction.atomic():
+            Email.objects.bulk_update(
+                emails, ["thread_order", "thread_depth"],
+                batch_size=self.batch_size)
+        self._set_threads_computed(thread_ids)
+
+    def _set_threads_computed(self, thread_ids):
+        self.impacted_thread_ids.difference_update(thread_ids)
+        if self.checkpoint is not None:
+            self.checkpoint.thread_ids = self.impacted_thread_ids
+            self.checkpoint.save()
+
+    def _report_failure(self, message_id, report_name, error):
+        """
+        Report an email that could not be imported.
+
+        :arg message_id: the value of the email's Message-ID header.
+        """
+        self._record_failure(message_id, error)
+        if isinstance(error, DuplicateMessage):
+            self.progress_marker.count_duplicates += 1
+            if self.verbose:
+                self.stderr.write(
+                    "Duplicate email with message-id '%s'%s"
+                    % (error.args[0], report_name))
+        elif isinstance(error, (LookupError, UnicodeError, ValueError)):
+            self.stderr.write("Failed adding message %s%s: %s"
+                              % (message_id, report_name, error))
+            if len(error.args) == 2:
                 try:
-                    print_exc(file=self.stderr)
-                except UnicodeError:
+                    self.stderr.write(
+                        "%s from %s about %s"
+                        % (error.args[0], error.args[1].get("From"),
+                           error.args[1].get("Subject")))
+                except UnicodeDecodeError:
                     pass
-                self.stderr.write(
-                    "Message %s%s failed to import, skipping"
-                    % (unquote(message["Message-Id"]), report_name))
+        elif isinstance(error, DatabaseError):
+            try:
+                print_exc(file=self.stderr)
+            except UnicodeError:
+                pass
+            self.stderr.write(
+                "Message %s%s failed to import, skipping"
+                % (unquote(message_id), report_name))
+        else:
+            # In case of *any* exception, log and continue to import the
+            # rest of the archive.
+            self.stderr.write(
+                "Message {}{} failed to import, skipping\n    {}".format(
+                    unquote(message_id), report_name, error))
+
+    def _record_failure(self, message_id, error):
+        if self.failures is None:
+            return
+        if len(error.args) == 2 and isinstance(error.args[1], Message):
+            # Don't include the message, like in _report_failure().
+            reason = error.args[0]
+        else:
+            reason = error
+        self.failures.append(
+            (message_id, "{}: {}".format(type(error).__name__, reason)))
+
+    def _store_one(self, parsed, message_id, report_name):
+        new_sender = parsed.sender_address not in self.senders
+        try:
+            with transaction.atomic():
+                with self.timer.stage("message_id"):
+                    if self._is_archived(parsed.message_id):
+                        raise DuplicateMessage(parsed.message_id)
+                email = store_email(
+                    self.mlist, parsed, self.timer, self.senders)
+        except Exception as e:
+            if new_sender:
+                # It was rolled back.
+                self.senders.pop(parsed.sender_address, None)
+            # Don't reraise the exception
+            self._report_failure(message_id, report_name, e)
+            return
+        self._add_imported(email)
+
+    def _add_duplicate(self, message_id, thread_id):
+        if self.resume:
+            # The email may have been stored after the last checkpoint of
+            # the interrupted import, its thread must still be computed and
+            # it may not be in the search index.
+            self.impacted_thread_ids.add(thread_id)
+            self.partial_thread_ids.add(thread_id)
+            if self.index:
+                self.to_index_message_ids.append(message_id)
+
+    def _add_imported(self, email):
+        self.message_ids.add(email.message_id)
+        if email.sender_id not in self.senders:
+            self.senders[email.sender_id] = Sender(address=email.sender_id)
+        self.last_message_id = email.message_id
+        # Store the list of impacted threads to be able to compute the
+        # thread_order and thread_depth values
+        self.impacted_thread_ids.add(email.thread_id)
+        self.thread_graph[email.thread_id].append(
+            (email.date, email.id, email.parent_id))
+        self.graph_email_ids.add(email.id)
+        if (email.parent_id is not None
+                and email.parent_id not in self.graph_email_ids):
+            # The thread has emails that were archived before.
+            self.partial_thread_ids.add(email.thread_id)
+        if self.index:
+            self.to_index.append(email)
+        self.progress_marker.count_imported += 1
+
+    def add_parsed(self, parsed, message_id, report_name):
+        """Store a parsed email."""
+        self._store_one(parsed, message_id, report_name)
+
+    def flush(self):
+        """Store the emails that are waiting to be imported."""
+
+    def update_index(self):
+        """
+        Add the emails stored since the last call to the search index.
+
+        The emails are the instances that were just stored, only their
+        attachments and tags are loaded from the database.
+        """
+        emails, self.to_index = self.to_index, []
+        if self.to_index_message_ids:
+            emails.extend(Email.objects.filter(
+                mailinglist=self.mlist,
+                message_id__in=self.to_index_message_ids))
+            self.to_index_message_ids = []
+        if not emails:
+            return
+        # The search index template uses them.
+        prefetch_related_objects(emails, "attachments", "thread__tags")
+        search_connection = haystack_connections[DEFAULT_ALIAS]
+        with self.timer.stage("index"):
+            search_connection.get_backend().update(
+                search_connection.get_unified_index().get_index(Email),
+                emails)
+
+    def report_timings(self):
+        stats = self.timings.get_stats()
+        if not stats:
+            return
+        self.stdout.write("Time spent in each stage (p50 / p95):")
+        for stage in IMPORT_STAGES:
+            if stage not in stats:
                 continue
-            except Exception as e:
-                # In case of *any* exception, log and continue to import the
-                # rest of the archive.
-                self.stderr.write(
-                    "Message {}{} failed to import, skipping\n    {}".format(
-                        unquote(message["Message-ID"]), report_name, e))
+            self.stdout.write(
+                "  {}: {:.1f} / {:.1f} ms, {} / {} queries".format(
+                    stage, stats[stage]["p50"] * 1000,
+                    stats[stage]["p95"] * 1000, stats[stage]["queries_p50"],
+                    stats[stage]["queries_p95"]))
+
+    def report_profile(self, duration):
+        """Print the throughput and the total time of each stage."""
+        megabytes = self.bytes_read / 1024 / 1024
+        self.stdout.write(
+            "Read {} messages ({:.1f} MB) in {:.1f} s: {:.1f} messages/s, "
+            "{:.2f} MB/s".format(
+                self.count_read, megabytes, duration,
+                self.count_read / duration, megabytes / duration))
+        self.stdout.write("Total time spent in each stage:")
+        stats = self.timings.get_stats()
+        for stage in IMPORT_STAGES:
+            if stage not in stats:
                 continue
-            email = Email.objects.get(
-                mailinglist__name=self.list_address,
-                message_id=get_message_id(message))
-            # # Commit every time to be able to rollback on error
-            # if not transaction.get_autocommit():
-            #     transaction.commit()
-            # Store the list of impacted threads to be able to compute the
-            # thread_order and thread_depth values
-            self.impacted_thread_ids.add(email.thread_id)
-            progress_marker.count_imported += 1
-        # self.store.search_index.flush() # Now commit to the search index
-        progress_marker.finish()
-        mbox.close()
+            total = stats[stage]["total"]
+            self.stdout.write("  {}: {:.2f} s ({:.0f}%), {} queries".format(
+                stage, total, 100 * total / duration,
+                stats[stage]["queries_total"]))
+
+
+# Number of messages sent at once to a worker process.
+POOL_CHUNK_SIZE = 16
+
+# The DbImporter used to parse the messages in a worker process, and the
+# mbox files it reads, by path.
+_worker_importer = None
+_worker_mboxes = {}
+
+
+def _init_worker(list_address, options):
+    global _worker_importer
+    _worker_importer = DbImporter(list_address, options, None, None)
+
+
+def _parse_in_worker(args):
+    """
+    Parse a message in a worker process.
+
+    The output, the timings and the failures are sent back to the main
+    process with the results of ``DbImporter.parse()``.
+    """
+    data, path, start, end, report_name = args
+    if data is None and path not in _worker_mboxes:
+        _worker_mboxes[path] = MboxReader(path)
+    importer = _worker_importer
+    output, errors = StringIO(), StringIO()
+    importer.stdout = OutputWrapper(output)
+    importer.stderr = OutputWrapper(errors)
+    importer.timings = MemoryCollector()
+    importer.timer = Timer([importer.timings])
+    importer.failures = []
+    if data is None:
+        with _worker_mboxes[path].view(start, end) as data:
+            message_id, parsed = importer.parse(data, report_name)
+    else:
+        message_id, parsed = importer.parse(data, report_name)
+    return (end, message_id, parsed, output.getvalue(), errors.getvalue(),
+            dict(importer.timings.samples), importer.failures)
+
+
+class BulkDbImporter(DbImporter):
+    """
+    Import email messages into the HyperKitty database in batches.
+
+    The emails are parsed in memory and stored with a few bulk queries per
+    batch, without sending the models' signals. The parents of the emails
+    are found using a map of the Message-IDs imported so far. The result is
+    the same as with the ``DbImporter``.
+    """
+
+    def __init__(self, list_address, options, stdout, stderr,
+                 checkpoint=None):
+        super().__init__(list_address, options, stdout, stderr, checkpoint)
+        # The emails waiting to be stored, as (ParsedEmail, Message-ID header,
+        # report_name) tuples.
+        self.batch = []
+        # Message-ID -> (email id, thread id) for the emails imported so far
+        # and for the parents found in the database.
+        self.known_emails = {}
+
+    def add_parsed(self, parsed, message_id, report_name):
+        self.batch.append((parsed, message_id, report_name))
+
+    def flush(self):
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        try:
+            with self.timer.stage("save"):
+                with transaction.atomic():
+                    emails, duplicates = self._store_batch(batch)
+        except (DatabaseError, LookupError, UnicodeError, ValueError) as e:
+            # Store the emails one by one to skip the ones that fail.
+            self.stderr.write(
+                "Could not store a batch of %d emails, storing them one by "
+                "one: %s" % (len(batch), e))
+            for parsed, message_id, report_name in batch:
+                self._store_one(parsed, message_id, report_name)
+            return
+        for message_id, report_name, error in duplicates:
+            self._report_failure(message_id, report_name, error)
+        for email in emails:
+            self._add_imported(email)
+
+    def _add_imported(self, email):
+        self.known_emails[email.message_id] = (email.id, email.thread_id)
+        super()._add_imported(email)
+
+    def _bulk_create(self, model, objects, key):
+        """
+        Insert the objects and set their primary keys, even on databases that
+        can't return them from a bulk insert.
+        """
+        model.objects.bulk_create(objects, batch_size=self.batch_size)
+        if not objects or connection.features.can_return_rows_from_bulk_insert:
+            return
+        keys = [getattr(obj, key) for obj in objects]
+        ids = dict(model.objects.filter(
+            mailinglist=self.mlist, **{"%s__in" % key: keys}
+            ).values_list(key, "id"))
+        for obj in objects:
+            obj.id = ids[getattr(obj, key)]
+
+    def _store_batch(self, batch):
+        """
+        Store a batch of parsed emails.
+
+        :returns: the list of the ``Email`` instances that were created, and
+            the list of the emails that were already archived, as
+            (Message-ID header, report_name, DuplicateMessage) tuples.
+        """
+        candidates = [parsed.message_id for parsed, _m, _r in batch
+                      if parsed.message_id in self.message_ids]
+        if candidates and self.exact_message_ids and not self.resume:
+            existing = set(candidates)
+        else:
+            # Confirm them in the database, and get their threads.
+            existing = set()
+            for message_id, thread_id in Email.objects.filter(
+                    mailinglist=self.mlist, message_id__in=candidates
+                    ).values_list("message_id", "thread_id"):
+                existing.add(message_id)
+                self._add_duplicate(message_id, thread_id)
+        # Look for the parents archived before this import.
+        missing = set(
+            parsed.in_reply_to for parsed, _m, _r in batch
+            if parsed.in_reply_to is not None
+            and parsed.in_reply_to not in self.known_emails)
+        if missing:
+            self.known_emails.update(
+                (message_id, (email_id, thread_id))
+                for message_id, email_id, thread_id in Email.objects.filter(
+                    mailinglist=self.mlist, message_id__in=missing
+                    ).values_list("message_id", "id", "thread_id"))
+
+        emails = []
+        duplicates = []
+        attachments = {}  # Message-ID -> list of attachments
+        batch_emails = {}  # Message-ID -> Email, in this batch
+        batch_parents = {}  # Message-ID -> parent Email, in this batch
+        threads = {}  # Message-ID -> thread id or new Thread
+        new_threads = []
+        for parsed, message_id, report_name in batch:
+            if (parsed.message_id in existing
+                    or parsed.message_id in batch_emails):
+                duplicates.append((
+                    message_id, report_name,
+                    DuplicateMessage(parsed.message_id)))
+                continue
+            email = Email(
+                mailinglist=self.mlist, message_id=parsed.message_id,
+                in_reply_to=parsed.in_reply_to,
+                sender_name=parsed.sender_name,
+                sender_id=parsed.sender_address, subject=parsed.subject,
+                date=parsed.date, timezone=parsed.timezone,
+                content=parsed.content)
+            if parsed.archived_date is not None:
+                email.archived_date = parsed.archived_date
+            # Like store_email(), only look for the parent in the emails that
+            # were stored before this one.
+            if email.in_reply_to in batch_emails:
+                parent = batch_emails[email.in_reply_to]
+                batch_parents[email.message_id] = parent
+                threads[email.message_id] = threads[parent.message_id]
+            elif email.in_reply_to in self.known_emails:
+                email.parent_id, thread_id = self.known_emails[
+                    email.in_reply_to]
+                threads[email.message_id] = thread_id
+            else:
+                thread = Thread(
+                    mailinglist=self.mlist, thread_id=email.message_id_hash)
+                new_threads.append((thread, email))
+                threads[email.message_id] = thread
+            emails.append(email)
+            batch_emails[email.message_id] = email
+            attachments[email.message_id] = parsed.attachments
+        if not emails:
+            return [], duplicates
+
+        new_senders = [
+            Sender(address=address) for address in
+            set(email.sender_id for email in emails)
+            if address not in self.senders]
+        Sender.objects.bulk_create(
+            new_senders, batch_size=self.batch_size, ignore_conflicts=True)
+        self._bulk_create(
+            Thread, [thread for thread, _email in new_threads], "thread_id")
+        for email in emails:
+            thread = threads[email.message_id]
+            email.thread_id = getattr(thread, "id", thread)
+        self._bulk_create(Email, emails, "message_id")
+        for message_id, parent in batch_parents.items():
+            batch_emails[message_id].parent_id = parent.id
+        Email.objects.bulk_update(
+            [batch_emails[message_id] for message_id in batch_parents],
+            ["parent"], batch_size=self.batch_size)
+
+        # Wait for the parents that have not been archived yet.
+        PendingReply.objects.bulk_create([
+            PendingReply(mailinglist=self.mlist,
+                         in_reply_to=email.in_reply_to, email=email)
+            for email in emails
+            if email.in_reply_to is not None and email.parent_id is None
+            and email.in_reply_to != email.message_id
+            ], batch_size=self.batch_size)
+
+        new_attachments = []
+        for email in emails:
+            counters = set()
+            for counter, name, content_type, encoding, content in (
+                    attachments[email.message_id]):
+                if counter in counters:
+                    continue
+                counters.add(counter)
+                attachment = Attachment(
+                    email=email, counter=counter, name=name,
+                    content_type=content_type, encoding=encoding)
+                attachment.set_content(content)
+                new_attachments.append(attachment)
+        Attachment.objects.bulk_create(
+            new_attachments, batch_size=self.batch_size)
+
+        # Like Thread.on_email_added(): the thread starts with the email that
+        # created it, and is active since the last email added to it.
+        updated_threads = {}
+        for thread, email in new_threads:
+            thread.starting_email = email
+            updated_threads[thread.id] = thread
+        existing_thread_ids = set(
+            email.thread_id for email in emails
+            if email.thread_id not in updated_threads)
+        for thread in Thread.objects.filter(id__in=existing_thread_ids):
+            thread.find_starting_email()
+            updated_threads[thread.id] = thread
+        for email in emails:
+            updated_threads[email.thread_id].date_active = email.date
+        Thread.objects.bulk_update(
+            list(updated_threads.values()), ["starting_email", "date_active"],
+            batch_size=self.batch_size)
+        update_counters(updated_threads)
+        return emails, duplicates
 
 
 class Command(BaseCommand):
@@ -290,11 +1121,16 @@ class Command(BaseCommand):
         "Imports the specified archive mbox(es). "
         "Before running this, the mbox(es) should be checked for "
         "messages that could throw uncaught exceptions with the "
-        "contrib/check_hk_archive script and for unescaped 'From ' lines "
-        "with Mailman 2.1's cleanarch script.")
+        "'manage.py hyperkitty_check_import' command and for unescaped "
+        "'From ' lines with Mailman 2.1's cleanarch script.")
 
     def add_arguments(self, parser):
-        parser.add_argument('mbox', nargs='+')
+        parser.add_argument(
+            'mbox', nargs='+',
+            help="mbox files, which can be compressed with gzip, bzip2 or xz "
+                 "(.gz, .bz2 or .xz), or Maildir folders. A quoted pattern "
+                 "like 'archives/*.txt.gz' imports the matching files in "
+                 "date order.")
         parser.add_argument(
             '--delete',
             action='store_true',
@@ -317,6 +1153,50 @@ class Command(BaseCommand):
             '--ignore-mtime',
             action='store_true', default=False,
             help="do not check mbox mtimes (slower)")
+        parser.add_argument(
+            '-j', '--jobs',
+            type=int, default=1,
+            help="number of processes parsing the emails while they are "
+                 "stored (default: %(default)s)")
+        parser.add_argument(
+            '--bulk',
+            action='store_true', default=False,
+            help="store the emails in batches with bulk queries (much "
+                 "faster for large archives)")
+        parser.add_argument(
+            '--batch-size',
+            type=int, default=1000,
+            help="number of emails stored at once with --bulk, and between "
+                 "two checkpoints (default: %(default)s)")
+        parser.add_argument(
+            '--index',
+            action='store_true', default=False,
+            help="add the emails to the full-text search index as they are "
+                 "stored, instead of updating the index of the whole list "
+                 "afterwards")
+        parser.add_argument(
+            '--dry-run',
+            action='store_true', default=False,
+            help="import into an empty in-memory database, to measure the "
+                 "speed of the import without changing anything")
+        parser.add_argument(
+            '--profile',
+            action='store_true', default=False,
+            help="print the number of messages and bytes imported per "
+                 "second, and the total time spent in each stage")
+        parser.add_argument(
+            '--profile-output',
+            help="save the statistics of the Python profiler to this file, "
+                 "they can be read with the pstats module. Only the main "
+                 "process is profiled.")
+        parser.add_argument(
+            '--checkpoint',
+            help="save the progress of the import to this file, to be able "
+                 "to resume it with --resume if it is interrupted")
+        parser.add_argument(
+            '--resume',
+            action='store_true', default=False,
+            help="resume the import from the file given with --checkpoint")
 
     def _check_options(self, options):
         if not options.get("list_address"):
@@ -328,9 +1208,7 @@ class Command(BaseCommand):
                 "the '@' symbol and the domain name.")
         if not options.get("mbox"):
             raise CommandError("No mbox file selected.")
-        for mbfile in options["mbox"]:
-            if not os.path.exists(mbfile):
-                raise CommandError("No such file: %s" % mbfile)
+        options["mbox"] = expand_mboxes(options["mbox"])
         options["verbosity"] = int(options.get("verbosity", "1"))
         if options["since"]:
             try:
@@ -340,11 +1218,34 @@ class Command(BaseCommand):
                         tzinfo=tz.tzlocal())
             except ValueError as e:
                 raise CommandError("invalid value for '--since': %s" % e)
+        if options.get("batch_size") is not None and options["batch_size"] < 1:
+            raise CommandError("The batch size must be a positive number.")
+        if options.get("jobs") is not None and options["jobs"] < 1:
+            raise CommandError("The number of jobs must be a positive number.")
+        if options.get("resume") and not options.get("checkpoint"):
+            raise CommandError(
+                "The checkpoint file must be given with --checkpoint.")
+        if options.get("dry_run") and (
+                options.get("checkpoint") or options.get("index")):
+            raise CommandError(
+                "The --checkpoint and --index options can't be used with "
+                "--dry-run.")
 
     def handle(self, *args, **options):
         self._check_options(options)
         setup_logging(self, options["verbosity"])
-        # main
+        if not options["dry_run"]:
+            self._import(options)
+            return
+        # There's nothing to synchronize in the in-memory database.
+        options["no_sync_mailman"] = True
+        if options["verbosity"] >= 1:
+            self.stdout.write(
+                "Dry run: importing into an empty in-memory database")
+        with dry_run():
+            self._import(options)
+
+    def _import(self, options):
         list_address = options["list_address"].lower()
         # Keep autocommit on SQLite:
         # https://docs.djangoproject.com/en/1.8/topics/db/transactions/#savepoints-in-sqlite
@@ -361,7 +1262,9 @@ class Command(BaseCommand):
         latest_email_date = Email.objects.filter(
                 mailinglist__name=list_address
             ).values("date").order_by("-date").first()
-        if latest_email_date and not options["since"]:
+        # When resuming, the checkpoint tells where to start.
+        if (latest_email_date and not options["since"]
+                and not options["resume"]):
             options["since"] = latest_email_date["date"]
             self.stdout.write(
                 'Warning: not importing messages older than {}. '
@@ -370,7 +1273,19 @@ class Command(BaseCommand):
         if options["since"] and options["verbosity"] >= 2:
             self.stdout.write(
                 "Only emails after %s will be imported" % options["since"])
-        importer = DbImporter(list_address, options, self.stdout, self.stderr)
+        checkpoint = None
+        if options["checkpoint"]:
+            checkpoint = Checkpoint(options["checkpoint"], list_address)
+            if options["resume"]:
+                checkpoint.load()
+        importer_class = BulkDbImporter if options["bulk"] else DbImporter
+        importer = importer_class(
+            list_address, options, self.stdout, self.stderr, checkpoint)
+        profiler = None
+        if options["profile_output"]:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        start = time.perf_counter()
         # disable mailman client for now
         for mbfile in options["mbox"]:
             if len(options["mbox"]) > 1:
@@ -382,7 +1297,7 @@ class Command(BaseCommand):
                                   % (mbfile, list_address))
             if not options["ignore_mtime"] and options["since"] is not None:
                 mtime = datetime.fromtimestamp(
-                    os.path.getmtime(mbfile), tz.tzlocal())
+                    get_mtime(mbfile), tz.tzlocal())
                 if mtime <= options["since"]:
                     if options["verbosity"] >= 2:
                         self.stdout.write('Mailbox file for %s is too old'
@@ -395,15 +1310,17 @@ class Command(BaseCommand):
                 self.stdout.write('  %s emails are stored into the database'
                                   % total_in_list)
         if options["verbosity"] >= 1:
+            importer.report_timings()
             self.stdout.write("Computing thread structure")
-        # Work on batches of thread ids to avoid creating a huge SQL request
-        # (it's an IN statement)
-        thread_ids = list(importer.impacted_thread_ids)
-        while thread_ids:
-            thread_ids_batch = thread_ids[:100]
-            thread_ids = thread_ids[100:]
-            for thread in Thread.objects.filter(id__in=thread_ids_batch):
-                compute_thread_order_and_depth(thread)
+        importer.compute_thread_structure()
+        duration = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(options["profile_output"])
+        if options["profile"]:
+            importer.report_profile(duration)
+        if options["dry_run"]:
+            return
         if not options["no_sync_mailman"]:
             if options["verbosity"] >= 1:
                 self.stdout.write("Synchronizing properties with Mailman")
@@ -413,7 +1330,7 @@ class Command(BaseCommand):
         if options["verbosity"] >= 1:
             self.stdout.write("Warming up cache")
         call_command("hyperkitty_warm_up_cache", list_address)
-        if options["verbosity"] >= 1:
+        if options["verbosity"] >= 1 and not options["index"]:
             self.stdout.write(
                 "The full-text search index is not updated for this list. "
                 "It will not be updated by the 'minutely' incremental "
@@ -422,3 +1339,6 @@ class Command(BaseCommand):
                 "'update_index_one_list {}'."
                 .format(list_address)
                 )
+        if checkpoint is not None:
+            # The import is complete.
+            checkpoint.delete()
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Recompute the counters stored in the threads.
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+from hyperkitty.management.utils import setup_logging
+from hyperkitty.models import MailingList, Thread
+from hyperkitty.models.thread import update_counters
+
+
+class Command(BaseCommand):
+    help = ("Recompute the number of emails, participants and votes stored "
+            "in the threads, and their last email.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'mlists', nargs='*',
+            help="the lists to repair, all the lists by default")
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help="number of threads to repair with each set of queries "
+                 "(default: %(default)s)")
+
+    def handle(self, *args, **options):
+        setup_logging(self, options["verbosity"])
+        if options["batch_size"] < 1:
+            raise CommandError("The batch size must be a positive number.")
+        threads = Thread.objects.order_by("id")
+        if options["mlists"]:
+            mlists = MailingList.objects.filter(name__in=options["mlists"])
+            missing = set(options["mlists"]) - set(
+                mlists.values_list("name", flat=True))
+            if missing:
+                raise CommandError("No such list: %s" % ", ".join(
+                    sorted(missing)))
+            threads = threads.filter(mailinglist__in=mlists)
+        thread_ids = list(threads.values_list("id", flat=True))
+        batch_size = options["batch_size"]
+        repaired = 0
+        for start in range(0, len(thread_ids), batch_size):
+            repaired += update_counters(
+                thread_ids[start:start + batch_size])
+        if options["verbosity"] >= 1:
+            self.stdout.write("Repaired the counters of %d threads out of %d."
+                              % (repaired, len(thread_ids)))
@@ -0,0 +1,48 @@
+# Generated by Django 4.2.30 on 2026-10-18 04:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_pending_replies(apps, schema_editor):
+    # Emails that start a thread but reply to another email are waiting for
+    # their parent. Use a single INSERT query, it's much faster.
+    schema_editor.execute("""
+        INSERT INTO hyperkitty_pendingreply
+            (mailinglist_id, in_reply_to, email_id)
+        SELECT mailinglist_id, in_reply_to, id FROM hyperkitty_email
+        WHERE parent_id IS NULL AND in_reply_to IS NOT NULL
+        """)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0023_alter_mailinglist_name'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingReply',
+            fields=[
+                ('id', models.AutoField(
+                    auto_created=True, primary_key=True, serialize=False,
+                    verbose_name='ID')),
+                ('in_reply_to', models.CharField(max_length=255)),
+                ('email', models.OneToOneField(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='pending_reply', to='hyperkitty.email')),
+                ('mailinglist', models.ForeignKey(
+                    on_delete=django.db.models.deletion.CASCADE,
+                    related_name='pending_replies',
+                    to='hyperkitty.mailinglist')),
+            ],
+            options={
+                'indexes': [models.Index(
+                    fields=['mailinglist', 'in_reply_to'],
+                    name='hyperkitty__mailing_2e83bd_idx')],
+            },
+        ),
+        migrations.RunPython(
+            populate_pending_replies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:44
+
+from collections import defaultdict
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_counters(apps, schema_editor):
+    Thread = apps.get_model("hyperkitty", "Thread")
+    Email = apps.get_model("hyperkitty", "Email")
+    Vote = apps.get_model("hyperkitty", "Vote")
+    thread_ids = list(Thread.objects.values_list("id", flat=True))
+    # Use a few queries per chunk of threads.
+    for start in range(0, len(thread_ids), 1000):
+        chunk = thread_ids[start:start + 1000]
+        counters = defaultdict(lambda: defaultdict(int))
+        for thread_id, _sender, _name, count in Email.objects.filter(
+                thread_id__in=chunk).values_list(
+                "thread_id", "sender_id", "sender_name").annotate(
+                models.Count("id")).order_by():
+            counters[thread_id]["emails_count"] += count
+            counters[thread_id]["participants_count"] += 1
+        for thread_id, value, count in Vote.objects.filter(
+                email__thread_id__in=chunk, value__in=(1, -1)).values_list(
+                "email__thread_id", "value").annotate(
+                models.Count("id")).order_by():
+            counters[thread_id]["likes" if value == 1 else "dislikes"] = count
+        last_emails = Email.objects.filter(
+            thread_id=models.OuterRef("id")).order_by("-date").values("id")
+        threads = list(Thread.objects.filter(id__in=chunk).annotate(
+            last_email_id_value=models.Subquery(last_emails[:1])))
+        for thread in threads:
+            for name in ("emails_count", "participants_count", "likes",
+                         "dislikes"):
+                setattr(thread, name, counters[thread.id][name])
+            thread.last_email_id = thread.last_email_id_value
+        Thread.objects.bulk_update(threads, [
+            "emails_count", "participants_count", "likes", "dislikes",
+            "last_email"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('hyperkitty', '0024_pendingreply'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='dislikes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='emails_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_email',
+            field=models.ForeignKey(
+                null=True, on_delete=django.db.models.deletion.SET_NULL,
+                related_name='+', to='hyperkitty.email'),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='likes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='participants_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
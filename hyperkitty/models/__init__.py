@@ -23,7 +23,7 @@
 # flake8:noqa
 
 from .category import ThreadCategory
-from .email import Attachment, Email
+from .email import Attachment, Email, PendingReply
 from .favorite import Favorite
 from .mailinglist import ArchivePolicy, MailingList
 from .profile import Profile
@@ -19,39 +19,291 @@
 #
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
+import math
+import random
+import time
+from collections import defaultdict
+
+from django.conf import settings
 from django.core.cache import cache
 
+from hyperkitty.lib.utils import LRUCache
+
+
+class Generations(object):
+    """
+    Counters stored in the Django cache, one per namespace, that are
+    incremented to invalidate the values of the namespace.
+
+    Each process keeps the counters that it has read for ``check_interval``
+    seconds, so the other processes see an incremented counter after this
+    delay at most.
+    """
+
+    def __init__(self, key_format, maxsize, check_interval):
+        self.key_format = key_format
+        self._local = LRUCache(maxsize=maxsize, timeout=check_interval)
+
+    def get(self, namespace):
+        generation = self._local.get(namespace)
+        if generation is None:
+            generation = self.get_many([namespace])[namespace]
+        return generation
+
+    def get_many(self, namespaces):
+        """Read the counters of several namespaces with one cache request."""
+        generations = {}
+        missing = {}
+        for namespace in namespaces:
+            generation = self._local.get(namespace)
+            if generation is None:
+                missing[self.key_format % namespace] = namespace
+            else:
+                generations[namespace] = generation
+        if missing:
+            found = cache.get_many(list(missing))
+            for key, namespace in missing.items():
+                generation = found.get(key)
+                if generation is None:
+                    # Don't restart from the same value if the counter has
+                    # been evicted.
+                    cache.add(key, random.randrange(1 << 30), None)
+                    generation = cache.get(key)
+                self._local.set(namespace, generation)
+                generations[namespace] = generation
+        return generations
+
+    def increment(self, namespace):
+        key = self.key_format % namespace
+        try:
+            generation = cache.incr(key)
+        except ValueError:
+            cache.add(key, random.randrange(1 << 30), None)
+            generation = cache.get(key)
+        self._local.set(namespace, generation)
+        return generation
+
+    def clear(self):
+        """Forget the counters read by this process."""
+        self._local.clear()
+
+
+class LocalCache(object):
+    """
+    A per-process cache in front of the Django cache, for the cached values
+    that are read on most pages.
+
+    Each value has a generation, which is a counter stored in the Django
+    cache and incremented when the value is rebuilt, and the value is stored
+    with its generation. The generations are read from the Django cache at
+    most every ``check_interval`` seconds, so the other processes drop their
+    copies of a rebuilt value after this delay at most. The values of a model
+    instance are all invalidated at once by its ``cache_generation``, which
+    is part of their keys.
+    """
+
+    GENERATION_KEY = "HyperKitty:generation:%s"
+
+    def __init__(self, maxsize, timeout, check_interval):
+        self.values = LRUCache(maxsize=maxsize, timeout=timeout)
+        self.generations = Generations(
+            self.GENERATION_KEY, maxsize, check_interval)
+
+    @property
+    def enabled(self):
+        return self.values.maxsize > 0
+
+    def get_generation(self, key):
+        return self.generations.get(key)
+
+    def invalidate(self, key):
+        """Invalidate a value in all the processes."""
+        return self.generations.increment(key)
+
+    def get(self, key, generation):
+        entry = self.values.get(key)
+        if entry is None or entry[1] != generation:
+            return None
+        return entry[0]
+
+    def set(self, key, value, generation):
+        self.values.set(key, (value, generation))
+
+
+local_cache = LocalCache(
+    maxsize=getattr(settings, "HYPERKITTY_LOCAL_CACHE_SIZE", 0),
+    timeout=getattr(settings, "HYPERKITTY_LOCAL_CACHE_TIMEOUT", 30),
+    check_interval=getattr(
+        settings, "HYPERKITTY_LOCAL_CACHE_CHECK_INTERVAL", 1))
+
+# The generations of the model instances, which are part of the keys of their
+# cached values. Incrementing it invalidates all the cached values of an
+# instance at once, without deleting or rebuilding them.
+cache_generations = Generations(
+    "HyperKitty:cache_generation:%s", maxsize=10000,
+    check_interval=getattr(
+        settings, "HYPERKITTY_LOCAL_CACHE_CHECK_INTERVAL", 1))
+
+
+def get_cache_namespace(instance):
+    return "%s:%s" % (instance.__class__.__name__, instance.pk)
+
+
+class CacheGenerationMixin(object):
+    """
+    Give a model instance a generation that is part of the keys of its cached
+    values and template fragments.
+    """
+
+    @property
+    def cache_generation(self):
+        return cache_generations.get(get_cache_namespace(self))
+
+    def invalidate_cache(self):
+        """Invalidate all the cached values of the instance at once."""
+        cache_generations.increment(get_cache_namespace(self))
+
+
+# Tells the missing values from the values that are None.
+_MISSING = object()
+
 
 class CachedValue(object):
 
     cache_key = None
     timeout = None
+    # Also keep the value in the per-process cache, if it is enabled. The
+    # value is shared by all the callers in the process, they must not
+    # modify it.
+    local = False
 
     def _get_cache_key(self, *args, **kwargs):
         if self.cache_key is not None:
             return self.cache_key
         raise NotImplementedError
 
+    def _use_local_cache(self):
+        return self.local and local_cache.enabled
+
     def get_value(self, *args, **kwargs):
         """Get the value that must be cached."""
         raise NotImplementedError
 
+    @classmethod
+    def get_values(cls, cached_values):
+        """
+        Get the values that must be cached for several instances of this
+        class. Subclasses can override it to use a single query.
+        """
+        return [cached_value.get_value() for cached_value in cached_values]
+
     def warm_up(self, *args, **kwargs):
         """Stores the value in the cache if it is not there already."""
-        if cache.get(self._get_cache_key(*args, **kwargs)) is None:
+        if cache.get(self._get_cache_key(*args, **kwargs),
+                     _MISSING) is _MISSING:
             self.rebuild(*args, **kwargs)
 
     def rebuild(self, *args, **kwargs):
         """Overwrite the value in the cache."""
+        start = time.monotonic()
         value = self.get_value(*args, **kwargs)
-        cache.set(self._get_cache_key(*args, **kwargs), value, self.timeout)
+        self._store(value, time.monotonic() - start, *args, **kwargs)
         return value
 
+    def set(self, value, *args, **kwargs):
+        """Store a value in the cache, and invalidate the other copies."""
+        self._store(value, 0, *args, **kwargs)
+
+    def _store(self, value, duration, *args, **kwargs):
+        cache_key = self._get_cache_key(*args, **kwargs)
+        cache.set(cache_key, self._wrap(value, duration),
+                  self._get_storage_timeout())
+        if self._use_local_cache():
+            generation = local_cache.invalidate(cache_key)
+            local_cache.set(cache_key, value, generation)
+
+    # Values with a timeout are stored with their expiration time and the
+    # time it took to compute them, and kept in the cache for twice as long,
+    # so that a stale value can be served while it is being rebuilt.
+
+    def _wrap(self, value, duration):
+        if self.timeout is None:
+            return value
+        return (value, time.time() + self.timeout, duration)
+
+    def _unwrap(self, entry):
+        if self.timeout is None or entry is _MISSING:
+            return entry
+        return entry[0]
+
+    def _get_storage_timeout(self):
+        if self.timeout is None:
+            return None
+        return 2 * self.timeout
+
+    def _must_refresh(self, entry):
+        if entry is _MISSING:
+            return True
+        if self.timeout is None:
+            return False
+        _value, expires, duration = entry
+        # Probabilistic early expiration (XFetch): each reader refreshes the
+        # value before it expires with a probability that grows as the
+        # expiration time gets closer, and faster if it is long to compute,
+        # so a single reader refreshes it most of the time.
+        beta = getattr(settings, "HYPERKITTY_CACHE_EARLY_REFRESH", 1)
+        return (time.time() - duration * beta * math.log(
+            1 - random.random())) >= expires
+
+    def _get_shared(self, cache_key, *args, **kwargs):
+        """
+        Return the value from Django's cache, rebuilding it if necessary, and
+        whether it was rebuilt.
+        """
+        # Some values are None, tell them apart from the missing ones.
+        entry = cache.get(cache_key, _MISSING)
+        if not self._must_refresh(entry):
+            return self._unwrap(entry), False
+        # Only one process rebuilds the value, the others serve the stale
+        # value if there is one, or wait for the new one.
+        lock_key = "%s:rebuild_lock" % cache_key
+        lock_timeout = getattr(
+            settings, "HYPERKITTY_CACHE_REBUILD_LOCK_TIMEOUT", 30)
+        if cache.add(lock_key, True, lock_timeout):
+            try:
+                return self.rebuild(*args, **kwargs), True
+            finally:
+                cache.delete(lock_key)
+        if entry is not _MISSING:
+            return self._unwrap(entry), False
+        deadline = time.monotonic() + getattr(
+            settings, "HYPERKITTY_CACHE_REBUILD_WAIT", 5)
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            locked = cache.get(lock_key) is not None
+            entry = cache.get(cache_key, _MISSING)
+            if entry is not _MISSING:
+                return self._unwrap(entry), False
+            if not locked:
+                # The lock was released without storing the value.
+                break
+        # The rebuild is too slow or has failed.
+        return self.rebuild(*args, **kwargs), True
+
     def get_or_set(self, *args, **kwargs):
         """Return the cached value, rebuilding the cache if necessary."""
-        value = cache.get(self._get_cache_key(*args, **kwargs))
+        cache_key = self._get_cache_key(*args, **kwargs)
+        if not self._use_local_cache():
+            return self._get_shared(cache_key, *args, **kwargs)[0]
+        # Read the generation first, the value that is read from the Django
+        # cache can't be older.
+        generation = local_cache.get_generation(cache_key)
+        value = local_cache.get(cache_key, generation)
         if value is None:
-            value = self.rebuild(*args, **kwargs)
+            value, rebuilt = self._get_shared(cache_key, *args, **kwargs)
+            # A rebuilt value is already stored with a new generation.
+            if not rebuilt:
+                local_cache.set(cache_key, value, generation)
         return value
 
     def __call__(self, *args, **kwargs):
@@ -62,15 +314,92 @@ class ModelCachedValue(CachedValue):
 
     def __init__(self, instance):
         self.instance = instance
+        # Set by prefetch().
+        self._prefetched = None
+
+    def _get_key_prefix(self):
+        namespace = get_cache_namespace(self.instance)
+        if not isinstance(self.instance, CacheGenerationMixin):
+            # Nothing invalidates it, don't read its generation.
+            return namespace
+        return "%s:%s" % (namespace, cache_generations.get(namespace))
 
     def _get_cache_key(self, *args, **kwargs):
         if self.cache_key is not None:
-            return "%s:%s:%s" % (
-                self.instance.__class__.__name__,
-                self.instance.pk,
-                self.cache_key)
+            return "%s:%s" % (self._get_key_prefix(), self.cache_key)
         raise NotImplementedError
 
+    def rebuild(self, *args, **kwargs):
+        self._prefetched = None
+        return super(ModelCachedValue, self).rebuild(*args, **kwargs)
+
+    def get_or_set(self, *args, **kwargs):
+        if self._prefetched is not None and not args and not kwargs:
+            return self._prefetched
+        return super(ModelCachedValue, self).get_or_set(*args, **kwargs)
+
+    @staticmethod
+    def prefetch(instances, keys):
+        """
+        Load cached values of several model instances with a single cache
+        request, and keep them on the instances for the rest of their life.
+
+        The values missing from the cache are rebuilt with the ``get_values()``
+        method of their class, so with one query per key when it is
+        aggregated.
+
+        :arg instances: the model instances, which must have a
+            ``cached_values`` dict.
+        :arg keys: the keys of the ``cached_values`` dict to load.
+        """
+        # Read the generations of the instances with one cache request too.
+        cache_generations.get_many(
+            {get_cache_namespace(instance) for instance in instances
+             if isinstance(instance, CacheGenerationMixin)})
+        by_cache_key = {}
+        for instance in instances:
+            for key in keys:
+                cached_value = instance.cached_values[key]
+                by_cache_key[cached_value._get_cache_key()] = cached_value
+        if not by_cache_key:
+            return
+        found = cache.get_many(list(by_cache_key))
+        missing = defaultdict(list)
+        for cache_key, cached_value in by_cache_key.items():
+            if cache_key not in found:
+                missing[cached_value.__class__].append(cached_value)
+            else:
+                cached_value._prefetched = cached_value._unwrap(
+                    found[cache_key])
+        for cls, cached_values in missing.items():
+            values = cls.get_values(cached_values)
+            for cached_value, value in zip(cached_values, values):
+                cached_value._prefetched = value
+            cache.set_many(
+                {cached_value._get_cache_key(): cached_value._wrap(value, 0)
+                 for cached_value, value in zip(cached_values, values)},
+                cached_values[0]._get_storage_timeout())
+
+
+def count_votes(field, ids):
+    """
+    Count the likes and dislikes of several emails or threads in one query.
+
+    :arg field: the field of the ``Vote`` model to group the votes by.
+    :arg ids: the values of this field.
+    :returns: a dict of the ``(likes, dislikes)`` tuples by id.
+    """
+    from django.db.models import Count
+
+    from .vote import Vote
+    votes = {id_: [0, 0] for id_ in ids}
+    query = Vote.objects.filter(
+        value__in=(1, -1), **{"%s__in" % field: ids}
+        ).values_list(field, "value").annotate(Count("id")).order_by()
+    for id_, value, count in query:
+        votes[id_][0 if value == 1 else 1] = count
+    return {id_: tuple(counts) for id_, counts in votes.items()}
+
 
 class VotesCachedValue(ModelCachedValue):
 
@@ -94,14 +423,35 @@ class VotesCachedValue(ModelCachedValue):
                 len([v for v in votes if v == -1]),
             )
 
+    @classmethod
+    def get_values(cls, cached_values):
+        from .thread import Thread
+        ids = defaultdict(list)
+        for cached_value in cached_values:
+            ids[isinstance(cached_value.instance, Thread)].append(
+                cached_value.instance.id)
+        votes = {
+            is_thread: count_votes(
+                "email__thread_id" if is_thread else "email_id", model_ids)
+            for is_thread, model_ids in ids.items()
+        }
+        return [
+            votes[isinstance(cached_value.instance, Thread)][
+                cached_value.instance.id]
+            for cached_value in cached_values
+        ]
+
     def get_or_set(self):
-        votes = super(VotesCachedValue, self).get_or_set()
-        likes, dislikes = votes
-        # XXX: use an Enum?
-        if likes - dislikes >= 10:
-            status = "likealot"
-        elif likes - dislikes > 0:
-            status = "like"
-        else:
-            status = "neutral"
-        return {"likes": likes, "dislikes": dislikes, "status": status}
+        likes, dislikes = super(VotesCachedValue, self).get_or_set()
+        return get_votes_summary(likes, dislikes)
+
+
+def get_votes_summary(likes, dislikes):
+    # XXX: use an Enum?
+    if likes - dislikes >= 10:
+        status = "likealot"
+    elif likes - dislikes > 0:
+        status = "like"
+    else:
+        status = "neutral"
+    return {"likes": likes, "dislikes": dislikes, "status": status}
@@ -23,19 +23,21 @@
 import logging
 import os
 import re
+from collections import defaultdict
 from email.generator import BytesGenerator
 from email.message import EmailMessage
 from email.utils import formataddr
 from io import BytesIO
 
 from django.conf import settings
-from django.db import IntegrityError, models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Max
 from django.utils.timezone import get_fixed_timezone, now
 
 from hyperkitty.lib.analysis import compute_thread_order_and_depth
 from .common import VotesCachedValue
 from .mailinglist import MailingList
-from .thread import Thread
+from .thread import Thread, update_counters
 from .vote import Vote
 
 
@@ -113,41 +115,61 @@ class Email(models.Model):
     def set_parent(self, parent):
         if self.id == parent.id:
             raise ValueError("An email can't be its own parent")
+        from hyperkitty.tasks import rebuild_thread_cache_new_email
+
         # Compute the subthread
-        subthread = [self]
-
-        def _collect_children(current_email):
-            children = list(current_email.children.all())
-            if not children:
-                return
-            subthread.extend(children)
-            for child in children:
-                _collect_children(child)
-        _collect_children(self)
-        # now set my new parent value
-        old_parent_id = self.parent_id
-        self.parent = parent
-        self.save(update_fields=["parent_id"])
-        # If my future parent is in my current subthread, I need to set its
-        # parent to my current parent
-        if parent in subthread:
-            parent.parent_id = old_parent_id
-            parent.save(update_fields=["parent_id"])
-            # do it after setting the new parent_id to avoid having two
-            # parent_ids set to None at the same time (IntegrityError)
-        if self.thread_id != parent.thread_id:
-            # we changed the thread, reattach the subthread
-            former_thread = self.thread
-            for child in subthread:
-                child.thread = parent.thread
-                child.save(update_fields=["thread_id"])
-                if child.date > parent.thread.date_active:
-                    parent.thread.date_active = child.date
-            parent.thread.save()
-            # if we were the starting email, or former thread may be empty
-            if former_thread.emails.count() == 0:
-                former_thread.delete()
-        compute_thread_order_and_depth(parent.thread)
+        children = defaultdict(list)
+        for email_id, parent_id in Email.objects.filter(
+                thread_id=self.thread_id).values_list("id", "parent_id"):
+            if parent_id is not None:
+                children[parent_id].append(email_id)
+        subthread = set()
+        to_visit = [self.id]
+        while to_visit:
+            email_id = to_visit.pop()
+            if email_id in subthread:
+                continue  # reply loop
+            subthread.add(email_id)
+            to_visit.extend(children[email_id])
+        thread = parent.thread
+        former_thread = self.thread
+        former_thread_id = former_thread.id
+        with transaction.atomic():
+            PendingReply.objects.filter(email_id=self.id).delete()
+            # now set my new parent value
+            old_parent_id = self.parent_id
+            self.parent = parent
+            self.save(update_fields=["parent_id"])
+            # If my future parent is in my current subthread, I need to set
+            # its parent to my current parent
+            if parent.id in subthread:
+                parent.parent_id = old_parent_id
+                parent.save(update_fields=["parent_id"])
+                # do it after setting the new parent_id to avoid having two
+                # parent_ids set to None at the same time (IntegrityError)
+            if former_thread.id != thread.id:
+                # we changed the thread, reattach the subthread
+                Email.objects.filter(id__in=subthread).update(
+                    thread_id=thread.id)
+                self.thread = thread
+                thread.date_active = thread.emails.aggregate(
+                    date_active=Max("date"))["date_active"]
+                thread.save(update_fields=["date_active"])
+                # if we were the starting email, or former thread may be empty
+                former_date_active = former_thread.emails.aggregate(
+                    date_active=Max("date"))["date_active"]
+                if former_date_active is None:
+                    former_thread.delete()
+                    former_thread = None
+                else:
+                    former_thread.date_active = former_date_active
+                    former_thread.save(update_fields=["date_active"])
+                    compute_thread_order_and_depth(former_thread)
+                update_counters([thread.id, former_thread_id])
+            compute_thread_order_and_depth(thread)
+        rebuild_thread_cache_new_email(thread.id)
+        if former_thread is not None and former_thread.id != thread.id:
+            rebuild_thread_cache_new_email(former_thread.id)
 
     def as_message(self, escape_addresses=True):
         # http://wordeology.com/computer/how-to-send-good-unicode-email-with-python.html
@@ -292,6 +314,25 @@ class Email(models.Model):
     on_vote_deleted = on_vote_added
 
 
+class PendingReply(models.Model):
+    """
+    An email replying to an email that has not been archived (yet).
+
+    When the parent email arrives, the reply is re-attached to it.
+    """
+    mailinglist = models.ForeignKey(
+        "MailingList", related_name="pending_replies",
+        on_delete=models.CASCADE)
+    in_reply_to = models.CharField(max_length=255)
+    email = models.OneToOneField(
+        "Email", related_name="pending_reply", on_delete=models.CASCADE)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["mailinglist", "in_reply_to"]),
+        ]
+
+
 class Attachment(models.Model):
     email = models.ForeignKey(
         "Email", related_name="attachments", on_delete=models.CASCADE)
@@ -35,7 +35,7 @@ from django_mailman3.lib.user import get_django_user
 from mailmanclient import MailmanConnectionError
 
 from hyperkitty.lib.utils import pgsql_disable_indexscan
-from .common import ModelCachedValue
+from .common import CacheGenerationMixin, ModelCachedValue
 from .thread import Thread
 
 
@@ -62,7 +62,7 @@ class ArchiveRenderingMode(Enum):
     markdown = 'markdown'
 
 
-class MailingList(models.Model):
+class MailingList(CacheGenerationMixin, models.Model):
     """
     An archived mailing-list.
     """
@@ -163,17 +163,7 @@ class MailingList(models.Model):
 
     @property
     def recent_threads_count(self):
-        # Don't use a CachedValue for this one, because it does not need a
-        # specific warm up or rebuild: this is done by the recent_threads
-        # CachedValue.
-        begin_date, end_date = self.get_recent_dates()
-        cache_key = "MailingList:%s:recent_threads_count" % self.pk
-        result = cache.get(cache_key)
-        if result is None:
-            result = self.get_threads_between(begin_date, end_date).count()
-            # The cache will be refreshed daily by a periodic job.
-            cache.set(cache_key, result, None)
-        return result
+        return self.cached_values["recent_threads"].get_count()
 
     def get_participants_count_for_month(self, year, month):
         return self.cached_values["participants_count_for_month"](year, month)
@@ -261,20 +251,21 @@ class MailingList(models.Model):
         # Set the default list_id
         if self.list_id is None:
             self.list_id = self.name.replace("@", ".")
+        # The archiver keeps a cache of the lists.
+        from hyperkitty.lib.incoming import forget_mailinglist
+        forget_mailinglist(self.name)
+
+    def on_post_delete(self):
+        from hyperkitty.lib.incoming import forget_mailinglist
+        forget_mailinglist(self.name)
 
     def on_thread_added(self, thread):
         self.cached_values["recent_threads"].add_thread(thread)
 
     def on_thread_deleted(self, thread):
-        from hyperkitty.tasks import (
-            rebuild_mailinglist_cache_for_month,
-            rebuild_mailinglist_cache_recent)
-        begin_date, end_date = self.get_recent_dates()
-        if thread.date_active >= begin_date and thread.date_active < end_date:
-            # It's a recent thread
-            rebuild_mailinglist_cache_recent(self.name)
-        rebuild_mailinglist_cache_for_month(
-            self.name, thread.date_active.year, thread.date_active.month)
+        # The deleted thread may be in any of the cached values, they will be
+        # rebuilt when they are read.
+        self.invalidate_cache()
 
     def on_email_added(self, email):
         if getattr(settings, "HYPERKITTY_BATCH_MODE", False):
@@ -309,7 +300,14 @@ class MailingList(models.Model):
     on_vote_deleted = on_vote_added
 
 
-class RecentThreads(ModelCachedValue):
+class MailingListCachedValue(ModelCachedValue):
+
+    # These values are read on most pages of the list, keep them in the
+    # per-process cache too.
+    local = True
+
+
+class RecentThreads(MailingListCachedValue):
 
     cache_key = "recent_threads"
 
@@ -324,9 +322,26 @@ class RecentThreads(ModelCachedValue):
 
     def rebuild(self):
         value = super(RecentThreads, self).rebuild()
-        cache.set("%s_count" % self._get_cache_key(), len(value), None)
+        cache.set(self._get_count_cache_key(), len(value), None)
         return value
 
+    def _get_count_cache_key(self):
+        return "%s_count" % self._get_cache_key()
+
+    def get_count(self):
+        # Don't use another CachedValue for the count, because it does not
+        # need a specific warm up or rebuild: this is done with the thread
+        # ids.
+        cache_key = self._get_count_cache_key()
+        result = cache.get(cache_key)
+        if result is None:
+            begin_date, end_date = self.instance.get_recent_dates()
+            result = self.instance.get_threads_between(
+                begin_date, end_date).count()
+            # The cache will be refreshed daily by a periodic job.
+            cache.set(cache_key, result, None)
+        return result
+
     def get_or_set(self):
         thread_ids = super(RecentThreads, self).get_or_set()
         return [Thread.objects.get(pk=pk) for pk in thread_ids]
@@ -342,16 +357,14 @@ class RecentThreads(ModelCachedValue):
             # If the thread is already recent, make it the most recent.
             recent_thread_ids.remove(thread.id)
         recent_thread_ids.insert(0, thread.id)
-        cache.set(self._get_cache_key(), recent_thread_ids, None)
-        cache.set("%s_count" % self._get_cache_key(),
-                  len(recent_thread_ids), None)
+        self.set(recent_thread_ids)
+        cache.set(self._get_count_cache_key(), len(recent_thread_ids), None)
 
 
-class ParticipantsCountForMonth(ModelCachedValue):
+class ParticipantsCountForMonth(MailingListCachedValue):
 
     def _get_cache_key(self, year, month):
-        return "MailingList:%s:p_count_for:%s:%s" % (
-            self.instance.pk, year, month)
+        return "%s:p_count_for:%s:%s" % (self._get_key_prefix(), year, month)
 
     def get_value(self, year, month):
         begin_date = datetime.datetime(year, month, 1, tzinfo=utc)
@@ -361,7 +374,7 @@ class ParticipantsCountForMonth(ModelCachedValue):
             begin_date, end_date)
 
 
-class RecentParticipantsCount(ModelCachedValue):
+class RecentParticipantsCount(MailingListCachedValue):
 
     cache_key = "recent_participants_count"
 
@@ -371,7 +384,7 @@ class RecentParticipantsCount(ModelCachedValue):
             begin_date, end_date)
 
 
-class TopPosters(ModelCachedValue):
+class TopPosters(MailingListCachedValue):
 
     cache_key = "top_posters"
 
@@ -402,63 +415,45 @@ class TopPosters(ModelCachedValue):
         return sorted_posters[:5]
 
 
-class TopThreads(ModelCachedValue):
+class TopThreads(MailingListCachedValue):
     """Threads with the most answers."""
 
     cache_key = "top_threads"
 
     def get_value(self):
-        # Filter on the recent_threads ids instead of re-using the date
-        # filter, otherwise the Sum will be computed for every thread
-        # regardless of their date.
         begin_date, end_date = self.instance.get_recent_dates()
-        recent_thread_ids = self.instance.get_threads_between(
-            begin_date, end_date).values("id")
-        threads = Thread.objects.filter(
-            id__in=recent_thread_ids).annotate(
-            models.Count("emails")).order_by("-emails__count")[:20]
-        # (not sure about using .values_list() here because of the annotation)
+        threads = self.instance.get_threads_between(begin_date, end_date)
         # Only cache the list of thread ids, or it may go over memcached's size
         # limit (1MB)
-        return [t.id for t in threads]
+        threads = threads.order_by("-emails_count", "-date_active")
+        return list(threads.values_list("id", flat=True)[:20])
 
     def get_or_set(self):
         thread_ids = super(TopThreads, self).get_or_set()
         return [Thread.objects.get(pk=pk) for pk in thread_ids]
 
 
-class PopularThreads(ModelCachedValue):
+class PopularThreads(MailingListCachedValue):
     """Threads with the most votes."""
 
     cache_key = "popular_threads"
 
     def get_value(self):
-        # Filter on the recent_threads ids instead of re-using the date
-        # filter, otherwise the Sum will be computed for every thread
-        # regardless of their date.
         begin_date, end_date = self.instance.get_recent_dates()
-        recent_thread_ids = self.instance.get_threads_between(
-            begin_date, end_date).values("id")
-        threads = Thread.objects.filter(
-            id__in=recent_thread_ids).annotate(
-            models.Sum("emails__votes__value")).order_by(
-            "-emails__votes__value__sum")[:20]
-        # (not sure about using .values_list() here because of the annotation)
-        for thread in threads:
-            value = thread.emails__votes__value__sum
-            if value is None:
-                value = 0
-            cache.set("Thread:%s:votes_total" % thread.id, value, None)
+        threads = self.instance.get_threads_between(begin_date, end_date)
         # Only cache the list of thread ids, or it may go over memcached's size
         # limit (1MB)
-        return [t.id for t in threads if t.votes_total > 0]
+        threads = threads.annotate(
+            votes_total=models.F("likes") - models.F("dislikes")).filter(
+            votes_total__gt=0).order_by("-votes_total", "-date_active")
+        return list(threads.values_list("id", flat=True)[:20])
 
     def get_or_set(self):
         thread_ids = super(PopularThreads, self).get_or_set()
         return [Thread.objects.get(pk=pk) for pk in thread_ids]
 
 
-class FirstDate(ModelCachedValue):
+class FirstDate(MailingListCachedValue):
 
     cache_key = "first_date"
 
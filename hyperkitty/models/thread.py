@@ -20,20 +20,21 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 import logging
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 
 from django.conf import settings
-from django.db import models
+from django.db import connection, models, transaction
 from django.utils.timezone import now, utc
 
 from hyperkitty.lib.analysis import compute_thread_order_and_depth
-from .common import ModelCachedValue, VotesCachedValue
+from .common import (
+    CacheGenerationMixin, ModelCachedValue, count_votes, get_votes_summary)
 
 
 logger = logging.getLogger(__name__)
 
 
-class Thread(models.Model):
+class Thread(CacheGenerationMixin, models.Model):
     """
     A thread of archived email, from a mailing-list. It is identified by both
     the list name and the thread id.
@@ -49,20 +50,34 @@ class Thread(models.Model):
     starting_email = models.OneToOneField(
         "Email", related_name="started_thread", null=True,
         on_delete=models.SET_NULL)
+    # The counters are updated with atomic queries when emails and votes are
+    # added or deleted, see COUNTER_FIELDS.
+    emails_count = models.IntegerField(default=0)
+    participants_count = models.IntegerField(default=0)
+    likes = models.IntegerField(default=0)
+    dislikes = models.IntegerField(default=0)
+    last_email = models.ForeignKey(
+        "Email", related_name="+", null=True, on_delete=models.SET_NULL)
 
     def __init__(self, *args, **kwargs):
         super(Thread, self).__init__(*args, **kwargs)
         self.cached_values = {
-            "participants_count": ParticipantsCount(self),
-            "emails_count": EmailsCount(self),
             "subject": Subject(self),
-            "votes": VotesCachedValue(self),
-            "votes_total": VotesTotal(self),
         }
 
     class Meta:
         unique_together = ("mailinglist", "thread_id")
 
+    def save(self, *args, **kwargs):
+        # Don't overwrite the counters with the values that were loaded with
+        # the instance, they may have been updated since then.
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in COUNTER_FIELDS
+            ]
+        super(Thread, self).save(*args, **kwargs)
+
     def __str__(self):
         return self.subject
 
@@ -77,10 +92,6 @@ class Thread(models.Model):
                 "sender__address", "sender_name").distinct()
             ]
 
-    @property
-    def participants_count(self):
-        return self.cached_values["participants_count"]()
-
     def replies_after(self, date):
         return self.emails.filter(date__gt=date)
 
@@ -101,20 +112,16 @@ class Thread(models.Model):
     #     self.category_id = category.id
     # category = property(_get_category, _set_category)
 
-    @property
-    def emails_count(self):
-        return self.cached_values["emails_count"]()
-
     @property
     def subject(self):
         return self.cached_values["subject"]()
 
     def get_votes(self):
-        return self.cached_values["votes"]()
+        return get_votes_summary(self.likes, self.dislikes)
 
     @property
     def votes_total(self):
-        return self.cached_values["votes_total"]()
+        return self.likes - self.dislikes
 
     @property
     def prev_thread(self):  # TODO: Make it a relationship
@@ -174,11 +181,23 @@ class Thread(models.Model):
         self.mailinglist.on_thread_deleted(self)
 
     def on_email_added(self, email):
+        from .email import Email  # circular import
         self.find_starting_email()
         self.date_active = email.date
         if self.starting_email is None:
             self.starting_email = email
-        self.save()
+        if self.last_email_id is None or not Email.objects.filter(
+                id=self.last_email_id, date__gt=email.date).exists():
+            self.last_email = email
+        with transaction.atomic():
+            self._lock()
+            self.emails_count = models.F("emails_count") + 1
+            if not self._has_other_email_from(email):
+                self.participants_count = models.F("participants_count") + 1
+            self.save(update_fields=[
+                "starting_email", "date_active", "last_email", "emails_count",
+                "participants_count"])
+        self.refresh_from_db(fields=["emails_count", "participants_count"])
         if not getattr(settings, "HYPERKITTY_BATCH_MODE", False):
             # Cache handling and thread positions will be handled at the end of
             # the import process.
@@ -196,32 +215,108 @@ class Thread(models.Model):
         else:
             if self.starting_email is None:
                 self.find_starting_email()
-                self.save(update_fields=["starting_email"])
             compute_thread_order_and_depth(self)
-            self.date_active = self.emails.order_by("-date").first().date
+            self.last_email = self.emails.order_by("-date").first()
+            self.date_active = self.last_email.date
+            with transaction.atomic():
+                self._lock()
+                self.emails_count = models.F("emails_count") - 1
+                if not self._has_other_email_from(email):
+                    self.participants_count = (
+                        models.F("participants_count") - 1)
+                self.save(update_fields=[
+                    "starting_email", "date_active", "last_email",
+                    "emails_count", "participants_count"])
+            self.refresh_from_db(fields=["emails_count", "participants_count"])
             rebuild_thread_cache_new_email(self.id)
 
-    def on_vote_added(self, vote):
-        from hyperkitty.tasks import rebuild_thread_cache_votes
-        rebuild_thread_cache_votes(self.id)
-
-    on_vote_deleted = on_vote_added
-
+    def _lock(self):
+        """
+        Lock the thread's row until the end of the transaction, so that the
+        emails of the same sender that are added or deleted concurrently are
+        seen by the participant check of the next one.
+
+        The new emails hold a key share lock on the row, which only a
+        ``FOR NO KEY UPDATE`` lock does not conflict with. On the other
+        databases, the counters can be fixed with the
+        ``hyperkitty_repair_counters`` command.
+        """
+        if not connection.features.has_select_for_no_key_update:
+            return
+        Thread.objects.select_for_update(no_key=True).only("id").get(
+            id=self.id)
 
-class ParticipantsCount(ModelCachedValue):
+    def _has_other_email_from(self, email):
+        # The participants are the distinct senders, by address and name.
+        return self.emails.filter(
+            sender_id=email.sender_id, sender_name=email.sender_name
+            ).exclude(id=email.id).exists()
 
-    cache_key = "participants_count"
+    def on_vote_added(self, vote):
+        # The vote may replace a vote that was already counted.
+        self._count_votes(added=vote.value, removed=vote.saved_value)
+
+    def on_vote_deleted(self, vote):
+        self._count_votes(removed=vote.saved_value)
+
+    def _count_votes(self, added=None, removed=None):
+        changes = {}
+        for value, increment in ((added, 1), (removed, -1)):
+            field = VOTE_FIELDS.get(value)
+            if field is not None:
+                changes[field] = (
+                    changes.get(field, models.F(field)) + increment)
+        if not changes:
+            return
+        Thread.objects.filter(id=self.id).update(**changes)
+        self.refresh_from_db(fields=["likes", "dislikes"])
 
-    def get_value(self):
-        return len(self.instance.participants)
 
+# The fields that are only updated with atomic queries.
+COUNTER_FIELDS = (
+    "emails_count", "participants_count", "likes", "dislikes", "last_email")
+# The counter of each vote value.
+VOTE_FIELDS = {1: "likes", -1: "dislikes"}
 
-class EmailsCount(ModelCachedValue):
 
-    cache_key = "emails_count"
+def update_counters(thread_ids):
+    """
+    Recompute the counters of threads from their emails and votes, for
+    example after emails have been moved between threads or imported in bulk.
 
-    def get_value(self):
-        return self.instance.emails.count()
+    :returns: the number of threads whose counters were wrong.
+    """
+    from .email import Email  # circular import
+    thread_ids = list(thread_ids)
+    emails_counts = defaultdict(int)
+    participants_counts = defaultdict(int)
+    participants = Email.objects.filter(thread_id__in=thread_ids).values_list(
+        "thread_id", "sender_id", "sender_name").annotate(
+        models.Count("id")).order_by()
+    for thread_id, _sender, _name, count in participants:
+        emails_counts[thread_id] += count
+        participants_counts[thread_id] += 1
+    votes = count_votes("email__thread_id", thread_ids)
+    last_emails = Email.objects.filter(
+        thread_id=models.OuterRef("id")).order_by("-date").values("id")[:1]
+    threads = Thread.objects.filter(id__in=thread_ids).annotate(
+        last_email_id_value=models.Subquery(last_emails))
+    changed = []
+    for thread in threads:
+        counters = {
+            "emails_count": emails_counts[thread.id],
+            "participants_count": participants_counts[thread.id],
+            "likes": votes[thread.id][0],
+            "dislikes": votes[thread.id][1],
+            "last_email_id": thread.last_email_id_value,
+        }
+        if any(getattr(thread, name) != value
+               for name, value in counters.items()):
+            for name, value in counters.items():
+                setattr(thread, name, value)
+            changed.append(thread)
+    Thread.objects.bulk_update(changed, COUNTER_FIELDS)
+    return len(changed)
 
 
 class Subject(ModelCachedValue):
@@ -231,14 +326,14 @@ class Subject(ModelCachedValue):
     def get_value(self):
         return self.instance.starting_email.subject
 
-
-class VotesTotal(ModelCachedValue):
-
-    cache_key = "votes_total"
-
-    def get_value(self):
-        votes = self.instance.get_votes()
-        return votes["likes"] - votes["dislikes"]
+    @classmethod
+    def get_values(cls, cached_values):
+        from .email import Email
+        subjects = dict(Email.objects.filter(
+            id__in=[cv.instance.starting_email_id for cv in cached_values]
+            ).values_list("id", "subject"))
+        return [subjects.get(cv.instance.starting_email_id)
+                for cv in cached_values]
 
 
 class LastView(models.Model):
@@ -34,6 +34,12 @@ class Vote(models.Model):
                              related_name="votes", on_delete=models.CASCADE)
     value = models.SmallIntegerField(db_index=True)
 
+    def __init__(self, *args, **kwargs):
+        super(Vote, self).__init__(*args, **kwargs)
+        # The value that is stored in the database, and counted in the
+        # thread's likes and dislikes.
+        self.saved_value = self.value if self.pk is not None else None
+
     class Meta:
         unique_together = ("email", "user")
 
@@ -41,6 +47,7 @@ class Vote(models.Model):
         self.email.on_vote_added(self)
         self.email.thread.on_vote_added(self)
         self.email.mailinglist.on_vote_added(self)
+        self.saved_value = self.value
 
     def on_post_delete(self):
         self.email.on_vote_deleted(self)
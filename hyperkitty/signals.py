@@ -28,6 +28,7 @@ from django.dispatch import receiver
 
 from django_mailman3.signals import mailinglist_created, mailinglist_modified
 
+from hyperkitty.lib.incoming import forget_mailinglist
 from hyperkitty.lib.mailman import import_list_from_mailman
 from hyperkitty.models.email import Attachment, Email
 from hyperkitty.models.mailinglist import MailingList
@@ -80,6 +81,11 @@ def MailingList_set_list_id(sender, **kwargs):
     kwargs["instance"].on_pre_save()
 
 
+@receiver(post_delete, sender=MailingList)
+def MailingList_on_post_delete(sender, **kwargs):
+    kwargs["instance"].on_post_delete()
+
+
 # Profile
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -130,6 +136,8 @@ def on_mailinglist_created(sender, **kwargs):
 
 @receiver(mailinglist_modified)
 def on_mailinglist_modified(sender, **kwargs):
+    # The signal only carries the list_id, forget all the cached lists.
+    forget_mailinglist()
     import_list_from_mailman(kwargs["list_id"])
 
 
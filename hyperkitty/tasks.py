@@ -24,16 +24,20 @@ Author: Aurelien Bompard <abompard@fedoraproject.org>
 """
 
 import logging
+from hashlib import sha1
 
+from django.conf import settings
 from django.core.cache import cache
-from django.core.cache.utils import make_template_fragment_key
+from django.db import transaction
 
 from django_q.tasks import AsyncTask
 from mailmanclient import MailmanConnectionError
 
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib import metrics
+from hyperkitty.lib.analysis import (
+    add_to_thread_order, compute_thread_order_and_depth)
 from hyperkitty.lib.utils import run_with_lock
-from hyperkitty.models.email import Email
+from hyperkitty.models.email import Email, PendingReply
 from hyperkitty.models.mailinglist import MailingList
 from hyperkitty.models.sender import Sender
 from hyperkitty.models.thread import Thread
@@ -42,6 +46,67 @@ from hyperkitty.search_indexes import update_index
 
 log = logging.getLogger(__name__)
 
+
+#
+# Coalescing
+#
+
+# Tasks that are not queued again if an identical task is already waiting in
+# the queue.
+COALESCED_TASKS = (
+    "rebuild_mailinglist_cache_recent",
+    "rebuild_mailinglist_cache_for_month",
+    "rebuild_thread_cache_new_email",
+    "rebuild_cache_popular_threads",
+    "compute_thread_positions",
+)
+
+
+def _get_pending_key(task_name, args):
+    args_hash = sha1(repr(args).encode("utf-8")).hexdigest()
+    return "HyperKitty:task_pending:%s:%s" % (task_name, args_hash)
+
+
+def run_coalesced(task_name, func, *args):
+    """
+    Queue a task, unless an identical one (same name and same arguments) is
+    already waiting in the queue.
+
+    A marker is stored in the cache when the task is queued, and removed when
+    the task starts running, so an event that happens while the task is
+    running will queue it again. The marker expires after
+    ``HYPERKITTY_TASK_COALESCE_WINDOW`` seconds, in case the task is lost.
+
+    Both are done when the current transaction is committed: if it is rolled
+    back, the task is not queued and no marker is left behind.
+    """
+    window = getattr(settings, "HYPERKITTY_TASK_COALESCE_WINDOW", 60)
+
+    def enqueue():
+        if window:
+            if not cache.add(_get_pending_key(task_name, args), True, window):
+                metrics.incr("coalesced:%s" % task_name)
+                return
+        AsyncTask(_run_pending, task_name, func, *args,
+                  q_options={'task_name': task_name}).run()
+
+    transaction.on_commit(enqueue)
+
+
+def _run_pending(task_name, func, *args):
+    cache.delete(_get_pending_key(task_name, args))
+    return func(*args)
+
+
+def get_coalesced_counts():
+    """Return the number of coalesced tasks, by task name."""
+    counters = metrics.get_counters(
+        ["coalesced:%s" % task_name for task_name in COALESCED_TASKS])
+    return {
+        name.split(":", 1)[1]: value for name, value in counters.items()
+    }
+
+
 #
 # Tasks
 #
@@ -58,9 +123,9 @@ def update_search_index():
 #     run_with_lock(update_index, remove=True)
 
 def rebuild_mailinglist_cache_recent(mlist_name):
-    AsyncTask(
-        _rebuild_mailinglist_cache_recent, mlist_name,
-        q_options={'task_name': 'rebuild_mailinglist_cache_recent'}).run()
+    run_coalesced(
+        'rebuild_mailinglist_cache_recent',
+        _rebuild_mailinglist_cache_recent, mlist_name)
 
 
 def _rebuild_mailinglist_cache_recent(mlist_name):
@@ -74,9 +139,9 @@ def _rebuild_mailinglist_cache_recent(mlist_name):
 
 
 def rebuild_mailinglist_cache_for_month(mlist_name, year, month):
-    AsyncTask(
-        _rebuild_mailinglist_cache_for_month, mlist_name, year, month,
-        q_options={'task_name': 'rebuild_mailinglist_cache_for_month'}).run()
+    run_coalesced(
+        'rebuild_mailinglist_cache_for_month',
+        _rebuild_mailinglist_cache_for_month, mlist_name, year, month)
 
 
 def _rebuild_mailinglist_cache_for_month(mlist_name, year, month):
@@ -89,8 +154,9 @@ def _rebuild_mailinglist_cache_for_month(mlist_name, year, month):
 
 
 def rebuild_thread_cache_new_email(thread_id):
-    AsyncTask(_rebuild_thread_cache_new_email, thread_id,
-              q_options={'task_name': 'rebuild_thread_cache_new_email'}).run()
+    run_coalesced(
+        'rebuild_thread_cache_new_email',
+        _rebuild_thread_cache_new_email, thread_id)
 
 
 def _rebuild_thread_cache_new_email(thread_id):
@@ -101,16 +167,15 @@ def _rebuild_thread_cache_new_email(thread_id):
             "Cannot rebuild the thread cache: thread %s does not exist.",
             thread_id)
         return
-    for cached_key in ["participants_count", "emails_count"]:
-        thread.cached_values[cached_key].rebuild()
-    # Don't forget the cached template fragment.
-    cache.delete(make_template_fragment_key(
-        "thread_participants", [thread.id]))
+    # The counters are stored in the thread, only the cached values and
+    # template fragments must be invalidated.
+    thread.invalidate_cache()
 
 
 def rebuild_cache_popular_threads(mlist_name):
-    AsyncTask(_rebuild_cache_popular_threads, mlist_name,
-              q_options={'task_name': 'rebuild_cache_popular_threads'}).run()
+    run_coalesced(
+        'rebuild_cache_popular_threads',
+        _rebuild_cache_popular_threads, mlist_name)
 
 
 def _rebuild_cache_popular_threads(mlist_name):
@@ -123,8 +188,9 @@ def _rebuild_cache_popular_threads(mlist_name):
 
 
 def compute_thread_positions(thread_id):
-    AsyncTask(_compute_thread_positions, thread_id,
-              q_options={'task_name': 'compute_thread_positions'}).run()
+    run_coalesced(
+        'compute_thread_positions',
+        _compute_thread_positions, thread_id)
 
 
 def _compute_thread_positions(thread_id):
@@ -136,12 +202,14 @@ def _compute_thread_positions(thread_id):
             "Cannot rebuild the thread cache: thread %s does not exist.",
             thread_id)
         return
-    compute_thread_order_and_depth(thread)
+    if not add_to_thread_order(thread):
+        compute_thread_order_and_depth(thread)
 
 
 def update_from_mailman(mlist_name):
-    AsyncTask(_update_from_mailman, mlist_name,
-              q_options={'task_name': 'update_from_mailman'}).run()
+    transaction.on_commit(AsyncTask(
+        _update_from_mailman, mlist_name,
+        q_options={'task_name': 'update_from_mailman'}).run)
 
 
 def _update_from_mailman(mlist_name):
@@ -153,9 +221,17 @@ def _update_from_mailman(mlist_name):
     mlist.update_from_mailman()
 
 
+def get_mailman_lookup_key(address):
+    """The key of the marker of the recent Mailman lookups of an address."""
+    # Addresses may contain characters that are not valid in cache keys.
+    return "Sender:%s:mailman_lookup" % sha1(
+        address.encode("utf-8")).hexdigest()
+
+
 def sender_mailman_id(sender_id):
-    AsyncTask(_sender_mailman_id, sender_id,
-              q_options={'task_name': 'sender_mailman_id'}).run()
+    transaction.on_commit(AsyncTask(
+        _sender_mailman_id, sender_id,
+        q_options={'task_name': 'sender_mailman_id'}).run)
 
 
 def _sender_mailman_id(sender_id):
@@ -163,12 +239,14 @@ def _sender_mailman_id(sender_id):
     try:
         sender.set_mailman_id()
     except MailmanConnectionError:
-        pass
+        # It was not looked up, allow the next email to try again.
+        cache.delete(get_mailman_lookup_key(sender.address))
 
 
 def check_orphans(email_id):
-    AsyncTask(_check_orphans, email_id,
-              q_options={'task_name': 'check_orphans'}).run()
+    transaction.on_commit(AsyncTask(
+        _check_orphans, email_id,
+        q_options={'task_name': 'check_orphans'}).run)
 
 
 def _check_orphans(email_id):
@@ -183,39 +261,22 @@ def _check_orphans(email_id):
         log.warning(
             "Cannot check for orphans: email %s does not exist.", email_id)
         return
-    orphans = Email.objects.filter(
-            mailinglist=email.mailinglist,
+    pending_replies = PendingReply.objects.filter(
+            mailinglist_id=email.mailinglist_id,
             in_reply_to=email.message_id,
-            parent_id__isnull=True,
         ).exclude(
             # guard against emails with the in-reply-to header pointing to
             # themselves
-            id=email.id
-        )
-    for orphan in orphans:
-        orphan.set_parent(email)
-
-
-def rebuild_thread_cache_votes(thread_id):
-    AsyncTask(_rebuild_thread_cache_votes, thread_id,
-              q_options={'task_name': 'rebuild_thread_cache_votes'}).run()
-
-
-def _rebuild_thread_cache_votes(thread_id):
-    try:
-        thread = Thread.objects.get(id=thread_id)
-    except Thread.DoesNotExist:
-        log.warning('Thread with id {thread_id} does not exist'.format(
-            thread_id=thread_id))
-        return
-
-    for cached_key in ["votes", "votes_total"]:
-        thread.cached_values[cached_key].rebuild()
+            email_id=email.id
+        ).select_related("email")
+    for pending_reply in pending_replies:
+        pending_reply.email.set_parent(email)
 
 
 def rebuild_email_cache_votes(email_id):
-    AsyncTask(_rebuild_email_cache_votes, email_id,
-              q_options={'task_name': 'rebuild_email_cache_votes'}).run()
+    transaction.on_commit(AsyncTask(
+        _rebuild_email_cache_votes, email_id,
+        q_options={'task_name': 'rebuild_email_cache_votes'}).run)
 
 
 def _rebuild_email_cache_votes(email_id):
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+from io import StringIO
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from hyperkitty.models import Email
+from hyperkitty.tests.utils import TestCase
+
+
+MBOX = (
+    b"From dummy@example.com Sun Feb  1 12:00:00 2015\n"
+    b"From: dummy@example.com\n"
+    b"Message-ID: <msg1>\n"
+    b"Date: 01 Feb 2015 12:00:00\n"
+    b"\n"
+    b"msg1\n"
+    b"\n"
+    b"From dummy@example.com Sun Feb  1 12:01:00 2015\n"
+    b"From: Dummy <d\xc3\xbcmmy@example.com>\n"
+    b"Message-ID: <msg2>\n"
+    b"Date: 01 Feb 2015 12:01:00\n"
+    b"\n"
+    b"msg2\n"
+    b"\n"
+    b"From dummy@example.com Sun Feb  1 12:02:00 2015\n"
+    b"From: dummy@example.com\n"
+    b"Message-ID: <msg1>\n"
+    b"Date: 01 Feb 2015 12:02:00\n"
+    b"\n"
+    b"msg1 again\n"
+)
+
+
+class CommandTestCase(TestCase):
+
+    def setUp(self):
+        self.mbox_path = os.path.join(self.tmpdir, "test.mbox")
+        with open(self.mbox_path, "wb") as mbox_file:
+            mbox_file.write(MBOX)
+        self.report_path = os.path.join(self.tmpdir, "report.json")
+
+    def tearDown(self):
+        settings.HYPERKITTY_BATCH_MODE = False
+
+    def _check(self, **options):
+        output = StringIO()
+        call_command("hyperkitty_check_import", self.mbox_path,
+                     report=self.report_path, stdout=output, stderr=output,
+                     **options)
+        self.assertIn("Checked 3 messages, 2 can't be imported.",
+                      output.getvalue())
+        with open(self.report_path) as report_file:
+            return json.load(report_file)
+
+    def test_report(self):
+        report = self._check()
+        self.assertEqual(report["messages"], 3)
+        self.assertEqual(report["failures"], 2)
+        self.assertEqual(len(report["mboxes"]), 1)
+        self.assertEqual(report["mboxes"][0]["path"], self.mbox_path)
+        failures = report["mboxes"][0]["failures"]
+        self.assertEqual(
+            [(failure["message_id"], failure["error"].split(":")[0])
+             for failure in failures],
+            [("<msg2>", "ValueError"), ("<msg1>", "DuplicateMessage")])
+        # The offsets locate the messages in the file.
+        for failure in failures:
+            message = MBOX[failure["offset"]:failure["end"]]
+            self.assertIn(
+                b"Message-ID: %s" % failure["message_id"].encode("ascii"),
+                message)
+        self.assertIn(b"msg1 again", message)
+
+    def test_jobs(self):
+        self.assertEqual(self._check(jobs=2), self._check())
+
+    def test_same_as_import(self):
+        # The emails that the check rejects are the ones that the import
+        # rejects.
+        self._check()
+        call_command("hyperkitty_import", self.mbox_path,
+                     list_address="list@example.com", no_sync_mailman=True,
+                     stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(
+            list(Email.objects.values_list("message_id", flat=True)),
+            ["msg1"])
+
+    def test_no_file(self):
+        with self.assertRaises(CommandError):
+            call_command("hyperkitty_check_import",
+                         os.path.join(self.tmpdir, "missing.mbox"),
+                         stdout=StringIO())
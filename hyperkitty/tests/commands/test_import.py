@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
+import gzip
+import json
 import mailbox
 import os.path
+import pstats
 import sys
+import threading
+import time
 from datetime import datetime
 from email import message_from_file, message_from_string
 from email.message import EmailMessage
@@ -12,14 +17,23 @@ from unittest import SkipTest, expectedFailure
 from unittest.mock import Mock, patch
 
 from django.conf import settings
-from django.core.management import call_command
-from django.db import DEFAULT_DB_ALIAS
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection
+from django.test import override_settings
 from django.utils.timezone import utc
 
+from haystack.query import SearchQuerySet
+
+from hyperkitty.lib.analysis import (
+    compute_thread_order_and_depth, get_thread_positions)
 from hyperkitty.lib.incoming import add_to_list
-from hyperkitty.management.commands.hyperkitty_import import Command
-from hyperkitty.models import ArchivePolicy, Email, MailingList
-from hyperkitty.tests.utils import TestCase, get_test_file
+from hyperkitty.lib.mbox import MboxReader
+from hyperkitty.management.commands.hyperkitty_import import (
+    BulkDbImporter, Command, DbImporter)
+from hyperkitty.models import (
+    ArchivePolicy, Email, MailingList, PendingReply, Thread)
+from hyperkitty.tests.utils import (
+    SearchEnabledTestCase, TestCase, get_test_file)
 
 
 class CommandTestCase(TestCase):
@@ -54,15 +68,16 @@ class CommandTestCase(TestCase):
         # do the import
         output = StringIO()
         with patch("hyperkitty.management.commands.hyperkitty_import"
-                   ".compute_thread_order_and_depth") as mock_compute:
+                   ".get_thread_positions",
+                   wraps=get_thread_positions) as mock_positions:
             kw = self.common_cmd_args.copy()
             kw["stdout"] = kw["stderr"] = output
             call_command('hyperkitty_import',
                          os.path.join(self.tmpdir, "test.mbox"), **kw)
-        self.assertEqual(mock_compute.call_count, 1)
-        thread = mock_compute.call_args[0][0]
-        self.assertEqual(thread.emails.count(), 1)
-        self.assertEqual(thread.starting_email.message_id, "msg2")
+        self.assertEqual(mock_positions.call_count, 1)
+        self.assertEqual(
+            mock_positions.call_args[0][0],
+            Email.objects.get(message_id="msg2").id)
 
     def test_since_auto(self):
         # When there's mail already and the "since" option is not used, it
@@ -132,6 +147,26 @@ class CommandTestCase(TestCase):
         ml = MailingList.objects.first()
         self.assertEqual(ml.name, "list@example.com")
 
+    def test_report_timings(self):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg1>"
+        msg["Date"] = "01 Feb 2015 12:00:00"
+        msg.set_payload("msg1")
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        mbox.add(msg)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertIn("Time spent in each stage (p50 / p95):",
+                      output.getvalue())
+        self.assertRegex(
+            output.getvalue(),
+            r"  scrub: [0-9.]+ / [0-9.]+ ms, 0 / 0 queries")
+
     def test_missing_message_id(self):
         msg = EmailMessage()
         msg["From"] = "dummy@example.com"
@@ -497,7 +532,8 @@ msg1
         self.assertEqual(Email.objects.count(), 1)
 
     def test_ungetable_message(self):
-        # This mbox message can't be converted to bytes.
+        # This mbox message can't be converted to bytes, but it is parsed
+        # from the mbox file directly.
         mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
         # We have to do it this way to see the exception.
         with open(get_test_file("unicode_issue.txt"), "rb") as em_file:
@@ -517,11 +553,9 @@ msg1
         kw["stdout"] = kw["stderr"] = output
         call_command('hyperkitty_import',
                      os.path.join(self.tmpdir, "test.mbox"), **kw)
-        # Message 1 must have been rejected, but no crash
-        self.assertIn("Failed to convert msg1 to bytes", output.getvalue())
-        # Message 2 must have been accepted
+        # Both messages must have been accepted
         self.assertEqual(MailingList.objects.count(), 1)
-        self.assertEqual(Email.objects.count(), 1)
+        self.assertEqual(Email.objects.count(), 2)
 
     def test_unknown_encoding(self):
         # Spam messages have been seen with bogus charset= encodings which
@@ -736,16 +770,564 @@ msg1
         mbox.close()
         # do the import
         output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"),
+                     batch_size=100, **kw)
+        self.assertEqual(
+            Email.objects.filter(thread_order=0, thread_depth=0).count(),
+            250)
+
+    def _get_archive(self, list_name):
+        # Everything that the import stores, without the database ids.
+        emails = Email.objects.filter(
+            mailinglist__name=list_name).order_by("message_id")
+        return [(
+            email.message_id, email.sender_id, email.sender_name,
+            email.subject, email.content, email.date,
+            email.parent.message_id if email.parent else None,
+            email.thread.thread_id, email.thread.starting_email.message_id,
+            email.thread.date_active, email.thread_order, email.thread_depth,
+            email.thread.emails_count, email.thread.participants_count,
+            email.thread.last_email.message_id,
+            PendingReply.objects.filter(email=email).exists(),
+            [(a.counter, a.name, a.content_type, a.size, a.get_content())
+             for a in email.attachments.order_by("counter")],
+            ) for email in emails]
+
+    def _make_archive(self, list_names):
+        # Archive an email in each list and create a mbox with threads,
+        # duplicates and orphans.
+        for list_name in list_names:
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg0>"
+            msg["Date"] = "01 Jan 2015 12:00:00"
+            msg.set_payload("msg0")
+            add_to_list(list_name, msg)
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        # msg, in-reply-to
+        for msgid, parent in [
+                ("msg1", None), ("msg2", "msg1"), ("msg3", "msg2"),
+                ("msg4", "unknown"), ("msg5", "msg6"), ("msg6", None),
+                ("msg7", "msg0"), ("msg1", None), ("msg8", "msg1"),
+                ("msg9", "msg9")]:
+            msg = EmailMessage()
+            msg["From"] = "Dummy %s <%s@example.com>" % (msgid, msgid)
+            msg["Message-ID"] = "<%s>" % msgid
+            msg["Subject"] = "Subject %s" % msgid
+            msg["Date"] = "01 Feb 2015 12:%s:00" % msgid[3:].zfill(2)
+            if parent is not None:
+                msg["In-Reply-To"] = "<%s>" % parent
+            msg.set_content(msgid)
+            if msgid == "msg3":
+                msg.add_attachment(b"data", maintype="application",
+                                   subtype="octet-stream", filename="a.bin")
+            mbox.add(msg)
+        mbox.close()
+
+    def test_bulk(self):
+        self._make_archive(["list@example.com", "list2@example.com"])
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["since"] = "2015-01-15"
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        kw["list_address"] = "list2@example.com"
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"),
+                     bulk=True, batch_size=3, **kw)
+        archive = self._get_archive("list@example.com")
+        self.assertEqual(len(archive), 10)
+        self.assertEqual(self._get_archive("list2@example.com"), archive)
+        self.assertIn("Duplicate email with message-id 'msg1'",
+                      output.getvalue())
+
+    def test_thread_structure(self):
+        # The thread structure computed in memory is the same as the one
+        # computed from the database.
+        self._make_archive(["list@example.com"])
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["since"] = "2015-01-15"
         with patch("hyperkitty.management.commands.hyperkitty_import"
-                   ".compute_thread_order_and_depth") as mock_compute:
-            kw = self.common_cmd_args.copy()
-            kw["stdout"] = kw["stderr"] = output
+                   ".compute_thread_order_and_depth",
+                   wraps=compute_thread_order_and_depth) as mock_compute:
             call_command('hyperkitty_import',
                          os.path.join(self.tmpdir, "test.mbox"), **kw)
-        called_thread_ids = set([
-            call[0][0].starting_email.message_id
-            for call in mock_compute.call_args_list
-            ])
+        # Only the thread of the email archived before the import is loaded
+        # from the database.
+        self.assertEqual(
+            [call[0][0].starting_email.message_id
+             for call in mock_compute.call_args_list],
+            ["msg0"])
+        archive = self._get_archive("list@example.com")
+        for thread in Thread.objects.all():
+            compute_thread_order_and_depth(thread)
+        self.assertEqual(self._get_archive("list@example.com"), archive)
+
+    def test_bulk_database_error(self):
+        # If a batch can't be stored, the emails are stored one by one.
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(3):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "01 Feb 2015 12:00:00"
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".BulkDbImporter._store_batch",
+                   side_effect=DatabaseError):
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"),
+                         bulk=True, **kw)
+        self.assertEqual(
+            list(Email.objects.order_by("message_id").values_list(
+                "message_id", flat=True)),
+            ["msg0", "msg1", "msg2"])
+        self.assertIn("3 email added to the database", output.getvalue())
+        self.assertIn("Could not store a batch of 3 emails", output.getvalue())
+
+    def test_bulk_one_failure(self):
+        # One email of the batch can't be stored, the others are stored.
+        if connection.vendor != "sqlite":
+            raise SkipTest("Uses a SQLite trigger")
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "CREATE TRIGGER reject_msg1 BEFORE INSERT ON hyperkitty_email "
+                "WHEN NEW.message_id = 'msg1' "
+                "BEGIN SELECT RAISE(ABORT, 'rejected'); END")
+        self.addCleanup(
+            connection.cursor().execute, "DROP TRIGGER reject_msg1")
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(3):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "01 Feb 2015 12:00:00"
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        mbox.close()
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"),
+                     bulk=True, **kw)
         self.assertEqual(
-            called_thread_ids,
-            set([("msg%d" % i) for i in range(250)]))
+            list(Email.objects.order_by("message_id").values_list(
+                "message_id", flat=True)),
+            ["msg0", "msg2"])
+        self.assertIn("Could not store a batch of 3 emails, storing them one "
+                      "by one: rejected", output.getvalue())
+        self.assertIn("Message msg1 failed to import", output.getvalue())
+
+    def test_jobs(self):
+        list_names = [
+            "list@example.com", "list2@example.com", "list3@example.com"]
+        # This email's attachment can't be stored.
+        with open(get_test_file("unknown-charset.txt")) as email_file:
+            msg = message_from_file(email_file)
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        mbox.add(msg)
+        mbox.close()
+        self._make_archive(list_names)
+        kw = self.common_cmd_args.copy()
+        kw["since"] = "2000-01-01"
+        outputs = []
+        for list_name, options in zip(list_names, [
+                {}, {"jobs": 2}, {"jobs": 2, "bulk": True}]):
+            output = StringIO()
+            kw["stdout"] = kw["stderr"] = output
+            kw["list_address"] = list_name
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"),
+                         **options, **kw)
+            outputs.append(output.getvalue())
+        archive = self._get_archive("list@example.com")
+        self.assertEqual(len(archive), 10)
+        self.assertEqual(self._get_archive("list2@example.com"), archive)
+        self.assertEqual(self._get_archive("list3@example.com"), archive)
+        for output in outputs:
+            # The output of the workers and their timings are forwarded.
+            self.assertIn("Failed adding message <msg@id>:", output)
+            self.assertIn("  11 emails read", output)
+            self.assertRegex(
+                output, r"  scrub: [0-9.]+ / [0-9.]+ ms, 0 / 0 queries")
+
+    def test_jobs_stopped_early(self):
+        # The pool can be terminated when the results are not all consumed,
+        # while the reader waits for the messages to be stored.
+        self._make_mbox(300)
+        importer = DbImporter(
+            "list@example.com", {"verbosity": 0, "jobs": 2},
+            StringIO(), StringIO())
+        mbox = MboxReader(os.path.join(self.tmpdir, "test.mbox"))
+        self.addCleanup(mbox.close)
+        results = importer.parse_all(mbox, "test.mbox")
+
+        def consume():
+            next(results)
+            time.sleep(0.5)
+            results.close()
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        consumer.join(30)
+        self.assertFalse(consumer.is_alive())
+        self.assertLess(importer.count_read, 300)
+
+    def _make_mbox(self, count):
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(1, count + 1):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "01 Feb 2015 12:00:00"
+            msg.set_payload("msg%d" % i)
+            mbox.add(msg)
+        mbox.close()
+
+    def _check_resume(self, importer_class, stored, **options):
+        # The import is interrupted before the fourth email, the checkpoint
+        # is saved after the second one, and there are already "stored"
+        # emails in the database.
+        self._make_mbox(5)
+        checkpoint_path = os.path.join(self.tmpdir, "checkpoint.json")
+        kw = self.common_cmd_args.copy()
+        kw.update(options)
+        kw["stdout"] = kw["stderr"] = StringIO()
+        kw["checkpoint"] = checkpoint_path
+        kw["batch_size"] = 2
+        add_parsed = importer_class.add_parsed
+
+        def interrupted_add_parsed(importer, parsed, *args):
+            # The import dies before storing the fourth email
+            if parsed.message_id == "msg4":
+                raise RuntimeError("interrupted")
+            add_parsed(importer, parsed, *args)
+
+        with patch.object(
+                importer_class, "add_parsed", interrupted_add_parsed):
+            self.assertRaises(
+                RuntimeError, call_command, 'hyperkitty_import',
+                os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(Email.objects.count(), stored)
+        with open(checkpoint_path) as checkpoint_file:
+            checkpoint = json.load(checkpoint_file)
+        mbox_state = checkpoint["mboxes"][
+            os.path.join(self.tmpdir, "test.mbox")]
+        self.assertEqual(mbox_state["message_id"], "msg2")
+        self.assertFalse(mbox_state["done"])
+        self.assertEqual(len(checkpoint["thread_ids"]), 2)
+        # Resume the import, after the second email.
+        output = StringIO()
+        kw["stdout"] = kw["stderr"] = output
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".compute_thread_order_and_depth") as mock_compute:
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"),
+                         resume=True, **kw)
+        self.assertIn("resuming after the email msg2", output.getvalue())
+        self.assertEqual(
+            "Duplicate email with message-id 'msg3'" in output.getvalue(),
+            stored == 3)
+        self.assertNotIn("msg1", output.getvalue())
+        self.assertEqual(Email.objects.count(), 5)
+        # The structure of the threads from before the interruption is
+        # computed too, from the database.
+        self.assertEqual(mock_compute.call_count, stored)
+        self.assertEqual(
+            list(Email.objects.filter(
+                message_id__in=["msg4", "msg5"]).values_list(
+                "thread_order", "thread_depth")),
+            [(0, 0), (0, 0)])
+        # The import is complete
+        self.assertFalse(os.path.exists(checkpoint_path))
+
+    def test_resume(self):
+        self._check_resume(DbImporter, 3)
+
+    def test_resume_bulk(self):
+        # The third email was not stored with the second batch.
+        self._check_resume(BulkDbImporter, 2, bulk=True)
+
+    def test_resume_thread_structure(self):
+        self._make_mbox(2)
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg0>"
+        msg.set_payload("msg0")
+        add_to_list("list@example.com", msg)
+        thread_id = Email.objects.get().thread_id
+        checkpoint_path = os.path.join(self.tmpdir, "checkpoint.json")
+        with open(checkpoint_path, "w") as checkpoint_file:
+            json.dump({
+                "list_address": "list@example.com",
+                "mboxes": {os.path.join(self.tmpdir, "test.mbox"): {
+                    "offset": 0, "message_id": None, "done": True}},
+                "thread_ids": [thread_id],
+            }, checkpoint_file)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        with patch("hyperkitty.management.commands.hyperkitty_import"
+                   ".compute_thread_order_and_depth") as mock_compute:
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "test.mbox"),
+                         checkpoint=checkpoint_path, resume=True, **kw)
+        # The mbox has already been imported, only the thread structure is
+        # left.
+        self.assertEqual(Email.objects.count(), 1)
+        self.assertEqual(mock_compute.call_count, 1)
+        self.assertEqual(mock_compute.call_args[0][0].id, thread_id)
+
+    def test_resume_errors(self):
+        self._make_mbox(1)
+        checkpoint_path = os.path.join(self.tmpdir, "checkpoint.json")
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        args = ['hyperkitty_import', os.path.join(self.tmpdir, "test.mbox")]
+        # No checkpoint file
+        self.assertRaises(
+            CommandError, call_command, *args, resume=True, **kw)
+        self.assertRaises(
+            CommandError, call_command, *args, resume=True,
+            checkpoint=checkpoint_path, **kw)
+        for list_address, message_id in [
+                ("other@example.com", None), ("list@example.com", "msg1")]:
+            with open(checkpoint_path, "w") as checkpoint_file:
+                json.dump({
+                    "list_address": list_address,
+                    "mboxes": {os.path.join(self.tmpdir, "test.mbox"): {
+                        "offset": 0, "message_id": message_id,
+                        "done": False}},
+                    "thread_ids": [],
+                }, checkpoint_file)
+            self.assertRaises(
+                CommandError, call_command, *args, resume=True,
+                checkpoint=checkpoint_path, **kw)
+        self.assertEqual(Email.objects.count(), 0)
+
+    def _check_preloaded(self, **options):
+        # The emails that are already archived are skipped without querying
+        # the database for each of them.
+        self._make_mbox(3)
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg2>"
+        msg.set_payload("msg2")
+        add_to_list("list@example.com", msg)
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["since"] = "2000-01-01"
+        kw.update(options)
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), **kw)
+        self.assertEqual(
+            list(Email.objects.order_by("message_id").values_list(
+                "message_id", flat=True)),
+            ["msg1", "msg2", "msg3"])
+        self.assertEqual(Email.objects.get(message_id="msg2").content, "msg2")
+        self.assertIn("Duplicate email with message-id 'msg2'",
+                      output.getvalue())
+        self.assertIn("2 email added to the database", output.getvalue())
+        self.assertIn("1 email already archived", output.getvalue())
+
+    def test_preloaded(self):
+        self._check_preloaded()
+
+    def test_preloaded_bulk(self):
+        self._check_preloaded(bulk=True)
+
+    @override_settings(HYPERKITTY_IMPORT_BLOOM_FILTER_THRESHOLD=0)
+    def test_preloaded_bloom_filter(self):
+        self._check_preloaded()
+
+    @override_settings(HYPERKITTY_IMPORT_BLOOM_FILTER_THRESHOLD=0)
+    def test_preloaded_bloom_filter_bulk(self):
+        self._check_preloaded(bulk=True)
+
+    def test_preloaded_no_query(self):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg1>"
+        msg.set_payload("msg1")
+        add_to_list("list@example.com", msg)
+        kw = self.common_cmd_args.copy()
+        kw["since"] = None
+        importer = DbImporter(
+            "list@example.com", kw, StringIO(), StringIO())
+        importer.mlist = MailingList.objects.get(name="list@example.com")
+        importer._preload()
+        self.assertIn("dummy@example.com", importer.senders)
+        with self.assertNumQueries(0):
+            self.assertTrue(importer._is_archived("msg1"))
+            self.assertFalse(importer._is_archived("msg2"))
+        with override_settings(HYPERKITTY_IMPORT_BLOOM_FILTER_THRESHOLD=0):
+            importer._preload()
+        self.assertFalse(importer.exact_message_ids)
+        # The filter only gives candidates, the database must confirm them.
+        with self.assertNumQueries(1):
+            self.assertTrue(importer._is_archived("msg1"))
+
+    def _make_compressed(self, name, message_ids):
+        mbox_path = os.path.join(self.tmpdir, "test.mbox")
+        mbox = mailbox.mbox(mbox_path)
+        for message_id in message_ids:
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<%s>" % message_id
+            msg["Date"] = "01 Feb 2015 12:00:00"
+            msg.set_payload(message_id)
+            mbox.add(msg)
+        mbox.close()
+        path = os.path.join(self.tmpdir, name)
+        with open(mbox_path, "rb") as mbox_file:
+            with gzip.open(path, "wb") as compressed:
+                compressed.write(mbox_file.read())
+        os.remove(mbox_path)
+        return path
+
+    def test_compressed(self):
+        path = self._make_compressed("test.mbox.gz", ["msg1", "msg2"])
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        call_command('hyperkitty_import', path, **kw)
+        self.assertEqual(
+            list(Email.objects.order_by("message_id").values_list(
+                "message_id", flat=True)),
+            ["msg1", "msg2"])
+
+    def test_maildir(self):
+        path = os.path.join(self.tmpdir, "Maildir")
+        maildir = mailbox.Maildir(path)
+        for i in range(3):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "01 Feb 2015 12:00:00"
+            msg.set_payload("msg%d" % i)
+            maildir.add(msg)
+        maildir.close()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        call_command('hyperkitty_import', path, jobs=2, **kw)
+        self.assertEqual(
+            list(Email.objects.order_by("message_id").values_list(
+                "message_id", flat=True)),
+            ["msg0", "msg1", "msg2"])
+
+    def test_not_maildir(self):
+        os.mkdir(os.path.join(self.tmpdir, "folder"))
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        with self.assertRaises(CommandError):
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "folder"), **kw)
+
+    def test_pattern(self):
+        # The Pipermail monthly archives are imported in date order.
+        for name in ["2015-March.txt.gz", "2014-December.txt.gz",
+                     "2015-February.txt.gz"]:
+            self._make_compressed(name, [name.split(".")[0]])
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "*.txt.gz"), **kw)
+        self.assertEqual(
+            [line.split()[4] for line in output.getvalue().splitlines()
+             if line.startswith("Importing from")],
+            [os.path.join(self.tmpdir, name) for name in [
+                "2014-December.txt.gz", "2015-February.txt.gz",
+                "2015-March.txt.gz"]])
+        self.assertEqual(Email.objects.count(), 3)
+        with self.assertRaises(CommandError):
+            call_command('hyperkitty_import',
+                         os.path.join(self.tmpdir, "*.mbox"), **kw)
+
+    def test_dry_run(self):
+        self._make_archive(["list@example.com"])
+        MailingList.objects.all().delete()
+        profile_path = os.path.join(self.tmpdir, "import.prof")
+        output = StringIO()
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = output
+        kw["since"] = "2000-01-01"
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"), dry_run=True,
+                     profile=True, profile_output=profile_path, **kw)
+        # Nothing was written to the database.
+        self.assertFalse(MailingList.objects.exists())
+        self.assertFalse(Email.objects.exists())
+        self.assertIn("9 email added to the database", output.getvalue())
+        self.assertRegex(
+            output.getvalue(),
+            r"Read 10 messages \([0-9.]+ MB\) in [0-9.]+ s: [0-9.]+ "
+            r"messages/s, [0-9.]+ MB/s")
+        for stage in ["read", "parse", "prepare", "scrub", "save",
+                      "thread_structure"]:
+            self.assertRegex(
+                output.getvalue(),
+                r"  %s: [0-9.]+ s \([0-9]+%%\), [0-9]+ queries" % stage)
+        stats = pstats.Stats(profile_path)
+        self.assertGreater(stats.total_calls, 0)
+
+    def test_dry_run_options(self):
+        self._make_mbox(1)
+        kw = self.common_cmd_args.copy()
+        kw["stdout"] = kw["stderr"] = StringIO()
+        for option in ["index", "checkpoint"]:
+            with self.assertRaises(CommandError):
+                call_command('hyperkitty_import',
+                             os.path.join(self.tmpdir, "test.mbox"),
+                             dry_run=True, **{option: "checkpoint.json"},
+                             **kw)
+
+
+class SearchIndexTestCase(SearchEnabledTestCase):
+
+    def _check_index(self, **options):
+        mbox = mailbox.mbox(os.path.join(self.tmpdir, "test.mbox"))
+        for i in range(5):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg["Date"] = "01 Feb 2015 12:00:00"
+            msg.set_content("msg%d" % i)
+            if i == 3:
+                msg.add_attachment(b"data", maintype="application",
+                                   subtype="octet-stream", filename="a.bin")
+            mbox.add(msg)
+        mbox.close()
+        call_command('hyperkitty_import',
+                     os.path.join(self.tmpdir, "test.mbox"),
+                     list_address="list@example.com", no_sync_mailman=True,
+                     index=True, batch_size=2, stdout=StringIO(),
+                     stderr=StringIO(), **options)
+        self.assertEqual(
+            sorted(result.object.message_id
+                   for result in SearchQuerySet().all()),
+            ["msg0", "msg1", "msg2", "msg3", "msg4"])
+        # The attachments are indexed.
+        self.assertEqual(
+            [result.object.message_id
+             for result in SearchQuerySet().filter(text="a.bin")],
+            ["msg3"])
+
+    def tearDown(self):
+        settings.HYPERKITTY_BATCH_MODE = False
+
+    def test_index(self):
+        self._check_index()
+
+    def test_index_bulk(self):
+        self._check_index(bulk=True)
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from email.message import EmailMessage
+from io import StringIO
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models.thread import Thread
+from hyperkitty.tests.utils import TestCase
+
+
+class CommandTestCase(TestCase):
+
+    def setUp(self):
+        for list_name in ("list1@example.com", "list2@example.com"):
+            for i in range(3):
+                msg = EmailMessage()
+                msg["From"] = "sender%d@example.com" % i
+                msg["Message-ID"] = "<msg%d>" % i
+                if i:
+                    msg["In-Reply-To"] = "<msg0>"
+                msg.set_payload("message %d" % i)
+                add_to_list(list_name, msg)
+        self.expected = list(Thread.objects.order_by("id").values_list(
+            "emails_count", "participants_count", "last_email_id"))
+        Thread.objects.update(
+            emails_count=0, participants_count=0, last_email=None)
+
+    def _repair(self, *args, **options):
+        output = StringIO()
+        call_command("hyperkitty_repair_counters", *args, stdout=output,
+                     **options)
+        return output.getvalue()
+
+    def test_repair(self):
+        output = self._repair(batch_size=1)
+        self.assertIn("Repaired the counters of 2 threads out of 2.", output)
+        self.assertEqual(
+            list(Thread.objects.order_by("id").values_list(
+                "emails_count", "participants_count", "last_email_id")),
+            self.expected)
+        output = self._repair()
+        self.assertIn("Repaired the counters of 0 threads out of 2.", output)
+
+    def test_repair_list(self):
+        output = self._repair("list2@example.com")
+        self.assertIn("Repaired the counters of 1 threads out of 1.", output)
+        self.assertEqual(
+            Thread.objects.get(
+                mailinglist__name="list2@example.com").emails_count, 3)
+        self.assertEqual(
+            Thread.objects.get(
+                mailinglist__name="list1@example.com").emails_count, 0)
+
+    def test_unknown_list(self):
+        with self.assertRaises(CommandError):
+            self._repair("list3@example.com")
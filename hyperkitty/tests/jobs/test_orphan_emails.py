@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from email.message import EmailMessage
+from unittest.mock import patch
+
+from hyperkitty.jobs.orphan_emails import Job
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models import Email, PendingReply
+from hyperkitty.tests.utils import TestCase
+
+
+def _make_msg(msgid, in_reply_to=None):
+    msg = EmailMessage()
+    msg["From"] = "person@example.com"
+    msg["Message-ID"] = "<%s>" % msgid
+    if in_reply_to is not None:
+        msg["In-Reply-To"] = "<%s>" % in_reply_to
+    msg.set_payload("Dummy message")
+    return msg
+
+
+class OrphanEmailsJobTestCase(TestCase):
+
+    def test_reattach(self):
+        with patch("hyperkitty.tasks.check_orphans"):
+            add_to_list("example-list", _make_msg("msg2", "msg1"))
+            add_to_list("example-list", _make_msg("msg3", "unknown"))
+            add_to_list("example-list", _make_msg("msg1"))
+        self.assertEqual(PendingReply.objects.count(), 2)
+        Job().execute()
+        orphan = Email.objects.get(message_id="msg2")
+        parent = Email.objects.get(message_id="msg1")
+        self.assertEqual(orphan.parent_id, parent.id)
+        self.assertEqual(orphan.thread_id, parent.thread_id)
+        # The reply to the unknown email is still waiting
+        self.assertEqual(
+            list(PendingReply.objects.values_list(
+                "email__message_id", flat=True)),
+            ["msg3"])
+
+    def test_other_list(self):
+        # The parent must be in the same list
+        with patch("hyperkitty.tasks.check_orphans"):
+            add_to_list("example-list", _make_msg("msg2", "msg1"))
+            add_to_list("other-list", _make_msg("msg1"))
+        Job().execute()
+        self.assertIsNone(Email.objects.get(message_id="msg2").parent_id)
+        self.assertEqual(PendingReply.objects.count(), 1)
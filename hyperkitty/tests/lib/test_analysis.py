@@ -20,11 +20,14 @@
 # Author: Aurelien Bompard <abompard@fedoraproject.org>
 #
 
+from datetime import timedelta
 from email.message import EmailMessage
+from unittest.mock import patch
 
 from django.utils.timezone import now
 
-from hyperkitty.lib.analysis import compute_thread_order_and_depth
+from hyperkitty.lib.analysis import (
+    add_to_thread_order, compute_thread_order_and_depth)
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import Email, MailingList, Sender, Thread
 from hyperkitty.tests.utils import TestCase
@@ -187,3 +190,173 @@ class TestThreadOrderDepth(TestCase):
         msg1.save()
         compute_thread_order_and_depth(thread)
         # Don't traceback with a "maximum recursion depth exceeded" error
+
+    def test_reply_loop_positions(self):
+        # msg1 is the starting email, but claims to reply to msg2.
+        thread = Thread.objects.create(
+            mailinglist=self.mlist, thread_id="msg1")
+        msg1 = self.make_fake_email(1, thread=thread)
+        msg1.save()
+        thread.starting_email = msg1
+        thread.save()
+        msg2 = self.make_fake_email(2, thread=thread)
+        msg2.parent = msg1
+        msg2.save()
+        msg1.parent = msg2
+        msg1.save()
+        compute_thread_order_and_depth(thread)
+        msg1.refresh_from_db()
+        msg2.refresh_from_db()
+        self.assertEqual((msg1.thread_order, msg1.thread_depth), (0, 0))
+        self.assertEqual((msg2.thread_order, msg2.thread_depth), (1, 1))
+
+    def test_deep_thread(self):
+        # Each email replies to the previous one, deeper than the recursion
+        # limit.
+        thread = Thread.objects.create(
+            mailinglist=self.mlist, thread_id="msg0")
+        sender = Sender.objects.create(address="sender@example.com")
+        date = now()
+        emails = Email.objects.bulk_create([
+            Email(mailinglist=self.mlist, message_id="msg%d" % num,
+                  subject="subject", content="message", sender=sender,
+                  thread=thread, date=date, timezone=0)
+            for num in range(1500)])
+        for parent, email in zip(emails, emails[1:]):
+            email.parent = parent
+        Email.objects.bulk_update(emails[1:], ["parent"])
+        thread.starting_email = emails[0]
+        thread.save()
+        compute_thread_order_and_depth(thread)
+        last = Email.objects.get(message_id="msg1499")
+        self.assertEqual(last.thread_order, 1499)
+        self.assertEqual(last.thread_depth, 1499)
+
+    def test_only_changed_rows_saved(self):
+        thread = Thread.objects.create(
+            mailinglist=self.mlist, thread_id="msg1")
+        msg1 = self.make_fake_email(1, thread=thread)
+        msg1.save()
+        thread.starting_email = msg1
+        thread.save()
+        msg2 = self.make_fake_email(2, thread=thread)
+        msg2.parent = msg1
+        msg2.save()
+        compute_thread_order_and_depth(thread)
+        # Everything is already in place: only the read query.
+        with self.assertNumQueries(1):
+            compute_thread_order_and_depth(thread)
+
+
+class TestAddToThreadOrder(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList.objects.create(name="example-list")
+        self.sender = Sender.objects.create(address="sender@example.com")
+        self.thread = Thread.objects.create(
+            mailinglist=self.mlist, thread_id="msg1")
+        self.date = now() - timedelta(days=1)
+        # Compute the positions explicitly in the tests.
+        patcher = patch("hyperkitty.tasks.compute_thread_positions")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_email(self, num, parent=None, minutes=None):
+        if minutes is None:
+            minutes = num
+        email = Email.objects.create(
+            mailinglist=self.mlist, message_id="msg%d" % num,
+            subject="subject %d" % num, content="message %d" % num,
+            sender=self.sender, thread=self.thread, parent=parent,
+            date=self.date + timedelta(minutes=minutes), timezone=0)
+        if parent is None:
+            self.thread.starting_email = email
+            self.thread.save()
+        return email
+
+    def get_positions(self):
+        return list(self.thread.emails.order_by("id").values_list(
+            "message_id", "thread_order", "thread_depth"))
+
+    def test_leaf_reply(self):
+        # msg1
+        # |-msg2
+        # | |-msg4
+        # | `-msg5 (new)
+        # `-msg3
+        msg1 = self.make_email(1)
+        msg2 = self.make_email(2, parent=msg1)
+        self.make_email(3, parent=msg1)
+        self.make_email(4, parent=msg2)
+        compute_thread_order_and_depth(self.thread)
+        self.make_email(5, parent=msg2)
+        with self.assertNumQueries(10):
+            self.assertTrue(add_to_thread_order(self.thread))
+        positions = self.get_positions()
+        self.assertEqual(positions, [
+            ("msg1", 0, 0), ("msg2", 1, 1), ("msg3", 4, 1), ("msg4", 2, 2),
+            ("msg5", 3, 2),
+        ])
+        # Same result as the full computation
+        compute_thread_order_and_depth(self.thread)
+        self.assertEqual(self.get_positions(), positions)
+
+    def test_reply_at_the_end(self):
+        msg1 = self.make_email(1)
+        msg2 = self.make_email(2, parent=msg1)
+        compute_thread_order_and_depth(self.thread)
+        self.make_email(3, parent=msg2)
+        self.make_email(4, parent=msg1)
+        self.assertTrue(add_to_thread_order(self.thread))
+        positions = self.get_positions()
+        self.assertEqual(positions, [
+            ("msg1", 0, 0), ("msg2", 1, 1), ("msg3", 2, 2), ("msg4", 3, 1),
+        ])
+        compute_thread_order_and_depth(self.thread)
+        self.assertEqual(self.get_positions(), positions)
+
+    def test_nothing_new(self):
+        msg1 = self.make_email(1)
+        self.make_email(2, parent=msg1)
+        compute_thread_order_and_depth(self.thread)
+        self.assertTrue(add_to_thread_order(self.thread))
+
+    def test_older_than_sibling(self):
+        # The new email was sent before its sibling, it must be inserted in
+        # the middle of its parent's replies.
+        msg1 = self.make_email(1)
+        self.make_email(2, parent=msg1)
+        compute_thread_order_and_depth(self.thread)
+        self.make_email(3, parent=msg1, minutes=0)
+        self.assertFalse(add_to_thread_order(self.thread))
+
+    def test_not_a_leaf(self):
+        # A reply to the new email was already archived.
+        msg1 = self.make_email(1)
+        compute_thread_order_and_depth(self.thread)
+        msg2 = self.make_email(2, parent=msg1)
+        self.make_email(3, parent=msg2)
+        Email.objects.filter(message_id="msg3").update(thread_order=1)
+        self.assertFalse(add_to_thread_order(self.thread))
+
+    def test_parent_without_position(self):
+        msg1 = self.make_email(1)
+        self.make_email(2, parent=msg1)
+        self.assertFalse(add_to_thread_order(self.thread))
+
+    def test_starting_email(self):
+        self.make_email(1)
+        self.assertFalse(add_to_thread_order(self.thread))
+
+    def test_task_fallback(self):
+        from hyperkitty.tasks import _compute_thread_positions
+        msg1 = self.make_email(1)
+        compute_thread_order_and_depth(self.thread)
+        self.make_email(2, parent=msg1)
+        with patch("hyperkitty.tasks.compute_thread_order_and_depth") as ctod:
+            _compute_thread_positions(self.thread.id)
+        self.assertFalse(ctod.called)
+        self.make_email(3, parent=msg1, minutes=0)
+        with patch("hyperkitty.tasks.compute_thread_order_and_depth") as ctod:
+            _compute_thread_positions(self.thread.id)
+        self.assertEqual(ctod.call_count, 1)
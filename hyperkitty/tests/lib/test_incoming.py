@@ -26,15 +26,23 @@ from email import message_from_file
 from email.message import EmailMessage
 from email.policy import default
 from unittest.mock import Mock, patch
+from urllib.error import HTTPError
 
 from django.core.cache import cache
 from django.db import DataError, IntegrityError
 from django.utils import timezone
 
-from hyperkitty.lib.incoming import DuplicateMessage, add_to_list
+from django_mailman3.signals import mailinglist_modified
+
+from hyperkitty.lib import incoming, metrics
+from hyperkitty.lib.incoming import (
+    SUPPRESSED_COUNTERS, DuplicateMessage, add_many_to_list, add_to_list,
+    parse_message, store_email)
 from hyperkitty.lib.utils import get_message_id_hash
-from hyperkitty.models import Attachment, Email, MailingList, Thread
-from hyperkitty.tests.utils import TestCase, get_test_file
+from hyperkitty.models import (
+    ArchivePolicy, Attachment, Email, MailingList, PendingReply,
+    Sender, Thread)
+from hyperkitty.tests.utils import TestCase, get_test_file, make_message
 
 
 class TestAddToList(TestCase):
@@ -466,6 +474,35 @@ class TestAddToList(TestCase):
         orphan = Email.objects.get(id=orphan.id)  # Refresh the instance
         parent = Email.objects.filter(message_id="msg1").first()
         self.assertEqual(orphan.parent_id, parent.id)
+        self.assertFalse(PendingReply.objects.exists())
+
+    def test_pending_reply(self):
+        msg = EmailMessage()
+        msg["From"] = "person@example.com"
+        msg["Message-ID"] = "<msg2>"
+        msg["In-Reply-To"] = "<msg1>"
+        msg.set_payload("Second message")
+        add_to_list("example-list", msg)
+        pending = PendingReply.objects.get()
+        self.assertEqual(pending.mailinglist.name, "example-list")
+        self.assertEqual(pending.in_reply_to, "msg1")
+        self.assertEqual(pending.email.message_id, "msg2")
+
+    def test_pending_reply_not_created(self):
+        # The parent is known, or the email replies to itself
+        msg1 = EmailMessage()
+        msg1["From"] = "person@example.com"
+        msg1["Message-ID"] = "<msg1>"
+        msg1["In-Reply-To"] = "<msg1>"
+        msg1.set_payload("First message")
+        add_to_list("example-list", msg1)
+        msg2 = EmailMessage()
+        msg2["From"] = "person@example.com"
+        msg2["Message-ID"] = "<msg2>"
+        msg2["In-Reply-To"] = "<msg1>"
+        msg2.set_payload("Second message")
+        add_to_list("example-list", msg2)
+        self.assertFalse(PendingReply.objects.exists())
 
     def test_archived_date(self):
         msg = EmailMessage()
@@ -499,9 +536,9 @@ class TestAddToList(TestCase):
     def test_rebuild_recent_threads_cache(self):
         # The recent threads cache must be rebuilt when a new message arrives.
         mlist = MailingList.objects.create(name="example-list")
-        cache.set("MailingList:%s:recent_threads" % mlist.pk, [42])
-        cache.set("MailingList:%s:recent_threads_count" % mlist.pk,
-                  "test-value")
+        cache_key = mlist.cached_values["recent_threads"]._get_cache_key()
+        cache.set(cache_key, [42])
+        cache.set("%s_count" % cache_key, "test-value")
         msg = EmailMessage()
         msg["From"] = "dummy@example.com"
         msg["Subject"] = "Fake Subject"
@@ -509,11 +546,10 @@ class TestAddToList(TestCase):
         msg.set_payload("Fake Message")
         m_hash = add_to_list("example-list", msg)
         thread = Thread.objects.get(thread_id=m_hash)
-        cached_value = cache.get("MailingList:%s:recent_threads" % mlist.pk)
+        cached_value = cache.get(cache_key)
         self.assertListEqual(list(cached_value), [thread.id])
         self.assertEqual(mlist.recent_threads[0].thread_id, m_hash)
-        self.assertEqual(
-            cache.get("MailingList:%s:recent_threads_count" % mlist.pk), 1)
+        self.assertEqual(cache.get("%s_count" % cache_key), 1)
 
     def test_existing_thread(self):
         msg = EmailMessage()
@@ -554,3 +590,223 @@ class TestAddToList(TestCase):
             filter_mock.exists.return_value = False
             Email.objects.filter.return_value = filter_mock
             self.assertRaises(ValueError, add_to_list, "example-list", msg)
+
+
+class TestParseMessage(TestCase):
+
+    def test_parse_and_store(self):
+        msg = EmailMessage()
+        msg["From"] = "Dummy Sender <dummy@example.com>"
+        msg["Message-ID"] = "<msg2>"
+        msg["In-Reply-To"] = "<msg1>"
+        msg["Subject"] = "Dummy subject"
+        msg["Date"] = "Fri, 02 Nov 2012 16:07:54 +0100"
+        msg.set_content("Dummy message")
+        msg.add_attachment(b"data", maintype="application",
+                           subtype="octet-stream", filename="a.bin")
+        with self.assertNumQueries(0):
+            parsed = parse_message(msg)
+        self.assertEqual(parsed.message_id, "msg2")
+        self.assertEqual(parsed.in_reply_to, "msg1")
+        self.assertEqual(parsed.sender_name, "Dummy Sender")
+        self.assertEqual(parsed.sender_address, "dummy@example.com")
+        self.assertEqual(parsed.timezone, 60)
+        self.assertEqual(len(parsed.attachments), 1)
+        mlist = MailingList.objects.create(name="example-list")
+        email = store_email(mlist, parsed)
+        self.assertEqual(email.subject, "Dummy subject")
+        self.assertEqual(email.sender.address, "dummy@example.com")
+        self.assertEqual(email.attachments.count(), 1)
+        self.assertTrue(PendingReply.objects.filter(email=email).exists())
+
+    def test_no_message_id(self):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg.set_payload("Dummy message")
+        self.assertRaises(ValueError, parse_message, msg)
+
+
+class TestAddManyToList(TestCase):
+
+    def test_basic(self):
+        messages = [make_message("msg%d" % i) for i in range(3)]
+        results = add_many_to_list("example-list", messages)
+        self.assertEqual(
+            results, [get_message_id_hash("msg%d" % i) for i in range(3)])
+        self.assertEqual(Email.objects.count(), 3)
+        self.assertEqual(MailingList.objects.count(), 1)
+
+    def test_shared_lookups(self):
+        messages = [make_message("msg%d" % i) for i in range(3)]
+        with patch("hyperkitty.lib.incoming.sender_mailman_id") as smi, \
+                patch("hyperkitty.lib.incoming.update_from_mailman") as ufm:
+            add_many_to_list("example-list", messages)
+        self.assertEqual(smi.call_count, 1)
+        self.assertEqual(ufm.call_count, 1)
+
+    def test_errors(self):
+        no_msgid = EmailMessage()
+        no_msgid["From"] = "dummy@example.com"
+        no_msgid.set_payload("Fake Message")
+        messages = [
+            make_message("msg1"),
+            no_msgid,
+            make_message("msg1"),
+            make_message("msg2"),
+        ]
+        results = add_many_to_list("example-list", messages)
+        self.assertEqual(results[0], get_message_id_hash("msg1"))
+        self.assertIsInstance(results[1], ValueError)
+        self.assertIsInstance(results[2], DuplicateMessage)
+        self.assertEqual(results[3], get_message_id_hash("msg2"))
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_unexpected_error(self):
+        messages = [make_message("msg%d" % i) for i in range(3)]
+        parse_message = incoming.parse_message
+
+        def _parse_message(message, timer=None):
+            if message["Message-ID"] == "<msg1>":
+                raise DataError("value too long")
+            return parse_message(message, timer)
+
+        with patch("hyperkitty.lib.incoming.parse_message", _parse_message):
+            results = add_many_to_list("example-list", messages)
+        self.assertEqual(results[0], get_message_id_hash("msg0"))
+        self.assertIsInstance(results[1], DataError)
+        self.assertEqual(results[2], get_message_id_hash("msg2"))
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_tasks_queued_on_commit(self):
+        messages = [make_message("msg%d" % i) for i in range(3)]
+        with patch("hyperkitty.tasks.AsyncTask") as AsyncTask:
+            with self.captureOnCommitCallbacks() as callbacks:
+                add_many_to_list("example-list", messages)
+            self.assertFalse(AsyncTask.return_value.run.called)
+            for callback in callbacks:
+                callback()
+            self.assertTrue(AsyncTask.return_value.run.called)
+
+    def test_archiving_disabled(self):
+        MailingList.objects.create(
+            name="example-list", archive_policy=ArchivePolicy.never.value)
+        results = add_many_to_list(
+            "example-list", [make_message("msg1")])
+        self.assertEqual(results, [None])
+        self.assertEqual(Email.objects.count(), 0)
+
+
+class TestLookupCaches(TestCase):
+
+    def test_cached_lookups(self):
+        MailingList.objects.create(name="example-list")
+        Sender.objects.create(address="dummy@example.com")
+        add_to_list("example-list", make_message("msg1"))
+        with patch("hyperkitty.lib.incoming.MailingList") as ml_mock, \
+                patch("hyperkitty.lib.incoming.Sender") as sender_mock:
+            add_to_list("example-list", make_message("msg2"))
+        self.assertFalse(ml_mock.objects.get_or_create.called)
+        self.assertFalse(sender_mock.objects.get_or_create.called)
+        self.assertEqual(Email.objects.count(), 2)
+
+    def test_no_mailinglist_save(self):
+        mlist = MailingList.objects.create(name="example-list")
+        add_to_list("example-list", make_message("msg1"))
+        with patch.object(MailingList, "save") as save_mock:
+            add_to_list("example-list", make_message("msg2"))
+        self.assertFalse(save_mock.called)
+        mlist.refresh_from_db()
+        self.assertEqual(mlist.list_id, "example-list")
+
+    def test_created_rows_cached_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            add_to_list("example-list", make_message("msg1"))
+        # The list and the sender were created, they will only be cached
+        # after the transaction is committed.
+        self.assertIsNone(incoming._mailinglist_cache.get("example-list"))
+        self.assertIsNone(incoming._sender_cache.get("dummy@example.com"))
+        for callback in callbacks:
+            callback()
+        self.assertIsNotNone(incoming._mailinglist_cache.get("example-list"))
+        self.assertIsNotNone(incoming._sender_cache.get("dummy@example.com"))
+
+    def test_invalidate_on_save(self):
+        mlist = MailingList.objects.create(name="example-list")
+        add_to_list("example-list", make_message("msg1"))
+        self.assertIsNotNone(incoming._mailinglist_cache.get("example-list"))
+        mlist.archive_policy = ArchivePolicy.never.value
+        mlist.save()
+        self.assertIsNone(incoming._mailinglist_cache.get("example-list"))
+        add_to_list("example-list", make_message("msg2"))
+        self.assertFalse(Email.objects.filter(message_id="msg2").exists())
+
+    def test_invalidate_on_delete(self):
+        mlist = MailingList.objects.create(name="example-list")
+        add_to_list("example-list", make_message("msg1"))
+        mlist.delete()
+        self.assertIsNone(incoming._mailinglist_cache.get("example-list"))
+
+    @patch("hyperkitty.signals.import_list_from_mailman")
+    def test_invalidate_on_mailinglist_modified(self, mock_ilfm):
+        MailingList.objects.create(name="example-list")
+        add_to_list("example-list", make_message("msg1"))
+        mailinglist_modified.send(sender="Postorius", list_id="example-list")
+        self.assertIsNone(incoming._mailinglist_cache.get("example-list"))
+
+
+class TestMailmanThrottling(TestCase):
+
+    def test_update_from_mailman_throttled(self):
+        # The sender is not found in Mailman.
+        self.mailman_client.get_user.side_effect = HTTPError(
+            "url", 404, "Not Found", {}, None)
+        with patch("hyperkitty.lib.incoming.update_from_mailman") as ufm:
+            for i in range(3):
+                add_to_list("example-list", make_message("msg%d" % i))
+        self.assertEqual(ufm.call_count, 1)
+        self.assertEqual(
+            metrics.get_counters(SUPPRESSED_COUNTERS), {
+                "update_from_mailman_suppressed": 2,
+                "sender_mailman_id_suppressed": 2,
+            })
+
+    def test_update_from_mailman_not_throttled(self):
+        self._override_setting("HYPERKITTY_MAILMAN_LIST_REFRESH_INTERVAL", 0)
+        with patch("hyperkitty.lib.incoming.update_from_mailman") as ufm:
+            for i in range(3):
+                add_to_list("example-list", make_message("msg%d" % i))
+        self.assertEqual(ufm.call_count, 3)
+
+    def test_sender_with_mailman_id(self):
+        Sender.objects.create(address="dummy@example.com", mailman_id="dummy")
+        with patch("hyperkitty.lib.incoming.sender_mailman_id") as smi:
+            add_to_list("example-list", make_message("msg1"))
+        self.assertFalse(smi.called)
+
+    def test_sender_negative_cache(self):
+        with patch("hyperkitty.lib.incoming.sender_mailman_id") as smi:
+            add_to_list("list1@example.com", make_message("msg1"))
+            add_to_list("list2@example.com", make_message("msg2"))
+            add_to_list("list1@example.com", make_message(
+                "msg3", sender="other@example.com"))
+        self.assertEqual(smi.call_count, 2)
+        self.assertEqual(
+            [c[0][0] for c in smi.call_args_list],
+            ["dummy@example.com", "other@example.com"])
+
+    def test_sender_mailman_unreachable(self):
+        # When Mailman can't be reached, the sender is looked up again with
+        # the next email.
+        for i in range(2):
+            add_to_list("example-list", make_message("msg%d" % i))
+        self.assertEqual(self.mailman_client.get_user.call_count, 2)
+        self.assertEqual(
+            metrics.get_counters(["sender_mailman_id_suppressed"]),
+            {"sender_mailman_id_suppressed": 0})
+
+    def test_sender_not_found(self):
+        self.mailman_client.get_user.side_effect = HTTPError(
+            "url", 404, "Not Found", {}, None)
+        for i in range(2):
+            add_to_list("example-list", make_message("msg%d" % i))
+        self.assertEqual(self.mailman_client.get_user.call_count, 1)
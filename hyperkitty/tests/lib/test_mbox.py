@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+import lzma
+import mailbox
+import os
+from email.message import EmailMessage
+from io import BytesIO
+
+from hyperkitty.lib.mbox import (
+    CompressedMboxReader, MaildirReader, MboxReader, MboxStreamReader,
+    open_mailbox, parse_mbox_message)
+from hyperkitty.tests.utils import TestCase
+
+
+def _make_mbox(path):
+    # Return the messages as mailbox.mbox reads them.
+    mbox = mailbox.mbox(path)
+    for i in range(3):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg%d>" % i
+        msg.set_payload(">From the body\nmsg%d\n" % i)
+        mbox.add(msg)
+    mbox.close()
+    mbox = mailbox.mbox(path)
+    messages = [mbox.get_bytes(key, from_=True) for key in mbox.keys()]
+    mbox.close()
+    return messages
+
+
+class MboxReaderTestCase(TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(self.tmpdir, "test.mbox")
+
+    def _read(self):
+        with MboxReader(self.path) as mbox:
+            return [bytes(mbox.view(start, end)) for start, end in mbox]
+
+    def test_same_as_mailbox(self):
+        expected = _make_mbox(self.path)
+        self.assertEqual(self._read(), expected)
+
+    def test_no_empty_line(self):
+        # Like mailbox.mbox, a From line starts a new message even if it does
+        # not follow an empty line.
+        with open(self.path, "wb") as f:
+            f.write(b"garbage\nFrom a@example.com Mon Jul 21 11:44:51 2008\n"
+                    b"Subject: 1\n\nbody\nFrom b@example.com\n\nbody\n")
+        self.assertEqual(self._read(), [
+            b"From a@example.com Mon Jul 21 11:44:51 2008\nSubject: 1\n\n"
+            b"body\n",
+            b"From b@example.com\n\nbody\n",
+        ])
+
+    def test_empty(self):
+        open(self.path, "wb").close()
+        self.assertEqual(self._read(), [])
+        with open(self.path, "wb") as f:
+            f.write(b"not a mbox file\n")
+        self.assertEqual(self._read(), [])
+
+    def test_parse(self):
+        message = parse_mbox_message(memoryview(
+            b"From a@example.com Mon Jul 21 11:44:51 2008\n"
+            b"Message-ID: <msg>\nSubject: caf\xc3\xa9\n\nbody\n"))
+        self.assertEqual(message.get_unixfrom(),
+                         "From a@example.com Mon Jul 21 11:44:51 2008")
+        self.assertEqual(message["Message-ID"], "<msg>")
+        self.assertEqual(message.get_content(), "body\n")
+
+
+class CompressedMboxReaderTestCase(TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(self.tmpdir, "test.mbox")
+
+    def _compress(self, module, extension):
+        expected = _make_mbox(self.path)
+        with open(self.path, "rb") as mbox_file:
+            with module.open(self.path + extension, "wb") as compressed:
+                compressed.write(mbox_file.read())
+        return expected
+
+    def test_same_as_mailbox(self):
+        for module, extension in [(gzip, ".gz"), (lzma, ".xz")]:
+            expected = self._compress(module, extension)
+            with open_mailbox(self.path + extension) as mbox:
+                self.assertIsInstance(mbox, CompressedMboxReader)
+                self.assertEqual(
+                    [data for end, data in mbox.read()], expected)
+            os.remove(self.path)
+
+    def test_offsets(self):
+        # The offsets are the same as in the decompressed file.
+        self._compress(gzip, ".gz")
+        with MboxReader(self.path) as mbox:
+            expected = [end for start, end in mbox]
+        with open_mailbox(self.path + ".gz") as mbox:
+            ends = [end for end, data in mbox.read()]
+            self.assertEqual(ends, expected)
+            self.assertEqual(
+                [end for end, data in mbox.read(ends[0])], ends[1:])
+
+
+class MboxStreamReaderTestCase(TestCase):
+
+    def test_same_as_mbox_reader(self):
+        path = os.path.join(self.tmpdir, "test.mbox")
+        expected = _make_mbox(path)
+        with MboxReader(path) as mbox:
+            ends = [end for start, end in mbox]
+        with open(path, "rb") as mbox_file:
+            reader = MboxStreamReader(BytesIO(mbox_file.read()))
+        self.assertEqual(list(reader.read()), list(zip(ends, expected)))
+
+
+class MaildirReaderTestCase(TestCase):
+
+    def test_read(self):
+        path = os.path.join(self.tmpdir, "Maildir")
+        maildir = mailbox.Maildir(path)
+        for i in range(3):
+            msg = EmailMessage()
+            msg["From"] = "dummy@example.com"
+            msg["Message-ID"] = "<msg%d>" % i
+            msg.set_payload("msg%d" % i)
+            maildir.add(msg)
+        maildir.close()
+        with open_mailbox(path) as mbox:
+            self.assertIsInstance(mbox, MaildirReader)
+            self.assertEqual(mbox.size, 3)
+            messages = list(mbox.read())
+            self.assertEqual([end for end, data in mbox.read(1)], [2, 3])
+        self.assertEqual([end for end, data in messages], [1, 2, 3])
+        self.assertEqual(
+            sorted(parse_mbox_message(data)["Message-ID"]
+                   for end, data in messages),
+            ["<msg0>", "<msg1>", "<msg2>"])
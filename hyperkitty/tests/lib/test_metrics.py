@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from email.message import EmailMessage
+
+from django.core.cache import cache
+from django.test import override_settings
+
+from hyperkitty.lib import metrics
+from hyperkitty.lib.incoming import STAGES, add_to_list
+from hyperkitty.models import MailingList
+from hyperkitty.tests.utils import TestCase
+
+
+class PercentileTestCase(TestCase):
+
+    def test_percentile(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(metrics.percentile(values, 50), 50)
+        self.assertEqual(metrics.percentile(values, 95), 95)
+        self.assertEqual(metrics.percentile(values, 100), 100)
+        self.assertEqual(metrics.percentile([3], 95), 3)
+
+    def test_percentile_empty(self):
+        self.assertIsNone(metrics.percentile([], 50))
+
+
+class TimerTestCase(TestCase):
+
+    def test_stage(self):
+        collector = metrics.MemoryCollector()
+        timer = metrics.Timer([collector])
+        with timer.stage("test"):
+            MailingList.objects.count()
+            MailingList.objects.count()
+        with timer.stage("test"):
+            pass
+        self.assertEqual(len(collector.samples["test"]), 2)
+        self.assertEqual(
+            [queries for duration, queries in collector.samples["test"]],
+            [2, 0])
+        stats = collector.get_stats()["test"]
+        self.assertEqual(stats["count"], 2)
+        self.assertEqual(stats["queries_p95"], 2)
+        self.assertGreaterEqual(stats["p95"], stats["p50"])
+
+    def test_no_collector(self):
+        timer = metrics.Timer([])
+        with timer.stage("test"):
+            pass
+
+    @override_settings(HYPERKITTY_METRICS_COLLECTORS=[
+        "hyperkitty.lib.metrics.LoggingCollector",
+        "hyperkitty.lib.metrics.CacheCollector"])
+    def test_collectors_setting(self):
+        timer = metrics.Timer()
+        self.assertEqual(
+            [type(c) for c in timer.collectors],
+            [metrics.LoggingCollector, metrics.CacheCollector])
+
+    def test_archiving_stages(self):
+        collector = metrics.MemoryCollector()
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg>"
+        msg.set_payload("Dummy message")
+        add_to_list("example-list", msg,
+                    timer=metrics.Timer([collector]))
+        self.assertEqual(set(collector.samples), set(STAGES))
+
+    @override_settings(HYPERKITTY_METRICS_SAMPLES=10)
+    def test_memory_bounded(self):
+        # The number of samples kept in memory is bounded, but the count and
+        # the totals are exact.
+        collector = metrics.MemoryCollector()
+        for i in range(100):
+            collector.record("test", 1.0, i)
+        self.assertEqual(len(collector.samples["test"]), 10)
+        stats = collector.get_stats()["test"]
+        self.assertEqual(stats["count"], 100)
+        self.assertEqual(stats["total"], 100.0)
+        self.assertEqual(stats["queries_total"], sum(range(100)))
+        self.assertEqual(stats["p95"], 1.0)
+
+
+class CacheCollectorTestCase(TestCase):
+
+    def setUp(self):
+        metrics.CacheCollector.flush()
+        cache.clear()
+
+    @override_settings(HYPERKITTY_METRICS_SAMPLES=3)
+    def test_rolling(self):
+        collector = metrics.CacheCollector()
+        for i in range(5):
+            collector.record("test", float(i), i)
+        metrics.CacheCollector.flush()
+        stats = metrics.get_cached_stats(["test", "other"])
+        self.assertEqual(list(stats), ["test"])
+        self.assertEqual(stats["test"]["count"], 3)
+        self.assertEqual(stats["test"]["p50"], 3.0)
+        self.assertEqual(stats["test"]["queries_p95"], 4)
+
+    @override_settings(HYPERKITTY_METRICS_FLUSH_INTERVAL=3600)
+    def test_flush_interval(self):
+        # The samples are written to the cache in batches.
+        collector = metrics.CacheCollector()
+        for i in range(5):
+            collector.record("test", float(i), i)
+        self.assertIsNone(cache.get(metrics.TIMINGS_KEY % "test"))
+        metrics.CacheCollector.flush()
+        self.assertEqual(len(cache.get(metrics.TIMINGS_KEY % "test")), 5)
+        collector.record("test", 5.0, 5)
+        # The statistics include the samples of the current process.
+        self.assertEqual(
+            metrics.get_cached_stats(["test"])["test"]["count"], 6)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+#
+
+import os
+from email.message import EmailMessage
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.db import OperationalError
+
+from flufl.lock import Lock
+
+from hyperkitty.lib import spool
+from hyperkitty.lib.spool import (
+    FAILED_DIR, LOCK_LIFETIME, drain_spool, spool_message)
+from hyperkitty.models import Email
+from hyperkitty.tests.utils import TestCase, make_message
+
+
+class SpoolTestCase(TestCase):
+
+    def setUp(self):
+        self.spool_dir = os.path.join(self.tmpdir, "spool")
+        self._override_setting("HYPERKITTY_ARCHIVE_SPOOL_DIR", self.spool_dir)
+
+    def _spooled_files(self, list_name="list@example.com"):
+        list_dir = os.path.join(self.spool_dir, list_name)
+        if not os.path.exists(list_dir):
+            return []
+        return sorted(os.listdir(list_dir))
+
+    def test_spool_message(self):
+        path = spool_message(
+            "list@example.com", make_message("msg1").as_bytes())
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(self._spooled_files(), [os.path.basename(path)])
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), make_message("msg1").as_bytes())
+
+    def test_spool_invalid_list_name(self):
+        for list_name in ("../list@example.com", "list", "list@ex/ample"):
+            self.assertRaises(
+                ValueError, spool_message, list_name, b"dummy")
+
+    def test_drain(self):
+        for i in range(5):
+            spool_message(
+                "list@example.com", make_message("msg%d" % i).as_bytes())
+        self.assertEqual(drain_spool(batch_size=2), 5)
+        self.assertEqual(self._spooled_files(), [])
+        self.assertEqual(
+            list(Email.objects.order_by("id").values_list(
+                "message_id", flat=True)),
+            ["msg%d" % i for i in range(5)])
+
+    def test_drain_failed(self):
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg.set_payload("No Message-ID")
+        spool_message("list@example.com", msg.as_bytes())
+        spool_message("list@example.com", make_message("msg1").as_bytes())
+        self.assertEqual(drain_spool(), 2)
+        self.assertEqual(self._spooled_files(), [])
+        self.assertEqual(Email.objects.count(), 1)
+        self.assertEqual(
+            len(os.listdir(os.path.join(
+                self.spool_dir, FAILED_DIR, "list@example.com"))), 1)
+
+    def test_drain_database_error(self):
+        spool_message("list@example.com", make_message("msg1").as_bytes())
+        with patch("hyperkitty.lib.spool.add_many_to_list") as amtl:
+            amtl.side_effect = OperationalError("database is down")
+            self.assertEqual(drain_spool(), 0)
+        # The message is still in the spool.
+        self.assertEqual(len(self._spooled_files()), 1)
+        self.assertEqual(drain_spool(), 1)
+        self.assertEqual(Email.objects.count(), 1)
+
+    def test_drain_database_error_closes_connection(self):
+        spool_message("list@example.com", make_message("msg1").as_bytes())
+        with patch("hyperkitty.lib.spool.add_many_to_list") as amtl, \
+                patch("hyperkitty.lib.spool.close_old_connections") as coc:
+            amtl.side_effect = OperationalError("database is down")
+            drain_spool()
+        self.assertEqual(coc.call_count, 1)
+
+    def test_drain_command_database_error(self):
+        # The command keeps running when the database is unavailable.
+        spool_message("list@example.com", make_message("msg1").as_bytes())
+        with patch("hyperkitty.lib.spool.add_many_to_list") as amtl, \
+                patch("hyperkitty.management.commands.hyperkitty_drain_spool"
+                      ".close_old_connections") as coc:
+            amtl.side_effect = OperationalError("database is down")
+            call_command("hyperkitty_drain_spool", once=True, verbosity=0)
+        self.assertEqual(len(self._spooled_files()), 1)
+        self.assertEqual(coc.call_count, 1)
+
+    def test_drain_unexpected_error(self):
+        for i in range(3):
+            spool_message(
+                "list@example.com", make_message("msg%d" % i).as_bytes())
+        message_from_bytes = spool.message_from_bytes
+
+        def _message_from_bytes(data, **kwargs):
+            if b"<msg1>" in data:
+                raise LookupError("unknown encoding")
+            return message_from_bytes(data, **kwargs)
+
+        with patch("hyperkitty.lib.spool.message_from_bytes",
+                   _message_from_bytes):
+            self.assertEqual(drain_spool(), 3)
+        self.assertEqual(self._spooled_files(), [])
+        self.assertEqual(
+            sorted(Email.objects.values_list("message_id", flat=True)),
+            ["msg0", "msg2"])
+        self.assertEqual(
+            len(os.listdir(os.path.join(
+                self.spool_dir, FAILED_DIR, "list@example.com"))), 1)
+
+    def test_drain_locked(self):
+        spool_message("list@example.com", make_message("msg1").as_bytes())
+        lock = Lock(os.path.join(self.spool_dir, ".lock"))
+        with lock:
+            self.assertEqual(drain_spool(), 0)
+        self.assertEqual(len(self._spooled_files()), 1)
+        self.assertEqual(drain_spool(), 1)
+
+    def test_drain_lock_refreshed(self):
+        for i in range(5):
+            spool_message(
+                "list@example.com", make_message("msg%d" % i).as_bytes())
+        with patch.object(Lock, "refresh", autospec=True) as refresh:
+            self.assertEqual(drain_spool(batch_size=2), 5)
+        self.assertEqual(refresh.call_count, 3)
+        self.assertEqual(refresh.call_args[0][0].lifetime, LOCK_LIFETIME)
+
+    def test_command(self):
+        spool_message("list@example.com", make_message("msg1").as_bytes())
+        call_command("hyperkitty_drain_spool", once=True, verbosity=0)
+        self.assertEqual(self._spooled_files(), [])
+        self.assertEqual(Email.objects.count(), 1)
@@ -26,6 +26,7 @@ from email import message_from_file, message_from_string
 from email.message import EmailMessage
 from tempfile import gettempdir
 from traceback import format_exc
+from unittest.mock import patch
 
 from django.utils import timezone
 from django.utils.timezone import get_fixed_timezone
@@ -372,3 +373,52 @@ Dummy Message
                                   'hyperkitty-jobs-update-index.lock'))
         self.assertIn('ValueError',
                       open(os.path.join(self.tmpdir, 'error.log')).read())
+
+
+class TestLRUCache(TestCase):
+
+    def test_eviction(self):
+        lru = utils.LRUCache(maxsize=2)
+        lru.set("a", 1)
+        lru.set("b", 2)
+        self.assertEqual(lru.get("a"), 1)  # "b" is now the oldest
+        lru.set("c", 3)
+        self.assertEqual(len(lru), 2)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), 1)
+        self.assertEqual(lru.get("c"), 3)
+
+    def test_timeout(self):
+        lru = utils.LRUCache(maxsize=2, timeout=10)
+        with patch("hyperkitty.lib.utils.time.monotonic", return_value=100):
+            lru.set("a", 1)
+        with patch("hyperkitty.lib.utils.time.monotonic", return_value=105):
+            self.assertEqual(lru.get("a"), 1)
+        with patch("hyperkitty.lib.utils.time.monotonic", return_value=111):
+            self.assertIsNone(lru.get("a"))
+        self.assertEqual(len(lru), 0)
+
+    def test_disabled(self):
+        lru = utils.LRUCache(maxsize=0)
+        lru.set("a", 1)
+        self.assertIsNone(lru.get("a"))
+
+
+class TestBloomFilter(TestCase):
+
+    def test_contains(self):
+        bloom = utils.BloomFilter(100)
+        for i in range(100):
+            bloom.add("msg%d@example.com" % i)
+        for i in range(100):
+            self.assertIn("msg%d@example.com" % i, bloom)
+        false_positives = sum(
+            "other%d@example.com" % i in bloom for i in range(1000))
+        # The error rate is 1%.
+        self.assertLess(false_positives, 50)
+
+    def test_empty(self):
+        bloom = utils.BloomFilter(0)
+        self.assertNotIn("msg@example.com", bloom)
+        bloom.add("msg@example.com")
+        self.assertIn("msg@example.com", bloom)
@@ -0,0 +1,430 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2024 by the Free Software Foundation, Inc.
+#
+# This file is part of HyperKitty.
+#
+# HyperKitty is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option)
+# any later version.
+#
+# HyperKitty is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+# FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License for
+# more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# HyperKitty.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+from email.message import EmailMessage
+from unittest.mock import patch
+
+from django.core.cache import cache
+
+from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models import common
+from hyperkitty.models.common import Generations, LocalCache, ModelCachedValue
+from hyperkitty.models.email import Email
+from hyperkitty.models.mailinglist import MailingList
+from hyperkitty.models.thread import Thread
+from hyperkitty.tests.utils import TestCase
+
+
+class Dummy(object):
+
+    def __init__(self, pk):
+        self.pk = pk
+        self.value = "value"
+
+
+class DummyValue(ModelCachedValue):
+
+    cache_key = "dummy"
+    local = True
+
+    def get_value(self):
+        return self.instance.value
+
+
+class OtherDummyValue(DummyValue):
+
+    cache_key = "other_dummy"
+
+
+class LocalCacheTestCase(TestCase):
+
+    def _use_process(self, maxsize=10, check_interval=60):
+        # Each LocalCache instance acts like the cache of another process.
+        local_cache = LocalCache(
+            maxsize=maxsize, timeout=60, check_interval=check_interval)
+        patcher = patch.object(common, "local_cache", local_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return local_cache
+
+    def test_local_hit(self):
+        self._use_process()
+        cached_value = DummyValue(Dummy(1))
+        self.assertEqual(cached_value(), "value")
+        with patch.object(cache, "get", wraps=cache.get) as cache_get:
+            self.assertEqual(cached_value(), "value")
+            self.assertEqual(DummyValue(Dummy(1))(), "value")
+        self.assertFalse(cache_get.called)
+
+    def test_disabled(self):
+        local_cache = self._use_process(maxsize=0)
+        cached_value = DummyValue(Dummy(1))
+        self.assertEqual(cached_value(), "value")
+        self.assertEqual(len(local_cache.values), 0)
+        with patch.object(cache, "get", wraps=cache.get) as cache_get:
+            self.assertEqual(cached_value(), "value")
+        self.assertEqual(cache_get.call_count, 1)
+
+    def test_not_local(self):
+        local_cache = self._use_process()
+        with patch.object(DummyValue, "local", False):
+            self.assertEqual(DummyValue(Dummy(1))(), "value")
+        self.assertEqual(len(local_cache.values), 0)
+
+    def test_bounded(self):
+        local_cache = self._use_process(maxsize=2)
+        for pk in range(5):
+            DummyValue(Dummy(pk))()
+        self.assertEqual(len(local_cache.values), 2)
+
+    def test_rebuild_in_other_process(self):
+        self._use_process(check_interval=0)
+        instance = Dummy(1)
+        self.assertEqual(DummyValue(instance)(), "value")
+        # Another process rebuilds the value.
+        self._use_process(check_interval=0)
+        instance.value = "new value"
+        DummyValue(instance).rebuild()
+        self.assertEqual(DummyValue(instance)(), "new value")
+        # The value is invalidated in the first process.
+        self._use_process(check_interval=0)
+        self.assertEqual(DummyValue(instance)(), "new value")
+
+    def test_rebuild_other_value(self):
+        # Rebuilding a value does not invalidate the other values of the
+        # instance.
+        self._use_process(check_interval=0)
+        instance = Dummy(1)
+        self.assertEqual(DummyValue(instance)(), "value")
+        OtherDummyValue(instance).rebuild()
+        with patch.object(DummyValue, "_get_shared") as get_shared:
+            self.assertEqual(DummyValue(instance)(), "value")
+        self.assertFalse(get_shared.called)
+
+    def test_check_interval(self):
+        # The generations are only read again after the check interval.
+        first_process = self._use_process(check_interval=60)
+        instance = Dummy(1)
+        self.assertEqual(DummyValue(instance)(), "value")
+        self._use_process()
+        instance.value = "new value"
+        DummyValue(instance).rebuild()
+        with patch.object(common, "local_cache", first_process):
+            self.assertEqual(DummyValue(instance)(), "value")
+            first_process.generations.clear()
+            self.assertEqual(DummyValue(instance)(), "new value")
+
+    def test_generation_evicted(self):
+        self._use_process(check_interval=0)
+        instance = Dummy(1)
+        self.assertEqual(DummyValue(instance)(), "value")
+        cache.clear()
+        instance.value = "new value"
+        self.assertEqual(DummyValue(instance)(), "new value")
+
+    def test_add_thread(self):
+        # The recent threads are invalidated when another process adds a
+        # thread.
+        first_process = self._use_process(check_interval=0)
+        mlist = MailingList.objects.create(name="example-list")
+        self.assertEqual(mlist.recent_threads, [])
+        self._use_process(check_interval=0)
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Message-ID"] = "<msg>"
+        msg.set_payload("Dummy message")
+        add_to_list("example-list", msg)
+        with patch.object(common, "local_cache", first_process):
+            self.assertEqual(
+                [thread.thread_id for thread in mlist.recent_threads],
+                [mlist.threads.get().thread_id])
+
+
+class ExpiringValue(ModelCachedValue):
+
+    cache_key = "expiring"
+    timeout = 60
+
+    def get_value(self):
+        self.instance.computed += 1
+        return self.instance.value
+
+
+class NoneValue(ModelCachedValue):
+
+    cache_key = "none"
+
+    def get_value(self):
+        self.instance.computed += 1
+        # Let the other reader try to rebuild it meanwhile.
+        self.instance.started.set()
+        self.instance.release.wait(5)
+        return None
+
+
+class StampedeTestCase(TestCase):
+
+    def setUp(self):
+        self.instance = Dummy(1)
+        self.instance.computed = 0
+        self.cached_value = ExpiringValue(self.instance)
+        self.cache_key = self.cached_value._get_cache_key()
+        self.lock_key = "%s:rebuild_lock" % self.cache_key
+
+    def _expire(self):
+        value, expires, duration = cache.get(self.cache_key)
+        cache.set(self.cache_key, (value, expires - 120, duration))
+
+    def test_rebuild(self):
+        self.assertEqual(self.cached_value(), "value")
+        self.assertEqual(self.cached_value(), "value")
+        self.assertEqual(self.instance.computed, 1)
+        # The lock is released.
+        self.assertIsNone(cache.get(self.lock_key))
+        value, expires, duration = cache.get(self.cache_key)
+        self.assertEqual(value, "value")
+
+    def test_rebuild_after_expiration(self):
+        self.cached_value()
+        self._expire()
+        self.instance.value = "new value"
+        self.assertEqual(self.cached_value(), "new value")
+        self.assertEqual(self.instance.computed, 2)
+
+    def test_stale_while_rebuilding(self):
+        # Another process is rebuilding the value, the stale copy is served.
+        self.cached_value()
+        self._expire()
+        self.instance.value = "new value"
+        cache.add(self.lock_key, True)
+        self.assertEqual(self.cached_value(), "value")
+        self.assertEqual(self.instance.computed, 1)
+
+    def test_wait_while_rebuilding(self):
+        # Another process is rebuilding the value and there is no stale copy,
+        # wait for the new value.
+        cache.add(self.lock_key, True)
+
+        def other_process(seconds):
+            cache.set(self.cache_key, ("other value", 0, 0))
+
+        with patch("hyperkitty.models.common.time.sleep") as sleep:
+            sleep.side_effect = other_process
+            self.assertEqual(self.cached_value(), "other value")
+        self.assertEqual(self.instance.computed, 0)
+
+    def test_wait_timeout(self):
+        # The other process does not store the value in time, rebuild it.
+        cache.add(self.lock_key, True)
+        with self.settings(HYPERKITTY_CACHE_REBUILD_WAIT=0):
+            self.assertEqual(self.cached_value(), "value")
+        self.assertEqual(self.instance.computed, 1)
+
+    def test_lock_released(self):
+        # The other process has released the lock without storing the value,
+        # don't wait any longer.
+        cache.add(self.lock_key, True)
+
+        def other_process(seconds):
+            cache.delete(self.lock_key)
+
+        with patch("hyperkitty.models.common.time.sleep") as sleep:
+            sleep.side_effect = other_process
+            self.assertEqual(self.cached_value(), "value")
+        self.assertEqual(sleep.call_count, 1)
+        self.assertEqual(self.instance.computed, 1)
+
+    def test_none_value(self):
+        # A value of None is cached, and the concurrent readers don't wait
+        # until the timeout for it.
+        self.instance.started = threading.Event()
+        self.instance.release = threading.Event()
+        results = []
+
+        def read():
+            results.append(NoneValue(self.instance)())
+
+        first_reader = threading.Thread(target=read)
+        first_reader.start()
+        self.instance.started.wait(5)
+        second_reader = threading.Thread(target=read)
+        start = time.monotonic()
+        with self.settings(HYPERKITTY_CACHE_REBUILD_WAIT=5):
+            second_reader.start()
+            self.instance.release.set()
+            first_reader.join()
+            second_reader.join()
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(results, [None, None])
+        self.assertEqual(self.instance.computed, 1)
+        self.assertIsNone(NoneValue(self.instance)())
+        self.assertEqual(self.instance.computed, 1)
+
+    def test_early_refresh(self):
+        self.cached_value()
+        value, expires, duration = cache.get(self.cache_key)
+        cache.set(self.cache_key, (value, expires, 10))
+        self.instance.value = "new value"
+        # Far from the expiration time, the value is not refreshed.
+        with patch("hyperkitty.models.common.random.random",
+                   return_value=0.5):
+            self.assertEqual(self.cached_value(), "value")
+        # With a low random value, it is refreshed before it expires.
+        with patch("hyperkitty.models.common.random.random",
+                   return_value=1 - 1e-10):
+            self.assertEqual(self.cached_value(), "new value")
+        self.assertEqual(self.instance.computed, 2)
+        # It can be disabled.
+        cache.set(self.cache_key, (value, expires, 10))
+        with self.settings(HYPERKITTY_CACHE_EARLY_REFRESH=0), \
+                patch("hyperkitty.models.common.random.random",
+                      return_value=1 - 1e-10):
+            self.assertEqual(self.cached_value(), "value")
+
+    def test_prefetch(self):
+        # The prefetched values are unwrapped, and the missing ones are stored
+        # like the rebuilt ones.
+        self.cached_value()
+        other = Dummy(2)
+        other.computed = 0
+        other.value = "other value"
+        for instance in (self.instance, other):
+            instance.cached_values = {"expiring": ExpiringValue(instance)}
+        ModelCachedValue.prefetch([self.instance, other], ["expiring"])
+        self.assertEqual(self.instance.cached_values["expiring"](), "value")
+        self.assertEqual(other.cached_values["expiring"](), "other value")
+        self.assertEqual(
+            cache.get(ExpiringValue(other)._get_cache_key())[0],
+            "other value")
+
+
+class GenerationTestCase(TestCase):
+
+    def setUp(self):
+        self.mlist = MailingList.objects.create(name="example-list")
+        msg = EmailMessage()
+        msg["From"] = "dummy@example.com"
+        msg["Subject"] = "Dummy subject"
+        msg["Message-ID"] = "<msg>"
+        msg.set_payload("Dummy message")
+        add_to_list("example-list", msg)
+        self.thread = Thread.objects.get()
+
+    def _use_process(self, check_interval=60):
+        generations = Generations(
+            "HyperKitty:cache_generation:%s", maxsize=10,
+            check_interval=check_interval)
+        patcher = patch.object(common, "cache_generations", generations)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return generations
+
+    def test_invalidate_mailinglist(self):
+        self.assertEqual(self.thread.subject, "Dummy subject")
+        cached_value = self.mlist.cached_values["top_posters"]
+        former_key = cached_value._get_cache_key()
+        self.assertEqual(len(cached_value()), 1)
+        month_key = self.mlist.cached_values[
+            "participants_count_for_month"]._get_cache_key(2024, 1)
+        self.mlist.invalidate_cache()
+        # All the keys change, and nothing is deleted.
+        self.assertNotEqual(cached_value._get_cache_key(), former_key)
+        self.assertNotEqual(
+            self.mlist.cached_values[
+                "participants_count_for_month"]._get_cache_key(2024, 1),
+            month_key)
+        self.assertIsNotNone(cache.get(former_key))
+        self.assertIsNone(cache.get(cached_value._get_cache_key()))
+        self.assertEqual(len(cached_value()), 1)
+        # The threads are not invalidated.
+        self.assertIsNotNone(cache.get(
+            self.thread.cached_values["subject"]._get_cache_key()))
+
+    def test_invalidate_thread(self):
+        generation = self.thread.cache_generation
+        self.assertEqual(self.thread.subject, "Dummy subject")
+        Email.objects.update(subject="New subject")
+        self.thread.invalidate_cache()
+        self.assertNotEqual(self.thread.cache_generation, generation)
+        self.assertEqual(
+            Thread.objects.get().cached_values["subject"](), "New subject")
+
+    def test_other_process(self):
+        # The other processes see the new generation after the check
+        # interval.
+        first_process = self._use_process()
+        generation = self.mlist.cache_generation
+        self._use_process()
+        self.mlist.invalidate_cache()
+        with patch.object(common, "cache_generations", first_process):
+            self.assertEqual(self.mlist.cache_generation, generation)
+            first_process.clear()
+            self.assertNotEqual(self.mlist.cache_generation, generation)
+
+    def test_evicted(self):
+        self._use_process(check_interval=0)
+        self.assertIsNotNone(self.mlist.cache_generation)
+        cache.clear()
+        self.assertIsNotNone(self.mlist.cache_generation)
+
+    def test_prefetch(self):
+        # The generations and the values are read with one request each.
+        threads = list(Thread.objects.all())
+        ModelCachedValue.prefetch(threads, ["subject"])
+        self._use_process()
+        threads = list(Thread.objects.all())
+        with patch.object(
+                cache, "get_many", wraps=cache.get_many) as get_many:
+            ModelCachedValue.prefetch(threads, ["subject"])
+        self.assertEqual(get_many.call_count, 2)
+        self.assertEqual(threads[0].subject, "Dummy subject")
+
+    def test_no_generation(self):
+        # The models that can't be invalidated don't read a generation.
+        email = Email.objects.get()
+        self.assertEqual(
+            email.cached_values["votes"]._get_cache_key(),
+            "Email:%s:votes" % email.pk)
+        emails = list(Email.objects.all())
+        with patch.object(
+                cache, "get_many", wraps=cache.get_many) as get_many:
+            ModelCachedValue.prefetch(emails, ["votes"])
+        self.assertEqual(get_many.call_count, 1)
+
+    def test_thread_deleted(self):
+        generation = self.mlist.cache_generation
+        self.thread.delete()
+        self.assertNotEqual(self.mlist.cache_generation, generation)
+        self.assertEqual(self.mlist.recent_threads, [])
+        self.assertEqual(self.mlist.recent_threads_count, 0)
+
+    def test_new_email(self):
+        # The template fragments of the thread are invalidated when an email
+        # is added.
+        generation = self.thread.cache_generation
+        msg = EmailMessage()
+        msg["From"] = "other@example.com"
+        msg["Message-ID"] = "<reply>"
+        msg["In-Reply-To"] = "<msg>"
+        msg.set_payload("Dummy reply")
+        add_to_list("example-list", msg)
+        self.assertNotEqual(self.thread.cache_generation, generation)
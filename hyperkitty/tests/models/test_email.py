@@ -26,6 +26,10 @@ from datetime import datetime
 from email import message_from_string
 from email.message import EmailMessage
 from mimetypes import guess_all_extensions
+from unittest.mock import patch
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from hyperkitty.lib.incoming import add_to_list
 from hyperkitty.models import Email, MailingList, Sender, Thread
@@ -300,6 +304,55 @@ class EmailSetParentTestCase(TestCase):
         email1 = _create_tree(["msg1"])[0]
         self.assertRaises(ValueError, email1.set_parent, email1)
 
+    def test_subthread_of_another_thread(self):
+        # Only part of the former thread is moved
+        email1, email1_1 = _create_tree(["msg1", "msg1.1"])
+        email2, email2_1, email2_1_1 = _create_tree(
+            ["msg2", "msg2.1", "msg2.1.1"])
+        former_thread = email2.thread
+        with patch("hyperkitty.tasks.rebuild_thread_cache_new_email") as rc:
+            email2_1.set_parent(email1_1)
+        self.assertEqual(
+            [c[0][0] for c in rc.call_args_list],
+            [email1.thread_id, former_thread.id])
+        self.assertEqual(email2_1.thread_id, email1.thread_id)
+        email2_1_1.refresh_from_db()
+        self.assertEqual(email2_1_1.thread_id, email1.thread_id)
+        self.assertEqual(
+            list(email1.thread.emails.order_by("thread_order").values_list(
+                "message_id", "thread_depth")),
+            [("msg1", 0), ("msg1.1", 1), ("msg2.1", 2), ("msg2.1.1", 3)])
+        thread = Thread.objects.get(id=email1.thread_id)
+        self.assertEqual(thread.date_active, email2_1_1.date)
+        # The former thread is still there, with its starting email
+        former_thread.refresh_from_db()
+        self.assertEqual(
+            list(former_thread.emails.values_list("message_id", flat=True)),
+            ["msg2"])
+        self.assertEqual(former_thread.date_active, email2.date)
+
+    def test_whole_thread_moved(self):
+        email1, email2 = _create_tree(["msg1", "msg2"])
+        former_thread_id = email2.thread_id
+        with patch("hyperkitty.tasks.rebuild_thread_cache_new_email") as rc:
+            email2.set_parent(email1)
+        self.assertFalse(Thread.objects.filter(id=former_thread_id).exists())
+        # Only the target thread's cache is rebuilt
+        self.assertEqual(rc.call_count, 1)
+        rc.assert_called_with(email1.thread_id)
+
+    def test_number_of_queries(self):
+        # The number of queries does not depend on the size of the subthread
+        def _count_queries(prefix, size):
+            tree = ["%s1" % prefix, "%s2" % prefix]
+            tree.extend(
+                "%s2%s" % (prefix, ".1" * depth) for depth in range(1, size))
+            emails = _create_tree(tree)
+            with CaptureQueriesContext(connection) as queries:
+                emails[2].set_parent(emails[0])
+            return len(queries)
+        self.assertEqual(_count_queries("a", 2), _count_queries("b", 10))
+
 
 class EmailDeleteTestCase(TestCase):
 
@@ -23,11 +23,17 @@
 import random
 import string
 from email.message import EmailMessage
+from unittest.mock import patch
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connection
 
 from hyperkitty.lib.incoming import add_to_list
+from hyperkitty.models.common import ModelCachedValue
 from hyperkitty.models.email import Email
 from hyperkitty.models.mailinglist import MailingList
-from hyperkitty.models.thread import Thread
+from hyperkitty.models.thread import Thread, update_counters
 from hyperkitty.tests.utils import TestCase
 
 
@@ -125,3 +131,218 @@ class ThreadTestCase(TestCase):
         self.assertTrue(
             len(msg_db.subject) < 2712,
             "Very long subjects are not trimmed")
+
+
+def _add_emails():
+    # Three threads, with zero, one and two replies.
+    for i in range(3):
+        msg = EmailMessage()
+        msg["From"] = "sender%d@example.com" % i
+        msg["Message-ID"] = "<msg%d>" % i
+        msg["Subject"] = "Subject %d" % i
+        msg["Date"] = "Fri, 02 Nov 2012 16:0%d:00 +0000" % i
+        msg.set_payload("message %d" % i)
+        add_to_list("example-list", msg)
+        for j in range(i):
+            reply = EmailMessage()
+            reply["From"] = "replier%d@example.com" % j
+            reply["Message-ID"] = "<reply%d-%d>" % (i, j)
+            reply["In-Reply-To"] = "<msg%d>" % i
+            reply["Date"] = "Fri, 02 Nov 2012 17:0%d:00 +0000" % j
+            reply.set_payload("reply")
+            add_to_list("example-list", reply)
+
+
+class ThreadPrefetchTestCase(TestCase):
+
+    def setUp(self):
+        _add_emails()
+        self.expected = {
+            thread.id: thread.subject for thread in Thread.objects.all()}
+        cache.clear()
+
+    def _get_subjects(self, threads):
+        return {thread.id: thread.subject for thread in threads}
+
+    def test_prefetch_misses(self):
+        # The values are rebuilt with one query per key.
+        threads = list(Thread.objects.all())
+        with self.assertNumQueries(1):
+            ModelCachedValue.prefetch(threads, ["subject"])
+        with self.assertNumQueries(0):
+            self.assertEqual(self._get_subjects(threads), self.expected)
+        # The rebuilt values have been cached.
+        threads = list(Thread.objects.all())
+        with self.assertNumQueries(0):
+            self.assertEqual(self._get_subjects(threads), self.expected)
+
+    def test_prefetch_single_cache_request(self):
+        ModelCachedValue.prefetch(Thread.objects.all(), ["subject"])
+        threads = list(Thread.objects.all())
+        with patch("hyperkitty.models.common.cache.get_many",
+                   wraps=cache.get_many) as get_many:
+            with self.assertNumQueries(0):
+                ModelCachedValue.prefetch(threads, ["subject"])
+        self.assertEqual(get_many.call_count, 1)
+        with patch("hyperkitty.models.common.cache.get") as get:
+            with self.assertNumQueries(0):
+                self.assertEqual(self._get_subjects(threads), self.expected)
+        self.assertFalse(get.called)
+
+    def test_prefetch_partial(self):
+        # Only the missing values are rebuilt.
+        thread = Thread.objects.get(starting_email__message_id="msg2")
+        self.assertEqual(thread.subject, "Subject 2")
+        threads = list(Thread.objects.order_by("id"))
+        with patch("hyperkitty.models.thread.Subject.get_values",
+                   return_value=["a", "b"]) as get_values:
+            ModelCachedValue.prefetch(threads, ["subject"])
+        self.assertEqual(
+            [cv.instance.id for cv in get_values.call_args[0][0]],
+            [t.id for t in threads if t.id != thread.id])
+        self.assertEqual(
+            [t.subject for t in threads if t.id != thread.id], ["a", "b"])
+
+    def test_rebuild_after_prefetch(self):
+        thread = Thread.objects.get(starting_email__message_id="msg0")
+        ModelCachedValue.prefetch([thread], ["subject"])
+        Email.objects.filter(message_id="msg0").update(subject="Changed")
+        thread.cached_values["subject"].rebuild()
+        self.assertEqual(thread.subject, "Changed")
+
+    def test_prefetch_email_votes(self):
+        user = User.objects.create(username="dummy")
+        Email.objects.get(message_id="msg1").vote(1, user)
+        Email.objects.get(message_id="reply2-0").vote(-1, user)
+        expected = {email.id: email.get_votes()
+                    for email in Email.objects.all()}
+        cache.clear()
+        emails = list(Email.objects.all())
+        with self.assertNumQueries(1):
+            ModelCachedValue.prefetch(emails, ["votes"])
+        with self.assertNumQueries(0):
+            self.assertEqual(
+                {email.id: email.get_votes() for email in emails}, expected)
+
+
+class ThreadCountersTestCase(TestCase):
+
+    def setUp(self):
+        _add_emails()
+        self.user = User.objects.create(username="dummy")
+
+    def _get_counters(self, thread):
+        thread = Thread.objects.get(id=thread.id)
+        return (thread.emails_count, thread.participants_count,
+                thread.likes, thread.dislikes,
+                thread.last_email.message_id if thread.last_email else None)
+
+    def _get_thread(self, message_id):
+        return Email.objects.get(message_id=message_id).thread
+
+    def test_add(self):
+        self.assertEqual(self._get_counters(self._get_thread("msg0")),
+                         (1, 1, 0, 0, "msg0"))
+        self.assertEqual(self._get_counters(self._get_thread("msg2")),
+                         (3, 3, 0, 0, "reply2-1"))
+        # The same sender is only counted once.
+        msg = EmailMessage()
+        msg["From"] = "sender2@example.com"
+        msg["Message-ID"] = "<reply2-2>"
+        msg["In-Reply-To"] = "<reply2-0>"
+        msg["Date"] = "Fri, 02 Nov 2012 16:30:00 +0000"
+        msg.set_payload("reply")
+        add_to_list("example-list", msg)
+        # Older than the last email.
+        self.assertEqual(self._get_counters(self._get_thread("msg2")),
+                         (4, 3, 0, 0, "reply2-1"))
+
+    def test_delete(self):
+        Email.objects.get(message_id="reply2-1").delete()
+        self.assertEqual(self._get_counters(self._get_thread("msg2")),
+                         (2, 2, 0, 0, "reply2-0"))
+
+    def test_votes(self):
+        email = Email.objects.get(message_id="reply2-0")
+        thread = email.thread
+        email.vote(1, self.user)
+        self.assertEqual(self._get_counters(thread), (3, 3, 1, 0, "reply2-1"))
+        email.vote(-1, self.user)
+        self.assertEqual(self._get_counters(thread), (3, 3, 0, 1, "reply2-1"))
+        Email.objects.get(message_id="msg2").vote(-1, self.user)
+        thread = Thread.objects.get(id=thread.id)
+        self.assertEqual(thread.get_votes(), {
+            "likes": 0, "dislikes": 2, "status": "neutral"})
+        self.assertEqual(thread.votes_total, -2)
+        email.vote(0, self.user)
+        self.assertEqual(self._get_counters(thread), (3, 3, 0, 1, "reply2-1"))
+        email.delete()
+        Email.objects.get(message_id="msg2").delete()
+        self.assertEqual(self._get_counters(thread), (1, 1, 0, 0, "reply2-1"))
+
+    def test_participants_check_locked(self):
+        # The thread is locked before looking for the other emails of the
+        # sender, so that concurrent emails are not counted twice.
+        calls = []
+        has_other_email_from = Thread._has_other_email_from
+
+        def _has_other_email_from(thread, email):
+            calls.append("check")
+            return has_other_email_from(thread, email)
+
+        msg = EmailMessage()
+        msg["From"] = "sender2@example.com"
+        msg["Message-ID"] = "<reply2-2>"
+        msg["In-Reply-To"] = "<reply2-0>"
+        msg.set_payload("reply")
+        with patch.object(Thread, "_lock", autospec=True,
+                          side_effect=lambda t: calls.append("lock")), \
+                patch.object(Thread, "_has_other_email_from",
+                             _has_other_email_from):
+            add_to_list("example-list", msg)
+        self.assertEqual(calls, ["lock", "check"])
+        self.assertEqual(self._get_counters(self._get_thread("msg2"))[:2],
+                         (4, 3))
+
+    def test_lock(self):
+        thread = self._get_thread("msg2")
+        with patch.object(connection.features,
+                          "has_select_for_no_key_update", True), \
+                patch.object(Thread.objects, "select_for_update",
+                             wraps=Thread.objects.select_for_update) as sfu:
+            thread._lock()
+        sfu.assert_called_once_with(no_key=True)
+        # The other databases don't support a lock that would not conflict
+        # with the new emails.
+        with patch.object(connection.features,
+                          "has_select_for_no_key_update", False), \
+                patch.object(Thread.objects, "select_for_update") as sfu:
+            thread._lock()
+        self.assertFalse(sfu.called)
+
+    def test_save_keeps_counters(self):
+        # Saving an instance that was loaded before the counters changed does
+        # not overwrite them.
+        thread = self._get_thread("msg0")
+        Email.objects.get(message_id="msg0").vote(1, self.user)
+        thread.date_active = thread.date_active
+        thread.save()
+        self.assertEqual(self._get_counters(thread), (1, 1, 1, 0, "msg0"))
+
+    def test_set_parent(self):
+        former_thread = self._get_thread("msg2")
+        Email.objects.get(message_id="reply2-1").vote(1, self.user)
+        Email.objects.get(message_id="reply2-1").set_parent(
+            Email.objects.get(message_id="msg1"))
+        self.assertEqual(self._get_counters(former_thread),
+                         (2, 2, 0, 0, "reply2-0"))
+        self.assertEqual(self._get_counters(self._get_thread("msg1")),
+                         (3, 3, 1, 0, "reply2-1"))
+
+    def test_update_counters(self):
+        thread = self._get_thread("msg2")
+        Thread.objects.filter(id=thread.id).update(
+            emails_count=42, likes=1, last_email=None)
+        self.assertEqual(
+            update_counters(Thread.objects.values_list("id", flat=True)), 1)
+        self.assertEqual(self._get_counters(thread), (3, 3, 0, 0, "reply2-1"))
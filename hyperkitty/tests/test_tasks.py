@@ -21,7 +21,11 @@
 #
 
 from email.message import EmailMessage
-from unittest.mock import patch
+from unittest.mock import Mock, patch
+
+from django.core.cache import cache
+from django.db import transaction
+from django.test import override_settings
 
 from hyperkitty import tasks
 from hyperkitty.lib.incoming import add_to_list
@@ -39,12 +43,6 @@ class TaskTestCase(TestCase):
         except Thread.DoesNotExist:
             self.fail("No protection when the thread is deleted")
 
-    def test_rebuild_thread_cache_votes_no_thread(self):
-        try:
-            tasks.rebuild_thread_cache_votes(42)
-        except Thread.DoesNotExist:
-            self.fail("No protection when the thread is deleted")
-
     def test_compute_thread_positions_no_thread(self):
         try:
             tasks.compute_thread_positions(42)
@@ -103,3 +101,80 @@ class TaskTestCase(TestCase):
         tasks.check_orphans(orig.id)
         reply.refresh_from_db()
         self.assertEqual(reply.parent_id, orig.pk)
+
+
+class CoalescingTestCase(TestCase):
+
+    def setUp(self):
+        patcher = patch("hyperkitty.tasks.AsyncTask")
+        self.AsyncTask = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _run_queued(self):
+        for call in self.AsyncTask.call_args_list:
+            func, *args = call[0]
+            func(*args)
+        self.AsyncTask.reset_mock()
+
+    def test_identical_tasks_coalesced(self):
+        for i in range(5):
+            tasks.rebuild_mailinglist_cache_recent("list@example.com")
+        self.assertEqual(self.AsyncTask.call_count, 1)
+        self.assertEqual(
+            tasks.get_coalesced_counts()["rebuild_mailinglist_cache_recent"],
+            4)
+
+    def test_different_args_not_coalesced(self):
+        tasks.rebuild_mailinglist_cache_recent("list1@example.com")
+        tasks.rebuild_mailinglist_cache_recent("list2@example.com")
+        tasks.rebuild_mailinglist_cache_for_month(
+            "list1@example.com", 2024, 1)
+        tasks.rebuild_mailinglist_cache_for_month(
+            "list1@example.com", 2024, 2)
+        self.assertEqual(self.AsyncTask.call_count, 4)
+        self.assertEqual(
+            tasks.get_coalesced_counts()["rebuild_mailinglist_cache_recent"],
+            0)
+
+    def test_queued_again_once_started(self):
+        tasks.rebuild_thread_cache_new_email(42)
+        tasks.rebuild_thread_cache_new_email(42)
+        self.assertEqual(self.AsyncTask.call_count, 1)
+        self._run_queued()
+        # The task has run, a new event must queue it again.
+        tasks.rebuild_thread_cache_new_email(42)
+        self.assertEqual(self.AsyncTask.call_count, 1)
+
+    def test_task_runs_the_function(self):
+        func = Mock()
+        tasks.run_coalesced("rebuild_cache_popular_threads", func, "arg")
+        self._run_queued()
+        func.assert_called_once_with("arg")
+        self.assertIsNone(cache.get(tasks._get_pending_key(
+            "rebuild_cache_popular_threads", ("arg", ))))
+
+    def test_queued_on_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.rebuild_mailinglist_cache_recent("list@example.com")
+            self.assertFalse(self.AsyncTask.called)
+        self.assertEqual(self.AsyncTask.call_count, 1)
+
+    def test_rollback(self):
+        try:
+            with transaction.atomic():
+                tasks.rebuild_mailinglist_cache_recent("list@example.com")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(self.AsyncTask.called)
+        self.assertIsNone(cache.get(tasks._get_pending_key(
+            "rebuild_mailinglist_cache_recent", ("list@example.com", ))))
+        # No marker was left behind, the next event queues the task.
+        tasks.rebuild_mailinglist_cache_recent("list@example.com")
+        self.assertEqual(self.AsyncTask.call_count, 1)
+
+    @override_settings(HYPERKITTY_TASK_COALESCE_WINDOW=0)
+    def test_disabled(self):
+        for i in range(3):
+            tasks.rebuild_mailinglist_cache_recent("list@example.com")
+        self.assertEqual(self.AsyncTask.call_count, 3)
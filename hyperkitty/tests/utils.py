@@ -24,6 +24,8 @@ import logging
 import os
 import shutil
 import tempfile
+from contextlib import contextmanager
+from email.message import EmailMessage
 from unittest import SkipTest
 from unittest.mock import Mock, patch
 
@@ -31,7 +33,7 @@ from django.apps import apps
 from django.conf import settings
 from django.core.cache import cache
 from django.core.management import call_command
-from django.db import connection
+from django.db import connection, transaction
 from django.db.migrations import RunPython, RunSQL
 from django.db.migrations.executor import MigrationExecutor
 from django.test import TestCase as DjangoTestCase
@@ -39,6 +41,8 @@ from django.test import TransactionTestCase
 
 import mailmanclient
 
+from hyperkitty.lib.incoming import clear_lookup_caches
+
 
 def setup_logging(tmpdir):
     formatter = logging.Formatter(fmt="%(message)s")
@@ -87,14 +91,60 @@ class TestCase(DjangoTestCase):
             "django_mailman3.lib.mailman.MailmanClient",
             lambda *a: self.mailman_client)
         self._mm_client_patcher.start()
+        # The test runs inside a transaction that is never committed, run the
+        # on_commit() callbacks when the code would have committed instead.
+        self._capturing_on_commit = False
+        self._on_commit_patchers = [
+            patch("django.db.transaction.on_commit",
+                  self._on_commit(transaction.on_commit)),
+            patch.object(transaction.Atomic, "__exit__",
+                         self._atomic_exit(transaction.Atomic.__exit__)),
+        ]
+        for patcher in self._on_commit_patchers:
+            patcher.start()
+
+    def _on_commit(self, original):
+        def on_commit(func, using=None, robust=False):
+            original(func, using=using, robust=robust)
+            self._run_commit_hooks(using)
+        return on_commit
+
+    def _atomic_exit(self, original):
+        def __exit__(atomic, *args):
+            result = original(atomic, *args)
+            self._run_commit_hooks(atomic.using)
+            return result
+        return __exit__
+
+    def _run_commit_hooks(self, using):
+        db_connection = transaction.get_connection(using)
+        if self._capturing_on_commit or not db_connection.atomic_blocks:
+            return
+        if all(block._from_testcase for block in db_connection.atomic_blocks):
+            db_connection.run_on_commit, callbacks = [], \
+                db_connection.run_on_commit
+            for _sids, func, _robust in callbacks:
+                func()
+
+    @contextmanager
+    def captureOnCommitCallbacks(self, **kwargs):
+        self._capturing_on_commit = True
+        try:
+            with super().captureOnCommitCallbacks(**kwargs) as callbacks:
+                yield callbacks
+        finally:
+            self._capturing_on_commit = False
 
     def _override_setting(self, key, value):
         self._old_settings[key] = getattr(settings, key, None)
         setattr(settings, key, value)
 
     def _post_teardown(self):
+        for patcher in self._on_commit_patchers:
+            patcher.stop()
         self._mm_client_patcher.stop()
         cache.clear()
+        clear_lookup_caches()
         for key, value in self._old_settings.items():
             if value is None:
                 delattr(settings, key)
@@ -167,3 +217,14 @@ def get_test_file(*fileparts):
 
 
 get_test_file.__test__ = False
+
+
+def make_message(msgid, sender="dummy@example.com"):
+    """A minimal email, as received from Mailman."""
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["Subject"] = "Fake Subject"
+    msg["Message-ID"] = "<%s>" % msgid
+    msg["Date"] = "Fri, 02 Nov 2012 16:07:54"
+    msg.set_payload("Fake Message")
+    return msg
@@ -139,7 +139,7 @@ class ListArchivesTestCase(TestCase):
         # Test the overview page with a clean cache (different code path for
         # MailingList.recent_threads)
         mlist = MailingList.objects.get(name="list@example.com")
-        cache.delete("MailingList:%s:recent_threads" % mlist.pk)
+        cache.delete(mlist.cached_values["recent_threads"]._get_cache_key())
         response = self.client.get(
             reverse('hk_list_overview', args=["list@example.com"]))
         self.assertEqual(response.status_code, 200)
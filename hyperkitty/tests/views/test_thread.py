@@ -469,7 +469,10 @@ class ThreadTestCase(TestCase):
         self._make_msg("id2", {
             "In-Reply-To": "<id1>", "Subject": "A reply"
             })
-        with patch("hyperkitty.tasks.compute_thread_order_and_depth") as ctoad:
+        with patch("hyperkitty.tasks.add_to_thread_order",
+                   return_value=False), \
+                patch("hyperkitty.tasks.compute_thread_order_and_depth") \
+                as ctoad:
             self._make_msg("id3", {
                 "In-Reply-To": "<id2>", "Subject": "A reply"
                 })
@@ -148,6 +148,9 @@ urlpatterns = [
     # Mailman archiver API
     path('api/mailman/urls', mailman.urls, name='hk_mailman_urls'),
     path('api/mailman/archive', mailman.archive, name='hk_mailman_archive'),
+    path('api/mailman/archive/batch', mailman.archive_batch,
+        name='hk_mailman_archive_batch'),
+    path('api/mailman/metrics', mailman.metrics, name='hk_mailman_metrics'),
 
     # REST API
     path('api/', include(api_patterns)),
@@ -25,6 +25,7 @@ import json
 import logging
 from email import message_from_binary_file
 from email.message import EmailMessage
+from email.parser import BytesHeaderParser
 from email.policy import default
 from functools import wraps
 from urllib.parse import unquote, urljoin
@@ -38,8 +39,14 @@ from django.views.decorators.http import require_POST
 
 from django_mailman3.models import MailDomain
 
-from hyperkitty.lib.incoming import DuplicateMessage, add_to_list
+from hyperkitty.lib import metrics as hk_metrics
+from hyperkitty.lib.incoming import (
+    STAGES, SUPPRESSED_COUNTERS, DuplicateMessage,
+    add_many_to_list, add_to_list)
+from hyperkitty.lib.mbox import MboxStreamReader, parse_mbox_message
+from hyperkitty.lib.spool import get_spool_dir, spool_message
 from hyperkitty.lib.utils import get_message_id_hash
+from hyperkitty.tasks import get_coalesced_counts
 
 
 logger = logging.getLogger(__name__)
@@ -118,7 +125,7 @@ def key_and_ip_auth(func):
     return _decorator
 
 
-def _get_url(mlist_fqdn, msg_id=None):
+def _get_url(mlist_fqdn, msg_id=None, domain=None):
     # We can't use HttpRequest.build_absolute_uri() because the mailman API may
     # be accessed via localhost.
     # https://docs.djangoproject.com/en/dev/ref/request-response/#django.http.HttpRequest.build_absolute_uri
@@ -134,13 +141,28 @@ def _get_url(mlist_fqdn, msg_id=None):
         url = reverse('hk_message_index', kwargs={
             "mlist_fqdn": mlist_fqdn, "message_id_hash": msg_hash})
     relative_url = unquote(url)
+    if domain is None:
+        domain = _get_domain(mlist_fqdn)
+    return urljoin("https://%s" % domain, relative_url)
+
+
+def _get_domain(mlist_fqdn):
     mail_domain = mlist_fqdn.split("@")[1]
     try:
-        domain = MailDomain.objects.get(
-            mail_domain=mail_domain).site.domain
+        return MailDomain.objects.get(mail_domain=mail_domain).site.domain
     except MailDomain.DoesNotExist:
-        domain = mail_domain
-    return urljoin("https://%s" % domain, relative_url)
+        return mail_domain
+
+
+def _split_mbox(mbox_file):
+    """Split an uploaded mbox file into email messages."""
+    messages = []
+    for _end, data in MboxStreamReader(mbox_file).read():
+        msg = parse_mbox_message(data)
+        # Same format as mailbox.mboxMessage.get_from()
+        msg.set_unixfrom(msg.get_unixfrom()[5:])
+        messages.append(msg)
+    return messages
 
 
 @key_and_ip_auth
@@ -150,6 +172,26 @@ def urls(request):
                         content_type='application/javascript')
 
 
+def _spool(mlist_fqdn, message_file):
+    """Store the message in the spool and let a worker archive it later."""
+    data = message_file.read()
+    msg_id = BytesHeaderParser().parsebytes(data).get("Message-Id")
+    if msg_id is None or not msg_id.strip():
+        error = "No 'Message-Id' header in email"
+        logger.warning("Could not spool the email: %s", error)
+        return HttpResponse(json.dumps({"error": error}), status=400,
+                            content_type='application/javascript')
+    try:
+        spool_message(mlist_fqdn, data)
+    except ValueError as e:
+        return HttpResponse(json.dumps({"error": str(e)}), status=400,
+                            content_type='application/javascript')
+    url = _get_url(mlist_fqdn, msg_id)
+    logger.info("Spooled message %s for %s", msg_id, url)
+    return HttpResponse(json.dumps({"url": url}), status=202,
+                        content_type='application/javascript')
+
+
 @require_POST
 @key_and_ip_auth
 @csrf_exempt
@@ -157,6 +199,8 @@ def archive(request):
     mlist_fqdn = request.POST["mlist"]
     if "message" not in request.FILES:
         raise SuspiciousOperation
+    if get_spool_dir():
+        return _spool(mlist_fqdn, request.FILES['message'])
     msg = message_from_binary_file(
         request.FILES['message'], _class=EmailMessage, policy=default)
     try:
@@ -172,3 +216,69 @@ def archive(request):
     logger.info("Archived message %s to %s", msg['Message-Id'], url)
     return HttpResponse(json.dumps({"url": url}),
                         content_type='application/javascript')
+
+
+@require_POST
+@key_and_ip_auth
+@csrf_exempt
+def archive_batch(request):
+    """Archive many messages to the same list in a single request.
+
+    The messages can be sent as several ``message`` files, or as a single
+    ``mbox`` file, or both.
+    """
+    mlist_fqdn = request.POST["mlist"]
+    messages = [
+        message_from_binary_file(f, _class=EmailMessage, policy=default)
+        for f in request.FILES.getlist("message")
+    ]
+    if "mbox" in request.FILES:
+        messages.extend(_split_mbox(request.FILES["mbox"]))
+    if not messages:
+        raise SuspiciousOperation
+    domain = _get_domain(mlist_fqdn)
+    results = []
+    for msg, result in zip(messages, add_many_to_list(mlist_fqdn, messages)):
+        msg_id = msg.get("Message-Id", None)
+        if isinstance(result, DuplicateMessage):
+            logger.info("Duplicate email with message-id '%s'", result.args[0])
+        elif isinstance(result, Exception):
+            logger.warning(
+                "Could not archive the email with message-id '%s': %s",
+                msg_id, result)
+            results.append({"message_id": msg_id, "error": str(result)})
+            continue
+        url = _get_url(mlist_fqdn, msg_id, domain=domain)
+        logger.info("Archived message %s to %s", msg_id, url)
+        results.append({"message_id": msg_id, "url": url})
+    return HttpResponse(json.dumps({"results": results}),
+                        content_type='application/javascript')
+
+
+@key_and_ip_auth
+def metrics(request):
+    """Return the archiver's counters and timings, in a text format.
+
+    The timings of the archiving stages are only available when the
+    ``CacheCollector`` is enabled in the ``HYPERKITTY_METRICS_COLLECTORS``
+    setting.
+    """
+    lines = []
+    counters = hk_metrics.get_counters(SUPPRESSED_COUNTERS)
+    counters.update(
+        ("coalesced:%s" % name, value)
+        for name, value in get_coalesced_counts().items())
+    for name, value in counters.items():
+        lines.append('hyperkitty_counter{name="%s"} %d' % (name, value))
+    for stage, stats in hk_metrics.get_cached_stats(STAGES).items():
+        lines.append('hyperkitty_archiving_samples{stage="%s"} %d'
+                     % (stage, stats["count"]))
+        for percent in (50, 95):
+            quantile = percent / 100.0
+            lines.append(
+                'hyperkitty_archiving_seconds{stage="%s",quantile="%g"} %f'
+                % (stage, quantile, stats["p%d" % percent]))
+            lines.append(
+                'hyperkitty_archiving_queries{stage="%s",quantile="%g"} %d'
+                % (stage, quantile, stats["queries_p%d" % percent]))
+    return HttpResponse("\n".join(lines) + "\n", content_type="text/plain")
@@ -44,6 +44,7 @@ from django_mailman3.lib.paginator import paginate
 from hyperkitty.lib.view_helpers import (
     check_mlist_private, daterange, get_display_dates, get_months)
 from hyperkitty.models import Favorite, LastView
+from hyperkitty.models.common import ModelCachedValue
 from hyperkitty.signals import silenced_email_pre_delete
 
 
@@ -239,6 +240,12 @@ def overview(request, mlist_fqdn=None):
     return render(request, "hyperkitty/overview.html", context)
 
 
+def _prefetch_overview_threads(threads):
+    # The counters are stored in the threads, only the subject is cached.
+    ModelCachedValue.prefetch(threads, ["subject"])
+    return threads
+
+
 @check_mlist_private
 # @cache_page(3600 * 12)  # cache for 12 hours
 def overview_recent_threads(request, mlist_fqdn):
@@ -246,7 +253,7 @@ def overview_recent_threads(request, mlist_fqdn):
     mlist = request.mlist
     return render(request, "hyperkitty/fragments/overview_threads.html", {
         'mlist': mlist,
-        'threads': mlist.recent_threads[:20],
+        'threads': _prefetch_overview_threads(mlist.recent_threads[:20]),
         'empty': _('No discussions this month (yet).'),
         })
 
@@ -258,7 +265,7 @@ def overview_pop_threads(request, mlist_fqdn):
     mlist = request.mlist
     return render(request, "hyperkitty/fragments/overview_threads.html", {
         'mlist': mlist,
-        'threads': mlist.popular_threads,
+        'threads': _prefetch_overview_threads(mlist.popular_threads),
         "empty": _('No vote has been cast this month (yet).'),
         })
 
@@ -270,7 +277,7 @@ def overview_top_threads(request, mlist_fqdn):
     mlist = request.mlist
     return render(request, "hyperkitty/fragments/overview_threads.html", {
         'mlist': mlist,
-        'threads': mlist.top_threads,
+        'threads': _prefetch_overview_threads(mlist.top_threads),
         "empty": _('No discussions this month (yet).'),
         })
 
@@ -287,7 +294,7 @@ def overview_favorites(request, mlist_fqdn):
         favorites = []
     return render(request, "hyperkitty/fragments/overview_threads.html", {
         'mlist': mlist,
-        'threads': favorites,
+        'threads': _prefetch_overview_threads(favorites),
         "empty": _('You have not flagged any discussions (yet).'),
         })
 
@@ -310,7 +317,7 @@ def overview_posted_to(request, mlist_fqdn):
         threads_posted_to = []
     return render(request, "hyperkitty/fragments/overview_threads.html", {
         'mlist': mlist,
-        'threads': threads_posted_to,
+        'threads': _prefetch_overview_threads(threads_posted_to),
         "empty": _('You have not posted to this list (yet).'),
         })
 
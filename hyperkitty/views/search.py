@@ -33,7 +33,7 @@ from haystack.forms import SearchForm
 from haystack.query import EmptySearchQuerySet, RelatedSearchQuerySet
 
 from hyperkitty.lib.view_helpers import is_mlist_authorized
-from hyperkitty.models import ArchivePolicy, MailingList
+from hyperkitty.models import ArchivePolicy, MailingList, Vote
 
 
 def search(request):
@@ -115,12 +115,14 @@ def search(request):
             _('Parsing error: %(error)s'),
             params={"error": e}, code="parse",
             ))
-    for email in emails:
-        if request.user.is_authenticated:
-            email.object.myvote = email.object.votes.filter(
-                user=request.user).first()
-        else:
-            email.object.myvote = None
+    messages = [email.object for email in emails if email.object is not None]
+    if request.user.is_authenticated:
+        myvotes = {vote.email_id: vote for vote in Vote.objects.filter(
+            email__in=messages, user=request.user)}
+    else:
+        myvotes = {}
+    for message in messages:
+        message.myvote = myvotes.get(message.id)
 
     context = {
         'mlist': mlist,